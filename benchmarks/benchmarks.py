@@ -0,0 +1,263 @@
+import subprocess
+import sys
+import tracemalloc
+
+import numpy as np
+
+import pystream as pst
+
+from . import catchments
+
+# Benchmarks to be run with airspeed velocity (asv), e.g., `asv run` to time
+# the commits of the current branch and `asv continuous master HEAD` to
+# compare two of them (see 'asv.conf.json'). Each phase of the simulation is
+# timed (`time_*`) and tracked in terms of peak memory (`peakmem_*`, i.e., the
+# peak resident memory of the whole process, and `track_*` for the peak
+# memory allocated by the phase itself) separately, for synthetic catchments
+# of `SIZES` x `SIZES` pixels and `NUM_YEARS` of monthly forcing (see the
+# `catchments` module)
+SIZES = [100, 500, 1000, 4000]
+NUM_YEARS = [10, 30]
+
+
+def _trace_peak_memory(func, *args):
+    # peak memory (in bytes) allocated by `func(*args)`, traced with
+    # `tracemalloc`
+    tracemalloc.start()
+    try:
+        start_memory, _ = tracemalloc.get_traced_memory()
+        func(*args)
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak_memory - start_memory
+
+
+class Setup:
+    # construction of the simulation, i.e., reading the terrain and
+    # climatological data, computing the D8 routing and the regridding
+    # weights
+    params = SIZES
+    param_names = ['size']
+    timeout = 600
+
+    def setup(self, size):
+        # ACHTUNG: this also generates (and caches) the synthetic catchment
+        # outside of the timed code
+        self.args, self.kwargs = catchments.synthetic_inputs(size, 10)
+
+    def time_setup(self, size):
+        pst.MonthlySimulation(*self.args, **self.kwargs)
+
+    def time_setup_outlet(self, size):
+        pst.MonthlySimulation(*self.args, gauges='outlet', **self.kwargs)
+
+    def peakmem_setup(self, size):
+        pst.MonthlySimulation(*self.args, **self.kwargs)
+
+    def track_setup_peak_memory(self, size):
+        return pst.MonthlySimulation(*self.args, trace_memory=True,
+                                     **self.kwargs).setup_peak_memory
+
+    track_setup_peak_memory.unit = 'bytes'
+
+
+class Routing:
+    # flow directions and accumulation of a year of monthly outflows
+    params = SIZES
+    param_names = ['size']
+    timeout = 600
+
+    def setup(self, size):
+        self.dem, _, _ = catchments.synthetic_terrain(size)
+        self.routing = pst.D8Routing(self.dem)
+        self.weights = np.random.RandomState(0).rand(12, size * size)
+        # factorize the routing operator outside of `time_accumulate_many`
+        self.routing.accumulate_many(self.weights[:1])
+
+    def time_flow_directions(self, size):
+        pst.D8Routing(self.dem)
+
+    def time_accumulate(self, size):
+        self.routing.accumulate(self.weights[0])
+
+    def time_accumulate_many(self, size):
+        self.routing.accumulate_many(self.weights)
+
+    def time_factorize(self, size):
+        self.routing._operator_lu = None
+        self.routing._get_operator_lu()
+
+    def peakmem_accumulate_many(self, size):
+        self.routing.accumulate_many(self.weights)
+
+    def track_accumulate_many_peak_memory(self, size):
+        return _trace_peak_memory(self.routing.accumulate_many, self.weights)
+
+    track_accumulate_many_peak_memory.unit = 'bytes'
+
+
+class HeatIndex:
+    # yearly heat index and alpha, which are computed once (from the
+    # temperature of the whole record, read year by year) before the first
+    # simulation
+    params = [SIZES, NUM_YEARS]
+    param_names = ['size', 'num_years']
+    timeout = 600
+
+    def setup(self, size, num_years):
+        self.ms = catchments.synthetic_simulation(size, num_years)
+
+    def time_heat_index(self, size, num_years):
+        self.ms._yearly_heat_index = None
+        self.ms._heat_index_alpha_cache = None
+        self.ms._get_yearly_heat_index_alpha(self.ms.HEAT_COEFF)
+
+    def peakmem_heat_index(self, size, num_years):
+        self.ms._yearly_heat_index = None
+        self.ms._heat_index_alpha_cache = None
+        self.ms._get_yearly_heat_index_alpha(self.ms.HEAT_COEFF)
+
+
+class WaterBalance:
+    # water balance of a year of months (without routing), with each engine
+    params = [SIZES, ['numpy', 'numba']]
+    param_names = ['size', 'engine']
+    timeout = 600
+
+    def setup(self, size, engine):
+        self.ms = catchments.synthetic_simulation(size, 10, engine=engine)
+        self.climate = [self.ms._get_climate(i, buffer_names=(None, None))
+                        for i in range(12)]
+        self.heat_index_alpha = list(self.ms._iter_heat_index_alpha())[:12]
+        # compile the numba kernel outside of the timed code
+        self.time_water_balance(size, engine)
+
+    def time_water_balance(self, size, engine):
+        for (prec_i, temp_i), (year_heat_index, year_alpha) in zip(
+                self.climate, self.heat_index_alpha):
+            self.ms._water_balance_step(prec_i, temp_i, year_heat_index,
+                                        year_alpha)
+
+    def peakmem_water_balance(self, size, engine):
+        self.time_water_balance(size, engine)
+
+    def track_water_balance_peak_memory(self, size, engine):
+        # ACHTUNG: the work buffers are allocated in `setup`, so this is the
+        # memory allocated at each step besides them
+        return _trace_peak_memory(self.time_water_balance, size, engine)
+
+    track_water_balance_peak_memory.unit = 'bytes'
+
+
+class Simulate:
+    # whole simulations, i.e., climatological data extraction (and
+    # regridding), water balance and routing, over all the pixels (gauges
+    # set to None) or only over the catchment of the outlet. The outflow is
+    # routed in batches of `MonthlySimulation.ROUTING_BATCH_SIZE` months, so
+    # that memory usage does not grow with the length of the record
+    params = [SIZES, NUM_YEARS, [None, 'outlet']]
+    param_names = ['size', 'num_years', 'gauges']
+    timeout = 1800
+
+    def setup(self, size, num_years, gauges):
+        self.ms = catchments.synthetic_simulation(size, num_years,
+                                                  gauges=gauges)
+        # leave the heat index precomputation out of the timed code
+        self.ms._get_yearly_heat_index_alpha(self.ms.HEAT_COEFF)
+
+    def time_simulate(self, size, num_years, gauges):
+        self.ms.simulate(start=0)
+
+    def peakmem_simulate(self, size, num_years, gauges):
+        self.ms.simulate(start=0)
+
+
+class Metrics:
+    # goodness of fit of the gauge flow of ensembles of simulations
+    params = [[1, 100, 10000], NUM_YEARS]
+    param_names = ['num_members', 'num_years']
+
+    def setup(self, num_members, num_years):
+        rng = np.random.RandomState(0)
+        self.obs_gauge_flow = rng.gamma(2, 10, num_years * 12)
+        self.sim_gauge_flow = self.obs_gauge_flow * rng.lognormal(
+            0, .3, (num_members, num_years * 12))
+
+    def time_nash_sutcliffe(self, num_members, num_years):
+        for sim_gauge_flow in self.sim_gauge_flow:
+            pst.nash_sutcliffe(sim_gauge_flow, self.obs_gauge_flow)
+
+    def time_compute_metrics(self, num_members, num_years):
+        pst.compute_metrics(self.sim_gauge_flow, self.obs_gauge_flow,
+                            num_warmup_months=6)
+
+    def time_streaming_metrics(self, num_members, num_years):
+        streaming_metrics = pst.StreamingMetrics(self.obs_gauge_flow,
+                                                 num_warmup_months=6)
+        for sim_gauge_flow_i in self.sim_gauge_flow.T:
+            streaming_metrics.update(sim_gauge_flow_i)
+        streaming_metrics.result()
+
+    def peakmem_compute_metrics(self, num_members, num_years):
+        self.time_compute_metrics(num_members, num_years)
+
+    def track_compute_metrics_peak_memory(self, num_members, num_years):
+        return _trace_peak_memory(self.time_compute_metrics, num_members,
+                                  num_years)
+
+    track_compute_metrics_peak_memory.unit = 'bytes'
+
+    def track_streaming_metrics_peak_memory(self, num_members, num_years):
+        return _trace_peak_memory(self.time_streaming_metrics, num_members,
+                                  num_years)
+
+    track_streaming_metrics_peak_memory.unit = 'bytes'
+
+
+# simulation of a small catchment of in-memory arrays, i.e., what a headless
+# (or worker) process does, which must not import the heavy dependencies that
+# are only needed for plotting, reading raster files or some analyses
+HEADLESS_SIMULATION = """
+import numpy as np
+import xarray as xr
+
+import pystream as pst
+
+rng = np.random.RandomState(0)
+ys, xs = np.mgrid[0:20, 0:25]
+dims = ('time', 'y', 'x')
+ms = pst.MonthlySimulation(
+    100 + 2 * ys + np.abs(xs - 12) + rng.rand(20, 25),
+    rng.uniform(.5, 1, (20, 25)), rng.uniform(0, 100, (20, 25)),
+    xr.Dataset({'prec': (dims, rng.uniform(0, 150, (24, 20, 25)))}),
+    xr.Dataset({'temp': (dims, rng.normal(10, 5, (24, 20, 25)))}),
+    res=(100, 100))
+ms.simulate()
+"""
+HEAVY_MODULES = ['matplotlib', 'rasterio', 'scipy.optimize', 'scipy.stats']
+
+
+class Import:
+    # start-up time of a fresh interpreter (`timeraw_*`), e.g., of each
+    # worker process of `calibrate` or `sensitivity_analysis`
+    timeout = 120
+
+    def timeraw_import(self):
+        return "import pystream"
+
+    def timeraw_headless_simulation(self):
+        return HEADLESS_SIMULATION
+
+    def track_heavy_imports(self):
+        # number of `HEAVY_MODULES` imported by a headless simulation, which
+        # should stay at zero
+        output = subprocess.run(
+            [
+                sys.executable, '-c', HEADLESS_SIMULATION +
+                f"import sys; print(sum(module in sys.modules for module in "
+                f"{HEAVY_MODULES}))"
+            ], check=True, capture_output=True, text=True).stdout
+        return int(output)
+
+    track_heavy_imports.unit = 'modules'
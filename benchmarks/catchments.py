@@ -0,0 +1,149 @@
+import hashlib
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import rasterio
+import richdem
+import xarray as xr
+
+import pystream as pst
+
+__all__ = [
+    'CLIMATE_CELL_SIZE', 'RES', 'synthetic_climate', 'synthetic_inputs',
+    'synthetic_simulation', 'synthetic_terrain'
+]
+
+# Synthetic catchments for the benchmarks, i.e., square grids of `size` x
+# `size` pixels of `RES` meters with a fractal DEM whose depressions are
+# filled so that it drains towards the middle of its bottom edge, cropf and
+# whc rasters that depend on the elevation and `num_years` of monthly forcing
+# on a climatological grid of cells of `CLIMATE_CELL_SIZE` x
+# `CLIMATE_CELL_SIZE` pixels, which is regridded on the fly (like most gridded
+# climatological products, which are much coarser than the DEMs). The
+# generated arrays are cached as '.npy' files in the
+# `PYSTREAM_BENCHMARK_CACHE` directory (by default, in the temporary
+# directory), since each benchmark runs in a new process
+RES = 100
+CLIMATE_CELL_SIZE = 25
+
+
+def _cached(name, generate, *key):
+    # loads the arrays returned by `generate()` from the cache (as memory
+    # maps), generating and caching them the first time
+    cache_root = os.environ.get(
+        'PYSTREAM_BENCHMARK_CACHE',
+        os.path.join(tempfile.gettempdir(), 'pystream-benchmarks'))
+    cache_dir = os.path.join(
+        cache_root,
+        name + '-' + hashlib.sha256(repr(key).encode()).hexdigest()[:16])
+    if not os.path.exists(cache_dir):
+        arrays = generate()
+        os.makedirs(cache_root, exist_ok=True)
+        # write to a temporary directory first so that concurrent benchmarks
+        # never see a partially written cache
+        tmp_dir = tempfile.mkdtemp(dir=cache_root)
+        for i, arr in enumerate(arrays):
+            np.save(os.path.join(tmp_dir, f'{i}.npy'), arr)
+        try:
+            os.rename(tmp_dir, cache_dir)
+        except OSError:
+            shutil.rmtree(tmp_dir)
+    return [
+        np.load(os.path.join(cache_dir, f'{i}.npy'), mmap_mode='r')
+        for i in range(len(os.listdir(cache_dir)))
+    ]
+
+
+def _fractal_noise(shape, rng, beta=3):
+    # Gaussian random field with a power spectrum proportional to
+    # `1 / frequency**beta` (i.e., brown-like noise for `beta=3`), normalized
+    # to zero mean and unit variance
+    freq = np.hypot(*np.meshgrid(np.fft.fftfreq(shape[0]),
+                                 np.fft.rfftfreq(shape[1]), indexing='ij'))
+    freq[0, 0] = np.inf
+    spectrum = (rng.normal(size=freq.shape) +
+                1j * rng.normal(size=freq.shape)) * freq**(-beta / 2)
+    noise = np.fft.irfft2(spectrum, s=shape)
+    return (noise - noise.mean()) / noise.std()
+
+
+def synthetic_terrain(size, seed=0):
+    # (dem, cropf, whc) arrays of shape (size, size)
+    def generate():
+        rng = np.random.RandomState(seed)
+        ys, xs = np.mgrid[0:size, 0:size] / size
+        # a regional slope towards the outlet plus fractal relief of a few
+        # hundred meters, with the depressions filled (with a small gradient
+        # over the flats) so that every pixel drains to the edges
+        dem = 1500 * np.hypot(1 - ys, xs - .5) + 200 * _fractal_noise(
+            (size, size), rng)
+        dem = richdem.rdarray(dem, no_data=-9999)
+        # (only to avoid richdem's warning about the missing geotransform)
+        dem.geotransform = list(
+            rasterio.transform.from_origin(0, size * RES, RES,
+                                           RES).to_gdal())
+        richdem.FillDepressions(dem, epsilon=True, in_place=True)
+        dem = np.asarray(dem)
+        elev = (dem - dem.min()) / np.ptp(dem)
+        # more crops in the lowlands and more soil water holding capacity in
+        # the valleys (with some noise on both)
+        cropf = np.clip(
+            1 - elev + .1 * _fractal_noise((size, size), rng, beta=2), 0, 1)
+        whc = np.clip(
+            200 * (1 - elev) + 20 * _fractal_noise(
+                (size, size), rng, beta=2), 0, None)
+        return dem, cropf, whc
+
+    return _cached('terrain', generate, size, seed)
+
+
+def _climate_coords(size):
+    # cell centers (in the CRS of the rasters, see `synthetic_simulation`) of
+    # the climatological grid that covers the rasters
+    num_cells = -(-size // CLIMATE_CELL_SIZE)
+    centers = (np.arange(num_cells) + .5) * CLIMATE_CELL_SIZE * RES
+    return centers[::-1], centers
+
+
+def synthetic_climate(size, num_years, seed=0):
+    # (prec_ds, temp_ds) datasets with (time, lat, lon) variables of
+    # `num_years` of monthly precipitation (mm) and temperature (C)
+    lat, lon = _climate_coords(size)
+
+    def generate():
+        rng = np.random.RandomState(seed)
+        shape = (lat.size, lon.size)
+        # orographic effects, i.e., wetter and colder towards the top edge
+        relief = np.linspace(1, 0, lat.size)[:, np.newaxis] + \
+            .2 * _fractal_noise(shape, rng, beta=2)
+        months = np.arange(num_years * 12)
+        seasonal = np.cos(2 * np.pi * months /
+                          12)[:, np.newaxis, np.newaxis]
+        prec = rng.gamma(2, 40 * (1 + relief),
+                         (months.size, ) + shape) * (1 + .3 * seasonal)
+        temp = 12 - 10 * seasonal - 8 * relief + rng.normal(
+            0, 2, (months.size, ) + shape)
+        return prec, temp
+
+    prec, temp = _cached('climate', generate, size, num_years, seed)
+    dims = ('time', 'lat', 'lon')
+    coords = {'time': np.arange(num_years * 12), 'lat': lat, 'lon': lon}
+    return (xr.Dataset({'prec': (dims, prec)}, coords=coords),
+            xr.Dataset({'temp': (dims, temp)}, coords=coords))
+
+
+def synthetic_inputs(size, num_years, seed=0):
+    # positional and keyword arguments of `MonthlySimulation`
+    dem, cropf, whc = synthetic_terrain(size, seed=seed)
+    prec_ds, temp_ds = synthetic_climate(size, num_years, seed=seed)
+    return (dem, cropf, whc, prec_ds, temp_ds), dict(
+        res=(RES, RES), transform=rasterio.transform.from_origin(
+            0, size * RES, RES, RES), climate_regridding='bilinear')
+
+
+def synthetic_simulation(size, num_years, seed=0, **kwargs):
+    args, simulation_kws = synthetic_inputs(size, num_years, seed=seed)
+    simulation_kws.update(kwargs)
+    return pst.MonthlySimulation(*args, **simulation_kws)
@@ -1,5 +1,15 @@
 __version__ = '0.1.0'
 
+from .accumulators import *  # noqa
+from .batch import *  # noqa
+from .calibration import *  # noqa
+from .coarsening import *  # noqa
+from .metrics import *  # noqa
 from .monthly_simulation import *  # noqa
+from .outputs import *  # noqa
 from .plotting import *  # noqa
+from .profiling import *  # noqa
+from .regridding import *  # noqa
+from .routing import *  # noqa
+from .sensitivity import *  # noqa
 from .utils import *  # noqa
@@ -0,0 +1,230 @@
+import numpy as np
+
+from .outputs import OUTPUT_FIELDS
+
+__all__ = ['MeanVariance', 'MinMax', 'Exceedance', 'Quantiles']
+
+# Online accumulators, which compute per-pixel summary statistics of a field
+# (see `OUTPUT_FIELDS`) while the simulation runs, so that the monthly fields
+# never need to be stored. Each accumulator is started with the shape of the
+# simulated pixels, updated with the values of each month (in chronological
+# order) and returns a dict that maps the names of its statistics to arrays
+# of shape `prefix_shape + the shape of the simulated pixels`, where
+# `prefix_shape` is empty except for `Quantiles`
+
+
+class _Accumulator:
+    # dimensions (besides the spatial ones) of the statistics
+    dims = ()
+
+    def __init__(self, field):
+        if field not in OUTPUT_FIELDS:
+            raise ValueError(
+                f"Accumulated field {field} must be among {OUTPUT_FIELDS}")
+        self.field = field
+
+    def start(self, shape):
+        self.count = 0
+
+    def update(self, values):
+        self.count += 1
+
+    def coords(self):
+        return {}
+
+
+class MeanVariance(_Accumulator):
+    # running mean and variance with Welford's algorithm, where `ddof` is the
+    # delta degrees of freedom of the variance
+    def __init__(self, field, ddof=0):
+        super().__init__(field)
+        self.ddof = ddof
+
+    def start(self, shape):
+        super().start(shape)
+        self._mean = np.zeros(shape)
+        self._m2 = np.zeros(shape)
+        self._delta = np.empty(shape)
+        self._tmp = np.empty(shape)
+
+    def update(self, values):
+        super().update(values)
+        # ACHTUNG: all the operations are in place so that nothing is
+        # allocated at each step
+        np.subtract(values, self._mean, out=self._delta)
+        self._mean += np.divide(self._delta, self.count, out=self._tmp)
+        self._delta *= np.subtract(values, self._mean, out=self._tmp)
+        self._m2 += self._delta
+
+    def result(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            variance = self._m2 / (self.count - self.ddof)
+        return {
+            f'{self.field}_mean': self._mean.copy(),
+            f'{self.field}_variance': variance
+        }
+
+
+class MinMax(_Accumulator):
+    def start(self, shape):
+        super().start(shape)
+        self._min = np.full(shape, np.inf)
+        self._max = np.full(shape, -np.inf)
+
+    def update(self, values):
+        super().update(values)
+        np.fmin(self._min, values, out=self._min)
+        np.fmax(self._max, values, out=self._max)
+
+    def result(self):
+        return {
+            f'{self.field}_min': self._min.copy(),
+            f'{self.field}_max': self._max.copy()
+        }
+
+
+class Exceedance(_Accumulator):
+    # number of months in which the field exceeds `threshold`, e.g.,
+    # `Exceedance('snow_accum', 0)` counts the months with snow cover
+    def __init__(self, field, threshold):
+        super().__init__(field)
+        self.threshold = threshold
+
+    def start(self, shape):
+        super().start(shape)
+        self._counts = np.zeros(shape, dtype=np.int64)
+        self._exceeds = np.empty(shape, dtype=bool)
+
+    def update(self, values):
+        super().update(values)
+        np.greater(values, self.threshold, out=self._exceeds)
+        self._counts += self._exceeds
+
+    def result(self):
+        return {f'{self.field}_exceedance': self._counts.copy()}
+
+
+class Quantiles(_Accumulator):
+    # Approximate quantiles with the P-square algorithm (Jain and Chlamtac,
+    # 1985), which keeps five markers per pixel and quantile (i.e., constant
+    # memory regardless of the length of the record). The markers of all the
+    # pixels and quantiles are updated at once
+    dims = ('quantile', )
+
+    def __init__(self, field, quantiles=(.05, .5, .95)):
+        super().__init__(field)
+        self.quantiles = np.asarray(quantiles, dtype=np.double)
+        if self.quantiles.ndim != 1 or np.any((self.quantiles <= 0) |
+                                              (self.quantiles >= 1)):
+            raise ValueError(
+                "Quantiles must be a sequence of values between 0 and 1")
+
+    def start(self, shape):
+        super().start(shape)
+        # add axes so that the quantiles are broadcast to the pixels
+        p = self.quantiles.reshape((-1, ) + (1, ) * len(shape))
+        # marker heights and (actual) positions, with shape (5, quantiles) +
+        # shape, and desired positions and their increments, with shape
+        # (5, quantiles) + (1, ) * len(shape)
+        markers_shape = (5, len(self.quantiles)) + tuple(shape)
+        self._heights = np.zeros(markers_shape)
+        self._positions = np.broadcast_to(
+            np.arange(1, 6, dtype=np.double).reshape(
+                (5, ) + (1, ) * (len(markers_shape) - 1)),
+            markers_shape).copy()
+        self._desired_positions = np.stack(
+            [np.ones_like(p), 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5 + 0 * p])
+        self._desired_increments = np.stack(
+            [np.zeros_like(p), p / 2, p, (1 + p) / 2, 1 + 0 * p])
+
+    def update(self, values):
+        super().update(values)
+        values = np.broadcast_to(values, self._heights.shape[1:])
+        heights, positions = self._heights, self._positions
+        if self.count <= 5:
+            # the first five values are the initial markers (sorted once the
+            # five of them are available)
+            heights[self.count - 1] = values
+            if self.count == 5:
+                heights.sort(axis=0)
+            return
+
+        # find the cell of the value, extending the extreme markers if needed
+        np.minimum(heights[0], values, out=heights[0])
+        np.maximum(heights[4], values, out=heights[4])
+        cell = np.sum(values >= heights[1:4], axis=0)
+        positions[1:] += np.arange(1, 5).reshape(
+            (4, ) + (1, ) * values.ndim) > cell
+        self._desired_positions += self._desired_increments
+
+        # adjust the three middle markers
+        for i in range(1, 4):
+            d = self._desired_positions[i] - positions[i]
+            adjust = ((d >= 1) & (positions[i + 1] - positions[i] > 1)) | (
+                (d <= -1) & (positions[i - 1] - positions[i] < -1))
+            if not np.any(adjust):
+                continue
+            d = np.where(adjust, np.sign(d), 0)
+            # piecewise-parabolic prediction
+            with np.errstate(divide='ignore', invalid='ignore'):
+                parabolic = heights[i] + d / (
+                    positions[i + 1] - positions[i - 1]) * (
+                        (positions[i] - positions[i - 1] + d) *
+                        (heights[i + 1] - heights[i]) /
+                        (positions[i + 1] - positions[i]) +
+                        (positions[i + 1] - positions[i] - d) *
+                        (heights[i] - heights[i - 1]) /
+                        (positions[i] - positions[i - 1]))
+            # linear prediction, where the parabolic one is not monotonic
+            neighbour = np.where(d > 0, i + 1, i - 1)
+            neighbour_heights = np.take_along_axis(heights, neighbour[None],
+                                                   axis=0)[0]
+            neighbour_positions = np.take_along_axis(positions,
+                                                     neighbour[None],
+                                                     axis=0)[0]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                linear = heights[i] + d * (neighbour_heights - heights[i]) / (
+                    neighbour_positions - positions[i])
+            heights[i] = np.where(
+                adjust,
+                np.where((heights[i - 1] < parabolic) &
+                         (parabolic < heights[i + 1]), parabolic, linear),
+                heights[i])
+            positions[i] += d
+
+    def result(self):
+        if self.count >= 5:
+            quantiles = self._heights[2].copy()
+        else:
+            # exact quantiles of the values seen so far
+            quantiles = np.stack([
+                np.quantile(self._heights[:self.count, j], q, axis=0)
+                for j, q in enumerate(self.quantiles)
+            ])
+        return {f'{self.field}_quantile': quantiles}
+
+    def coords(self):
+        return {'quantile': self.quantiles}
+
+
+class _AccumulatorRecorder:
+    # passes the fields of each simulation step to the accumulators (with the
+    # same interface as `outputs.StepWriter`)
+    def __init__(self, accumulators, shape):
+        self.accumulators = list(accumulators)
+        for accumulator in self.accumulators:
+            if not isinstance(accumulator, _Accumulator):
+                raise ValueError(
+                    f"Accumulators must be among {__all__} instances")
+            accumulator.start(shape)
+        self.fields = list(
+            dict.fromkeys(accumulator.field
+                          for accumulator in self.accumulators))
+
+    def write(self, field, i, values):
+        for accumulator in self.accumulators:
+            if accumulator.field == field:
+                accumulator.update(values)
+
+    def close(self):
+        pass
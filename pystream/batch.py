@@ -0,0 +1,179 @@
+import multiprocessing as mp
+import time
+import traceback
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from .monthly_simulation import MonthlySimulation
+
+__all__ = ['simulate_catchments']
+
+# keys of each entry of the manifest that are not passed to the constructor
+_MANIFEST_KEYS = ['catchment', 'dem', 'cropf', 'whc', 'climate_window', 'size']
+
+
+def _get_window(window):
+    if window is None:
+        return window
+    # rasterio is only imported when needed (see
+    # `MonthlySimulation._read_raster`)
+    from rasterio import windows
+    if isinstance(window, windows.Window):
+        return window
+    return windows.Window.from_slices(*window)
+
+
+def _get_catchment_size(entry):
+    # number of pixels of a catchment, which is used to schedule the largest
+    # catchments first (unless the manifest provides its own 'size')
+    if entry.get('size') is not None:
+        return entry['size']
+    window = _get_window(entry.get('window'))
+    if window is not None:
+        return int(window.height * window.width)
+    if isinstance(entry['dem'], str):
+        import rasterio
+        with rasterio.open(entry['dem']) as src:
+            return src.height * src.width
+    return int(np.prod(np.shape(entry['dem'])))
+
+
+def _simulate_catchment(task):
+    # runs in the worker processes, so that errors are reported instead of
+    # raised
+    entry, prec, temp, prec_varname, temp_varname, decode_times, \
+        simulation_kws = task
+    start_time = time.perf_counter()
+    datasets = []
+    try:
+        # only the window of the catchment is read from the shared datasets
+        climate_window = _get_window(entry.get('climate_window'))
+        for climate, varname in [(prec, prec_varname),
+                                 (temp, temp_varname)]:
+            datasets.append(
+                MonthlySimulation._prepare_ds(climate, varname, decode_times,
+                                              climate_window))
+        (prec_ds, prec_varname), (temp_ds, temp_varname) = datasets
+        kwargs = dict(simulation_kws)
+        kwargs.update({
+            key: value
+            for key, value in entry.items() if key not in _MANIFEST_KEYS
+        })
+        ms = MonthlySimulation(entry['dem'], entry['cropf'], entry['whc'],
+                               prec_ds, temp_ds, prec_varname=prec_varname,
+                               temp_varname=temp_varname, **kwargs)
+        gauge_flow = ms.simulate()
+        if gauge_flow.ndim > 1:
+            if gauge_flow.shape[1] != 1:
+                raise ValueError("Each catchment must have a single gauge")
+            gauge_flow = gauge_flow[:, 0]
+        error = ''
+    except Exception:
+        gauge_flow = None
+        error = traceback.format_exc()
+    finally:
+        for ds, _ in datasets:
+            ds.close()
+
+    return entry['catchment'], gauge_flow, time.perf_counter() - start_time, \
+        error
+
+
+def simulate_catchments(manifest, prec, temp, prec_varname=None,
+                        temp_varname=None, decode_times=False, processes=None,
+                        **simulation_kws):
+    # Simulates many independent catchments in a pool of `processes` worker
+    # processes. The `manifest` is a list of dicts (or a pandas data frame
+    # with one row per catchment) with the 'catchment' identifier, its
+    # 'dem', 'cropf' and 'whc' (file paths or arrays) and optionally the
+    # 'climate_window' of the catchment in the shared climatological datasets
+    # `prec` and `temp` (see the `window` argument of `MonthlySimulation`),
+    # which should be file paths so that each worker only reads its window
+    # from disk. Any other key of an entry (e.g., 'gauges' or 'window'), as
+    # well as `simulation_kws` (for all the catchments), is passed to the
+    # `MonthlySimulation` constructor. ACHTUNG: a 'window' (or a 'mask')
+    # restricts both the rasters and the climatological datasets, so it
+    # cannot be combined with a 'climate_window', which is meant for rasters
+    # that are already cropped to the catchment.
+    #
+    # The catchments are scheduled from the largest to the smallest (by
+    # number of pixels, or by the 'size' of the entry if provided), so that
+    # the largest ones do not end up running alone at the end of the batch.
+    #
+    # Returns a dataset with the gauge flow of each catchment and month (NaN
+    # for the catchments that failed), the time spent on each catchment (in
+    # seconds) and the traceback of the catchments that failed (an empty
+    # string otherwise)
+    if isinstance(manifest, pd.DataFrame):
+        # drop the missing values of the columns that only some catchments
+        # have (e.g., 'gauges')
+        manifest = [{
+            key: value
+            for key, value in entry.items()
+            if not (np.isscalar(value) and pd.isna(value))
+        } for entry in manifest.to_dict('records')]
+    manifest = [dict(entry) for entry in manifest]
+    for entry in manifest:
+        for key in ['catchment', 'dem', 'cropf', 'whc']:
+            if key not in entry:
+                raise ValueError(
+                    f"Each entry of the manifest must have a '{key}'")
+        if entry.get('climate_window') is not None:
+            for key in ['window', 'mask']:
+                if entry.get(key) is not None:
+                    raise ValueError(
+                        f"The entry of catchment {entry['catchment']} "
+                        f"cannot have both a 'climate_window' and a "
+                        f"'{key}', since the '{key}' also applies to the "
+                        "climatological datasets")
+    catchments = [entry['catchment'] for entry in manifest]
+    if len(set(catchments)) != len(catchments):
+        raise ValueError("The catchment identifiers must be unique")
+    if processes is None:
+        processes = mp.cpu_count()
+
+    # the time coordinate is taken from the precipitation dataset
+    prec_ds, prec_varname = MonthlySimulation._prepare_ds(
+        prec, prec_varname, decode_times)
+    time_coord = prec_ds['time'].values
+    if isinstance(prec, str):
+        prec_ds.close()
+
+    sizes = [_get_catchment_size(entry) for entry in manifest]
+    tasks = [(manifest[i], prec, temp, prec_varname, temp_varname,
+              decode_times, simulation_kws)
+             for i in np.argsort(sizes, kind='stable')[::-1]]
+
+    # ACHTUNG: like in `calibrate`, the worker processes are spawned with the
+    # 'numba' engine
+    if simulation_kws.get('engine') == 'numba':
+        context = mp.get_context('spawn')
+    else:
+        context = mp.get_context()
+    results = {}
+    with context.Pool(processes) as pool:
+        for catchment, gauge_flow, elapsed_time, error in \
+                pool.imap_unordered(_simulate_catchment, tasks):
+            results[catchment] = gauge_flow, elapsed_time, error
+
+    gauge_flow = np.full((len(catchments), len(time_coord)), np.nan)
+    elapsed_time = np.empty(len(catchments))
+    errors = []
+    for i, catchment in enumerate(catchments):
+        catchment_gauge_flow, elapsed_time[i], error = results[catchment]
+        if catchment_gauge_flow is not None:
+            gauge_flow[i] = catchment_gauge_flow
+        errors.append(error)
+
+    return xr.Dataset(
+        {
+            'gauge_flow': (('catchment', 'time'), gauge_flow),
+            'elapsed_time': ('catchment', elapsed_time),
+            'error': ('catchment', np.array(errors, dtype=object))
+        },
+        coords={
+            'catchment': catchments,
+            'time': time_coord
+        })
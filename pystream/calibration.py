@@ -0,0 +1,249 @@
+import contextlib
+import multiprocessing as mp
+
+import numpy as np
+import pandas as pd
+import richdem
+import xarray as xr
+
+from . import metrics, routing
+from .monthly_simulation import MonthlySimulation
+
+__all__ = ['calibrate']
+
+# global variables of the worker processes, set by `_init_worker`
+_worker = {}
+
+
+def _share_array(arr):
+    # copies `arr` into a new shared memory block and returns the block
+    # together with what is needed to attach to it from another process
+    from multiprocessing import shared_memory
+
+    arr = np.ascontiguousarray(arr)
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+    return shm, (shm.name, arr.shape, arr.dtype.str)
+
+
+def _attach_array(name, shape, dtype):
+    # ACHTUNG: the worker processes share the resource tracker of the parent
+    # process, which owns the shared memory blocks and unlinks them
+    from multiprocessing import shared_memory
+
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _init_worker(shared_specs, nodata, climate_coords, simulation_kws,
+                 parameter_names, obs_gauge_flow, num_warmup_months,
+                 metric='nash_sutcliffe'):
+    # attach to the terrain and climatological arrays (without copying them)
+    # and build the simulation that will be used for all the evaluations of
+    # this worker. The shared memory blocks must be kept referenced so that
+    # they are not closed while the arrays are in use
+    shms, arrs = {}, {}
+    for key, spec in shared_specs.items():
+        shms[key], arrs[key] = _attach_array(*spec)
+
+    # the routing and the yearly heat index of the simulation are shared too,
+    # so that the workers do not recompute them
+    flow_routing = routing.D8Routing.from_arrays(
+        **{name: arrs[f'routing_{name}']
+           for name in routing.D8Routing.ARRAYS})
+    dims = ('time', 'y', 'x')
+    simulation = MonthlySimulation(
+        richdem.rdarray(arrs['dem'], no_data=nodata),
+        arrs['cropf'], arrs['whc'],
+        xr.Dataset({'prec': (dims, arrs['prec'])}, coords=climate_coords),
+        xr.Dataset({'temp': (dims, arrs['temp'])}, coords=climate_coords),
+        flow_routing=flow_routing, **simulation_kws)
+    simulation._yearly_heat_index = arrs['yearly_heat_index']
+
+    _worker.update(shms=shms, simulation=simulation,
+                   parameter_names=parameter_names,
+                   obs_gauge_flow=obs_gauge_flow,
+                   num_warmup_months=num_warmup_months, metric=metric)
+
+
+def _score_members(sim_gauge_flow, obs_gauge_flow, metric):
+    # `metric` (see `metrics.METRICS`) of each member of an ensemble, i.e.,
+    # the first axis of `sim_gauge_flow`, or its mean gauge flow if
+    # `obs_gauge_flow` is None. If there are many gauges, the score of a
+    # member is the mean of the scores at each gauge
+    if obs_gauge_flow is None:
+        score = sim_gauge_flow.mean(axis=1)
+    else:
+        score = metrics.compute_metrics(sim_gauge_flow, obs_gauge_flow,
+                                        metrics=[metric])[metric]
+    return score.reshape(len(sim_gauge_flow), -1).mean(axis=1)
+
+
+def _evaluate_members(parameter_sets):
+    # score (see `_score_members`) of each parameter set, all of them
+    # simulated at once as an ensemble
+    sim_gauge_flow = _worker['simulation'].simulate_ensemble(
+        parameter_sets, parameter_names=_worker['parameter_names'])
+    num_warmup_months = _worker['num_warmup_months']
+    obs_gauge_flow = _worker['obs_gauge_flow']
+    if obs_gauge_flow is not None:
+        obs_gauge_flow = obs_gauge_flow[num_warmup_months:]
+    return _score_members(sim_gauge_flow[:, num_warmup_months:],
+                          obs_gauge_flow, _worker['metric'])
+
+
+@contextlib.contextmanager
+def _worker_pool(simulation, parameter_names, obs_gauge_flow,
+                 num_warmup_months, processes, metric='nash_sutcliffe'):
+    # pool of `processes` worker processes that score parameter sets with
+    # `_evaluate_members`, which attach to the terrain, climatological data,
+    # routing and yearly heat index of `simulation` in shared memory without
+    # copying nor recomputing them
+
+    # everything that the workers need to rebuild the simulation
+    simulation_kws = dict(res=simulation.res,
+                          init_parameters=simulation.parameters,
+                          engine=simulation.engine,
+                          transform=simulation.transform,
+                          climate_regridding=simulation.climate_regridding)
+    if hasattr(simulation, 'monthly_daylight_hours'):
+        simulation_kws['monthly_daylight_hours'] = \
+            simulation.monthly_daylight_hours
+    if simulation.gauges is not None:
+        simulation_kws['gauges'] = np.transpose(
+            np.unravel_index(simulation.gauges, simulation.dem.shape))
+    # the coordinates of the climatological grid are only needed to regrid it
+    climate_coords = None
+    if simulation.climate_regridding is not None:
+        prec_da = simulation.prec_ds[simulation.prec_varname]
+        climate_coords = {
+            dim: prec_da[prec_dim].values
+            for dim, prec_dim in zip(
+                ['y', 'x'], [dim for dim in prec_da.dims if dim != 'time'])
+        }
+
+    # SHARED MEMORY
+    shms, shared_specs = {}, {}
+    try:
+        for key, arr in [
+            ('dem', np.asarray(simulation.dem, dtype=np.double)),
+            ('cropf', simulation.cropf), ('whc', simulation.whc),
+            ('prec', simulation.prec_ds[simulation.prec_varname].values),
+            ('temp', simulation.temp_ds[simulation.temp_varname].values),
+            ('yearly_heat_index', simulation._get_yearly_heat_index())
+        ] + [(f'routing_{name}', getattr(simulation.routing, name))
+             for name in routing.D8Routing.ARRAYS]:
+            shms[key], shared_specs[key] = _share_array(arr)
+
+        # ACHTUNG: numba's threading layers are not always safe to use in a
+        # forked process (e.g., GNU OpenMP), so with the 'numba' engine the
+        # worker processes are spawned
+        if simulation.engine == 'numba':
+            context = mp.get_context('spawn')
+        else:
+            context = mp.get_context()
+        with context.Pool(processes, initializer=_init_worker,
+                          initargs=(shared_specs, simulation.dem.no_data,
+                                    climate_coords, simulation_kws,
+                                    parameter_names, obs_gauge_flow,
+                                    num_warmup_months, metric)) as pool:
+            yield pool
+    finally:
+        for shm in shms.values():
+            shm.close()
+            shm.unlink()
+
+
+def _latin_hypercube(num_samples, num_dims, random_state):
+    # one sample in each of the `num_samples` equally-sized strata of each
+    # dimension, with the strata randomly paired across dimensions
+    strata = np.argsort(random_state.rand(num_samples, num_dims), axis=0)
+    return (strata + random_state.rand(num_samples, num_dims)) / num_samples
+
+
+def calibrate(simulation, obs_gauge_flow, parameter_bounds, method='lhs',
+              num_samples=100, maxiter=100, popsize=15, num_warmup_months=6,
+              processes=None, batch_size=None, seed=None):
+    # Searches the parameters of `simulation` (a `MonthlySimulation`
+    # instance) that maximize the Nash-Sutcliffe efficiency of the simulated
+    # gauge flow with respect to `obs_gauge_flow` (of shape (num_months, ) or
+    # (num_months, num_gauges) in gauge mode). `parameter_bounds` maps the
+    # name of each calibrated parameter to its (min, max) bounds, and the rest
+    # of parameters take the values of `simulation`. The search `method` can
+    # be 'random' or 'lhs' (Latin hypercube), which evaluate `num_samples`
+    # parameter sets, or 'differential_evolution' (see
+    # `scipy.optimize.differential_evolution` for `maxiter` and `popsize`).
+    #
+    # The evaluations are distributed across a pool of `processes` worker
+    # processes, which attach to the terrain and climatological arrays of
+    # `simulation` in shared memory without copying nor re-reading them. Each
+    # worker simulates batches of (at most) `batch_size` parameter sets at
+    # once as an ensemble (by default, 64, since the memory of an ensemble
+    # grows with its members), and the parameter sets are split into at least
+    # one batch per worker.
+    #
+    # Returns a dict with the best parameters and a pandas data frame with
+    # the history of all the evaluated parameter sets and their
+    # Nash-Sutcliffe efficiency
+    if method not in ['random', 'lhs', 'differential_evolution']:
+        raise ValueError(
+            "Method must be 'random', 'lhs' or 'differential_evolution'")
+    parameter_names = list(parameter_bounds)
+    for parameter in parameter_names:
+        if parameter not in MonthlySimulation.PARAMETER_NAMES:
+            raise ValueError(f"Parameter {parameter} must be among "
+                             f"{MonthlySimulation.PARAMETER_NAMES}")
+    bounds = np.array([parameter_bounds[parameter]
+                       for parameter in parameter_names],
+                      dtype=np.double)  # yapf: disable
+    obs_gauge_flow = np.asarray(obs_gauge_flow, dtype=np.double)
+    if processes is None:
+        processes = mp.cpu_count()
+    if batch_size is None:
+        batch_size = 64
+
+    history = []
+    with _worker_pool(simulation, parameter_names, obs_gauge_flow,
+                      num_warmup_months, processes) as pool:
+
+        def evaluate(parameter_sets):
+            parameter_sets = np.atleast_2d(parameter_sets)
+            num_batches = min(
+                max(int(np.ceil(len(parameter_sets) / batch_size)),
+                    processes), len(parameter_sets))
+            nash_sutcliffe = np.concatenate(
+                pool.map(_evaluate_members,
+                         np.array_split(parameter_sets, num_batches)))
+            history.append(
+                np.column_stack([parameter_sets, nash_sutcliffe]))
+            return nash_sutcliffe
+
+        random_state = np.random.RandomState(seed)
+        if method == 'differential_evolution':
+            # scipy only needs a map-like callable to evaluate the whole
+            # population at once, so instead of mapping its (pickled)
+            # objective function, we evaluate the population in batches
+            # of ensemble members (ACHTUNG: `scipy.optimize` is slow to
+            # import, so it is only imported when needed)
+            from scipy import optimize
+            optimize.differential_evolution(
+                lambda x: -evaluate(x)[0], bounds, maxiter=maxiter,
+                popsize=popsize, seed=random_state, polish=False,
+                updating='deferred',
+                workers=lambda _, population: -evaluate(list(population)))
+        else:
+            if method == 'random':
+                samples = random_state.rand(num_samples, len(bounds))
+            else:
+                samples = _latin_hypercube(num_samples, len(bounds),
+                                           random_state)
+            evaluate(bounds[:, 0] + samples *
+                     (bounds[:, 1] - bounds[:, 0]))
+
+    history = pd.DataFrame(np.concatenate(history),
+                           columns=parameter_names + ['nash_sutcliffe'])
+    best_parameters = simulation.parameters
+    best_parameters.update(history.loc[history['nash_sutcliffe'].idxmax(),
+                                       parameter_names].to_dict())
+
+    return best_parameters, history
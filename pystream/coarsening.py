@@ -0,0 +1,209 @@
+import time
+
+import numpy as np
+import richdem
+import xarray as xr
+from scipy import sparse
+
+from . import metrics, routing
+from .monthly_simulation import MonthlySimulation
+
+__all__ = ['coarsen_simulation', 'proxy_match']
+
+
+def _break_cycles(receivers):
+    # Sets to -1 (i.e., does not drain) the receiver of at least one pixel of
+    # each cycle. Pointer jumping: after `ceil(log2(n))` doublings, the
+    # pixels whose path does not end draining out end at a pixel of a cycle
+    receivers = receivers.copy()
+    jumps = receivers.copy()
+    for _ in range(int(np.ceil(np.log2(max(receivers.size, 2))))):
+        jumps = np.where(jumps >= 0, jumps[jumps], -1)
+    receivers[np.unique(jumps[jumps >= 0])] = -1
+    return receivers
+
+
+def coarsen_simulation(simulation, factor):
+    # Coarse-resolution proxy of `simulation` (a `MonthlySimulation`
+    # instance), e.g., to screen parameters about `factor**2` times faster.
+    # Each block of `factor` x `factor` pixels becomes a pixel of the proxy,
+    # which is simulated if at least half of the block is simulated by
+    # `simulation` (or if it has a gauge), with the mean terrain and
+    # climatological data of the simulated pixels of the block. The flow
+    # directions of the proxy are not derived from its (mean) DEM but
+    # upscaled from the routing of `simulation` (like the COTAT method): the
+    # receiver of a block is the block into which the flow path from its
+    # pixel with the largest drainage area exits, so that the proxy keeps the
+    # drainage network and the catchment of each gauge. The
+    # `drainage_area_ratio` attribute of the proxy is the ratio between the
+    # drainage area of each gauge (or of the outlet of the largest basin if
+    # there are no gauges) in the proxy and in `simulation`. ACHTUNG: without
+    # gauges, the blocks that mix many small basins (e.g., local pits) drain
+    # into a single one, so that the proxy of a catchment is much closer
+    # with gauges (or 'outlet')
+    factor = int(factor)
+    if factor < 1:
+        raise ValueError("The coarsening factor must be a positive integer")
+    height, width = simulation.dem.shape
+    coarse_shape = (-(-height // factor), -(-width // factor))
+    num_coarse = coarse_shape[0] * coarse_shape[1]
+    # block of each pixel and number of pixels of each block
+    rows, cols = np.divmod(np.arange(height * width), width)
+    blocks = (rows // factor) * coarse_shape[1] + cols // factor
+    block_sizes = np.bincount(blocks, minlength=num_coarse)
+
+    # SIMULATED BLOCKS
+    if simulation._pixels is None:
+        pixels = np.arange(height * width)
+    else:
+        pixels = simulation._pixels
+    pixel_blocks = blocks[pixels]
+    counts = np.bincount(pixel_blocks, minlength=num_coarse)
+    valid = 2 * counts >= block_sizes
+    if simulation.gauges is not None:
+        gauge_blocks = blocks[simulation.gauges]
+        valid[gauge_blocks] = True
+    valid &= counts > 0
+    coarse_pixels = np.flatnonzero(valid)
+
+    # sparse matrix that averages the values of the simulated pixels (see
+    # `MonthlySimulation._to_domain`) over the simulated blocks
+    keep = valid[pixel_blocks]
+    aggregation = sparse.csr_matrix(
+        (1 / counts[pixel_blocks[keep]],
+         (np.searchsorted(coarse_pixels,
+                          pixel_blocks[keep]), np.flatnonzero(keep))),
+        shape=(coarse_pixels.size, pixels.size))
+
+    def to_coarse_raster(values, fill_value=np.nan):
+        # stack of domain values (last axis) to a stack of proxy rasters
+        values = np.asarray(values, dtype=np.double)
+        values = values.reshape(values.shape[:values.ndim -
+                                             simulation._cropf.ndim] + (-1, ))
+        raster = np.full(values.shape[:-1] + (num_coarse, ), fill_value)
+        raster[..., coarse_pixels] = aggregation.dot(values.T).T
+        return raster.reshape(values.shape[:-1] + coarse_shape)
+
+    # TERRAIN
+    nodata = simulation.dem.no_data
+    coarse_dem = richdem.rdarray(to_coarse_raster(
+        simulation._to_domain(np.asarray(simulation.dem)), fill_value=nodata),
+                                 no_data=nodata)
+    coarse_cropf = to_coarse_raster(simulation._cropf)
+    coarse_whc = to_coarse_raster(simulation._whc)
+
+    # CLIMATOLOGICAL DATA (including the appended months, if any), which is
+    # aggregated month by month so that the fine-resolution record is never
+    # held in memory
+    coarse_prec, coarse_temp = [
+        np.empty((simulation.num_months, ) + coarse_shape) for _ in range(2)
+    ]
+    for i in range(simulation.num_months):
+        prec_i, temp_i = simulation._get_climate(i, buffer_names=(None, None))
+        coarse_prec[i] = to_coarse_raster(prec_i)
+        coarse_temp[i] = to_coarse_raster(temp_i)
+    dims = ('time', 'y', 'x')
+    if simulation.num_months == simulation._num_record_months:
+        coords = {'time': simulation.prec_ds['time'].values}
+    else:
+        coords = {}
+    coarse_prec_ds = xr.Dataset({'prec': (dims, coarse_prec)}, coords=coords)
+    coarse_temp_ds = xr.Dataset({'temp': (dims, coarse_temp)}, coords=coords)
+
+    # ROUTING
+    # pixel of each simulated block with the largest drainage area
+    accum = simulation.routing.accumulate(np.ones(height * width)).ravel()
+    order = np.lexsort((accum[pixels[keep]], pixel_blocks[keep]))
+    sorted_blocks = pixel_blocks[keep][order]
+    last = np.r_[sorted_blocks[1:] != sorted_blocks[:-1], True]
+    current = pixels[keep][order][last]
+    # follow the flow path from these pixels until it exits the block
+    current_blocks = sorted_blocks[last]
+    coarse_receivers = np.full(num_coarse, -1, dtype=np.intp)
+    active = np.ones(current.size, dtype=bool)
+    for _ in range(factor * factor):
+        receivers = simulation.routing.receivers[current]
+        drains = active & (receivers >= 0)
+        exits = drains & (blocks[np.maximum(receivers, 0)] != current_blocks)
+        coarse_receivers[current_blocks[exits]] = blocks[receivers[exits]]
+        active = drains & ~exits
+        if not np.any(active):
+            break
+        current = np.where(active, receivers, current)
+    # blocks that are not simulated neither drain nor receive flow
+    coarse_receivers[~valid] = -1
+    coarse_receivers[(coarse_receivers >= 0)
+                     & ~valid[np.maximum(coarse_receivers, 0)]] = -1
+    flow_routing = routing.D8Routing.from_receivers(
+        _break_cycles(coarse_receivers), ~valid.reshape(coarse_shape))
+
+    # PROXY
+    kwargs = dict(res=(simulation.res[0] * factor,
+                       simulation.res[1] * factor),
+                  init_parameters=simulation.parameters,
+                  engine=simulation.engine, flow_routing=flow_routing)
+    if hasattr(simulation, 'monthly_daylight_hours'):
+        kwargs['monthly_daylight_hours'] = simulation.monthly_daylight_hours
+    if simulation.gauges is not None:
+        kwargs['gauges'] = np.transpose(
+            np.unravel_index(gauge_blocks, coarse_shape))
+    proxy = MonthlySimulation(coarse_dem, coarse_cropf, coarse_whc,
+                              coarse_prec_ds, coarse_temp_ds, **kwargs)
+
+    # DRAINAGE AREA (in pixels of `simulation`, since the blocks at the
+    # bottom and right edges might have less than `factor**2` pixels)
+    if simulation.gauges is None:
+        fine_outlets = [simulation.routing.outlet()]
+        coarse_outlets = [proxy.routing.outlet()]
+    else:
+        fine_outlets = simulation.gauges
+        coarse_outlets = proxy.gauges
+    proxy.drainage_area_ratio = np.array([
+        block_sizes[proxy.routing.upstream_pixels(coarse_outlet)].sum() /
+        simulation.routing.upstream_pixels(fine_outlet).size
+        for fine_outlet, coarse_outlet in zip(fine_outlets, coarse_outlets)
+    ])
+    proxy.coarsening_factor = factor
+
+    return proxy
+
+
+def proxy_match(simulation, proxy, parameters=None, num_warmup_months=6):
+    # How closely the gauge flow of a coarse-resolution `proxy` (see
+    # `coarsen_simulation`) matches the one of the full-resolution
+    # `simulation`, both simulated from zero state variables with
+    # `parameters` (by default, the ones of `simulation`). Returns a dict
+    # with the Nash-Sutcliffe efficiency of the proxy with respect to the
+    # full-resolution flow, their correlation and the relative bias of the
+    # proxy (excluding the `num_warmup_months`, and with one value per gauge
+    # in gauge mode), the ratio of their drainage areas and the speedup of
+    # the proxy
+    if parameters is None:
+        parameters = simulation.parameters
+    parameter_names = list(parameters)
+    parameter_values = [[parameters[name] for name in parameter_names]]
+
+    gauge_flows, elapsed_times = [], []
+    for ms in [simulation, proxy]:
+        start_time = time.perf_counter()
+        gauge_flows.append(
+            ms.simulate_ensemble(parameter_values,
+                                 parameter_names=parameter_names)[0]
+            [num_warmup_months:])
+        elapsed_times.append(time.perf_counter() - start_time)
+    gauge_flow, proxy_gauge_flow = gauge_flows
+
+    match = metrics.compute_metrics(
+        proxy_gauge_flow, gauge_flow,
+        metrics=['nash_sutcliffe', 'correlation', 'pbias'])
+    drainage_area_ratio = proxy.drainage_area_ratio
+    if simulation.gauges is None:
+        drainage_area_ratio = drainage_area_ratio[0]
+
+    return {
+        'nash_sutcliffe': match['nash_sutcliffe'],
+        'correlation': match['correlation'],
+        'relative_bias': match['pbias'] / 100,
+        'drainage_area_ratio': drainage_area_ratio,
+        'speedup': elapsed_times[0] / elapsed_times[1]
+    }
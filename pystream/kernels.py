@@ -0,0 +1,118 @@
+import os
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+__all__ = []
+
+# ACHTUNG: this module is only imported by `MonthlySimulation` when the 'numba'
+# engine is requested, and it is not part of the public API
+
+
+def _water_balance_kernel(snow_accum, available_water, ground_water, outflow,
+                          prec, temp, cropf, whc, heat_index, alpha,
+                          parameters, daylight_factor, res_factor):
+    # Fused version of `MonthlySimulation._water_balance`, i.e., the snow,
+    # potential evapotranspiration, soil storage and flow separation of each
+    # pixel in a single pass over memory. The state variables, the outflow,
+    # the heat index and alpha have shape (num_members, num_pixels), the
+    # climatological and terrain arrays have shape (num_pixels, ) and
+    # `parameters` has shape (num_members, 7), with the columns in the order
+    # of `PARAMETERS`. The state variables are updated in place
+    num_members, num_pixels = snow_accum.shape
+    for k in numba.prange(num_members * num_pixels):
+        m = k // num_pixels
+        p = k - m * num_pixels
+        temp_snow_fall = parameters[m, 0]
+        temp_snow_melt = parameters[m, 1]
+        snow_melt_coeff = parameters[m, 2]
+        cropf_coeff = parameters[m, 3]
+        whc_coeff = parameters[m, 4]
+        togw = parameters[m, 5]
+        c = parameters[m, 6]
+        prec_i = prec[p]
+        temp_i = temp[p]
+
+        # SNOW
+        if temp_i > temp_snow_fall:
+            snowfall_i = 0.
+        else:
+            snowfall_i = prec_i
+        snow_accum_i = snow_accum[m, p] + snowfall_i
+        if temp_i < temp_snow_melt:
+            snow_melt_i = 0.
+        else:
+            snow_melt_i = snow_melt_coeff * (temp_i - temp_snow_melt)
+        # like `np.minimum`, propagate NaNs
+        if np.isnan(snow_accum_i) or snow_melt_i > snow_accum_i:
+            snow_melt_i = snow_accum_i
+        snow_accum[m, p] = snow_accum_i - snow_melt_i
+        liquid_prec_i = prec_i - snowfall_i + snow_melt_i
+
+        # POTENTIAL EVAPOTRANSPIRATION (Thornthwaite)
+        if temp_i >= 26.5:
+            pe_i = -415.85 + 32.24 * temp_i - .43 * temp_i**2
+        elif temp_i > 0:
+            pe_i = 16 * ((10 * (temp_i / heat_index[m, p]))**alpha[m, p])
+        elif temp_i <= 0:
+            pe_i = 0.
+        else:
+            pe_i = np.nan
+        pe_i = pe_i * (daylight_factor * cropf[p] * cropf_coeff)
+
+        # SOIL STORAGE (Thornthwaite-Mather)
+        prec_eff_i = liquid_prec_i - pe_i
+        whc_i = whc[p] * whc_coeff
+        available_water_prev = available_water[m, p]
+        wetting_i = available_water_prev + prec_eff_i
+        excess_i = 0.
+        if prec_eff_i <= 0:
+            # soil is drying
+            available_water[m, p] = available_water_prev * np.exp(
+                prec_eff_i / whc_i)
+        elif wetting_i <= whc_i:
+            # soil is wetting below capacity
+            available_water[m, p] = wetting_i
+        elif wetting_i > whc_i:
+            # soil is wetting above capacity
+            excess_i = wetting_i - whc_i
+            available_water[m, p] = whc_i
+
+        # FLOW SEPARATION
+        runoff_i = (1 - togw) * excess_i
+        ground_water_i = ground_water[m, p] + (excess_i - runoff_i)
+        base_flow_i = ground_water_i * c
+        ground_water[m, p] = ground_water_i - base_flow_i
+        outflow[m, p] = ((runoff_i + base_flow_i) / 1000) * res_factor
+
+
+def set_threading_layer_priority():
+    # ACHTUNG: with the TBB threading layer, a process that has run a parallel
+    # kernel can hang at exit if it has forked (e.g., for the worker pool of
+    # `calibrate`), so the other threading layers are preferred. This changes
+    # numba's (process-wide) configuration, so it is only done when setting
+    # up the 'numba' engine and unless the user has configured the threading
+    # layer (through the environment variables or `numba.config`)
+    if numba.config.THREADING_LAYER == 'default' and \
+       'NUMBA_THREADING_LAYER_PRIORITY' not in os.environ and \
+       numba.config.THREADING_LAYER_PRIORITY == ['tbb', 'omp', 'workqueue']:
+        numba.config.THREADING_LAYER_PRIORITY = ['omp', 'workqueue', 'tbb']
+
+
+# order of the columns of the `parameters` argument of the kernel
+PARAMETERS = [
+    'TEMP_SNOW_FALL', 'TEMP_SNOW_MELT', 'SNOW_MELT_COEFF', 'CROPF_COEFF',
+    'WHC_COEFF', 'TOGW', 'C'
+]
+
+if numba is not None:
+    # compiled lazily at the first call (for the data types of its arguments)
+    # and cached on disk
+    water_balance_kernel = numba.njit(parallel=True, cache=True)(
+        _water_balance_kernel)
+else:
+    water_balance_kernel = None
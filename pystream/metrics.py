@@ -0,0 +1,236 @@
+import numpy as np
+
+__all__ = ['METRICS', 'StreamingMetrics', 'compute_metrics']
+
+# Goodness of fit of simulated gauge flows against an observed gauge flow:
+# - 'nash_sutcliffe': Nash-Sutcliffe efficiency
+# - 'log_nash_sutcliffe': Nash-Sutcliffe efficiency of the logarithms of the
+#   flows (plus `log_epsilon`, by default 1% of the mean observed flow, so
+#   that zero flows are allowed), which emphasizes the low flows
+# - 'kling_gupta': Kling-Gupta efficiency (Gupta et al., 2009), i.e., one
+#   minus the euclidean distance of its three components to their ideal
+#   value of one:
+#   - 'correlation': Pearson correlation coefficient
+#   - 'variability_ratio': ratio of the simulated and observed standard
+#     deviations
+#   - 'bias_ratio': ratio of the simulated and observed means
+# - 'rmse': root mean squared error
+# - 'pbias': percent bias, which is positive when the simulated flow
+#   overestimates the observed one
+#
+# The observed gauge flow has shape `(months, )` or `(months, gauges)`, and
+# the simulated one `batch_shape + observed shape`, e.g., `(members, months)`
+# for the gauge flow of an ensemble (see `simulate_ensemble`), so that each
+# metric has shape `batch_shape` or `batch_shape + (gauges, )`. The first
+# `num_warmup_months` and the months with NaN observations are ignored
+METRICS = [
+    'nash_sutcliffe', 'log_nash_sutcliffe', 'kling_gupta', 'correlation',
+    'variability_ratio', 'bias_ratio', 'rmse', 'pbias'
+]
+
+
+def _check_metrics(metrics):
+    if metrics is None:
+        return METRICS
+    for metric in metrics:
+        if metric not in METRICS:
+            raise ValueError(f"Metrics must be among {METRICS}")
+    return metrics
+
+
+def _prepare_obs(obs_gauge_flow, num_warmup_months, log_epsilon):
+    # observed flow after the warm-up, with zeros instead of NaN, weights
+    # that are zero for the NaN observations and `log_epsilon`
+    obs_gauge_flow = np.asarray(obs_gauge_flow,
+                                dtype=np.double)[num_warmup_months:]
+    weights = (~np.isnan(obs_gauge_flow)).astype(np.double)
+    obs_gauge_flow = np.where(weights > 0, obs_gauge_flow, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_obs = obs_gauge_flow.sum(axis=0) / weights.sum(axis=0)
+    if log_epsilon is None:
+        log_epsilon = mean_obs / 100
+    return obs_gauge_flow, weights, log_epsilon
+
+
+def _obs_stats(obs_gauge_flow, weights, log_epsilon, log):
+    # count, mean and sum of squared deviations from the mean of the
+    # observed flow (and of its logarithm if `log` is True)
+    count = weights.sum(axis=0)
+    stats = {'count': count}
+    series = [('obs', obs_gauge_flow)]
+    if log:
+        series.append(('log_obs', np.log(obs_gauge_flow + log_epsilon)))
+    for key, values in series:
+        mean = (values * weights).sum(axis=0) / count
+        stats[f'mean_{key}'] = mean
+        stats[f'm2_{key}'] = (((values - mean) * weights)**2).sum(axis=0)
+    return stats
+
+
+def _from_stats(stats, metrics):
+    # metrics from the sums of the simulated and observed flows (see
+    # `compute_metrics` and `StreamingMetrics`)
+    results = {}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if 'nash_sutcliffe' in metrics:
+            results['nash_sutcliffe'] = 1 - stats['sse'] / stats['m2_obs']
+        if 'log_nash_sutcliffe' in metrics:
+            results['log_nash_sutcliffe'] = 1 - stats['log_sse'] / \
+                stats['m2_log_obs']
+        correlation = stats['cov'] / np.sqrt(stats['m2_sim'] *
+                                             stats['m2_obs'])
+        variability_ratio = np.sqrt(stats['m2_sim'] / stats['m2_obs'])
+        bias_ratio = stats['mean_sim'] / stats['mean_obs']
+        if 'kling_gupta' in metrics:
+            results['kling_gupta'] = 1 - np.sqrt(
+                (correlation - 1)**2 + (variability_ratio - 1)**2 +
+                (bias_ratio - 1)**2)
+        if 'correlation' in metrics:
+            results['correlation'] = correlation
+        if 'variability_ratio' in metrics:
+            results['variability_ratio'] = variability_ratio
+        if 'bias_ratio' in metrics:
+            results['bias_ratio'] = bias_ratio
+        if 'rmse' in metrics:
+            results['rmse'] = np.sqrt(stats['sse'] / stats['count'])
+        if 'pbias' in metrics:
+            results['pbias'] = 100 * (stats['mean_sim'] - stats['mean_obs']
+                                      ) / stats['mean_obs']
+    return results
+
+
+def compute_metrics(sim_gauge_flow, obs_gauge_flow, num_warmup_months=0,
+                    metrics=None, log_epsilon=None):
+    # Returns a dict that maps each of the `metrics` (by default, all the
+    # `METRICS`) to an array with its value for each simulated gauge flow,
+    # all of them computed at once with vectorized reductions along the time
+    # axis
+    metrics = _check_metrics(metrics)
+    sim_gauge_flow = np.asarray(sim_gauge_flow, dtype=np.double)
+    obs_ndim = np.ndim(obs_gauge_flow)
+    time_axis = sim_gauge_flow.ndim - obs_ndim
+    if time_axis < 0 or sim_gauge_flow.shape[time_axis:] != np.shape(
+            obs_gauge_flow):
+        raise ValueError(
+            "The shape of the simulated gauge flow must end with the shape "
+            "of the observed one")
+    if np.shape(obs_gauge_flow)[0] <= num_warmup_months:
+        raise ValueError("There must be months after the warm-up")
+    obs_gauge_flow, weights, log_epsilon = _prepare_obs(
+        obs_gauge_flow, num_warmup_months, log_epsilon)
+    log = 'log_nash_sutcliffe' in metrics
+    sim_gauge_flow = sim_gauge_flow[(slice(None), ) * time_axis +
+                                    (slice(num_warmup_months, None), )]
+
+    if not np.all(weights):
+        # ignore the simulated flows at the NaN observations (which are then
+        # multiplied by zero weights), even if they are NaN themselves
+        sim_gauge_flow = np.where(weights > 0, sim_gauge_flow, 0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        stats = _obs_stats(obs_gauge_flow, weights, log_epsilon, log)
+        mean_sim = (sim_gauge_flow * weights).sum(axis=time_axis) / \
+            stats['count']
+        stats['mean_sim'] = mean_sim
+        stats['m2_sim'] = (((sim_gauge_flow - np.expand_dims(
+            mean_sim, time_axis)) * weights)**2).sum(axis=time_axis)
+        stats['cov'] = (sim_gauge_flow * (obs_gauge_flow - stats['mean_obs']) *
+                        weights).sum(axis=time_axis)
+        stats['sse'] = (((sim_gauge_flow - obs_gauge_flow) *
+                         weights)**2).sum(axis=time_axis)
+        if log:
+            stats['log_sse'] = (
+                ((np.log(sim_gauge_flow + log_epsilon) -
+                  np.log(obs_gauge_flow + log_epsilon)) *
+                 weights)**2).sum(axis=time_axis)
+
+    return _from_stats(stats, metrics)
+
+
+class StreamingMetrics:
+    # Same as `compute_metrics`, but updated with the simulated gauge flow of
+    # one month at a time (e.g., of each step of a simulation), with shape
+    # `batch_shape + (gauges, )` in gauge mode and `batch_shape` otherwise, so
+    # that the time series of the simulated flows (e.g., of large ensembles)
+    # never need to be stored. Since the observed gauge flow is known from the
+    # start, its statistics are computed beforehand, and those of the
+    # simulated flow are updated with Welford's algorithm (see
+    # `accumulators.MeanVariance`)
+    def __init__(self, obs_gauge_flow, num_warmup_months=0, metrics=None,
+                 log_epsilon=None):
+        self.metrics = _check_metrics(metrics)
+        self.num_warmup_months = num_warmup_months
+        self.num_months = np.shape(obs_gauge_flow)[0]
+        if self.num_months <= num_warmup_months:
+            raise ValueError("There must be months after the warm-up")
+        self._obs_gauge_flow, self._weights, self.log_epsilon = _prepare_obs(
+            obs_gauge_flow, num_warmup_months, log_epsilon)
+        self._log = 'log_nash_sutcliffe' in self.metrics
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self._obs_stats = _obs_stats(self._obs_gauge_flow, self._weights,
+                                         self.log_epsilon, self._log)
+        self.step = 0
+        self._stats = None
+
+    def update(self, sim_gauge_flow_i):
+        if self.step >= self.num_months:
+            raise ValueError(
+                f"The observed gauge flow only has {self.num_months} months")
+        i = self.step - self.num_warmup_months
+        self.step += 1
+        if i < 0:
+            return
+        sim_gauge_flow_i = np.asarray(sim_gauge_flow_i, dtype=np.double)
+        obs_i = self._obs_gauge_flow[i]
+        weight_i = self._weights[i]
+        if not np.all(weight_i):
+            sim_gauge_flow_i = np.where(weight_i > 0, sim_gauge_flow_i, 0)
+        if self._stats is None:
+            batch_shape = np.broadcast(sim_gauge_flow_i, obs_i).shape
+            self._count = np.zeros(np.shape(weight_i))
+            self._stats = {
+                key: np.zeros(batch_shape)
+                for key in ['mean_sim', 'm2_sim', 'cov', 'sse'] +
+                (['log_sse'] if self._log else [])
+            }
+        stats = self._stats
+
+        # ACHTUNG: the months with NaN observations have zero weight, so that
+        # they do not change the statistics (and the counts stay positive
+        # once they are, so the divisions are always defined where used)
+        self._count += weight_i
+        delta = (sim_gauge_flow_i - stats['mean_sim']) * weight_i
+        with np.errstate(divide='ignore', invalid='ignore'):
+            stats['mean_sim'] += np.where(self._count > 0,
+                                          delta / self._count, 0)
+        stats['m2_sim'] += delta * (sim_gauge_flow_i - stats['mean_sim'])
+        stats['cov'] += sim_gauge_flow_i * (
+            obs_i - self._obs_stats['mean_obs']) * weight_i
+        stats['sse'] += ((sim_gauge_flow_i - obs_i) * weight_i)**2
+        if self._log:
+            stats['log_sse'] += (
+                (np.log(sim_gauge_flow_i + self.log_epsilon) -
+                 np.log(obs_i + self.log_epsilon)) * weight_i)**2
+
+    def result(self):
+        if self._stats is None:
+            raise ValueError("The metrics have not been updated after the "
+                             "warm-up months")
+        stats = dict(self._obs_stats)
+        stats.update(self._stats)
+        # the counts and observed statistics of the months seen so far
+        if self.step < self.num_months:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                stats.update(
+                    _obs_stats(
+                        self._obs_gauge_flow[:self.step -
+                                             self.num_warmup_months],
+                        self._weights[:self.step - self.num_warmup_months],
+                        self.log_epsilon, self._log))
+            # ACHTUNG: the covariance is computed with respect to the mean of
+            # all the observations, so it is corrected with the difference
+            # between the means of the months seen so far and of all of them
+            stats['cov'] = stats['cov'] - (
+                stats['mean_obs'] - self._obs_stats['mean_obs']) * \
+                stats['mean_sim'] * stats['count']
+        return _from_stats(stats, self.metrics)
@@ -1,21 +1,81 @@
+import functools
+import hashlib
 import itertools
+import json
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+import warnings
 
 import numpy as np
-import rasterio
 import richdem
 import xarray as xr
+from scipy import sparse
 
-from . import plotting, utils
+from . import accumulators as _accumulators
+from . import outputs, prefetch, profiling, regridding, routing, utils
 
 __all__ = ['MonthlySimulation']
 
 
+def _trace_setup_memory(init):
+    # Wraps `MonthlySimulation.__init__` so that, with the keyword-only
+    # argument `trace_memory=True`, the peak memory (in bytes) allocated while
+    # setting up the simulation (i.e., loading the terrain and climatological
+    # data and computing the routing) is traced with `tracemalloc` and stored
+    # in the `setup_peak_memory` attribute (None otherwise). Memory-mapped
+    # rasters (see `raster_cache_dir`) are not counted, since their pages are
+    # backed by the cache files
+    @functools.wraps(init)
+    def wrapper(self, *args, trace_memory=False, **kwargs):
+        if not trace_memory:
+            init(self, *args, **kwargs)
+            self.setup_peak_memory = None
+            return
+
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            # ACHTUNG: this resets the peak of the ongoing trace
+            tracemalloc.reset_peak()
+        else:
+            tracemalloc.start()
+        start_memory, _ = tracemalloc.get_traced_memory()
+        try:
+            init(self, *args, **kwargs)
+            _, peak_memory = tracemalloc.get_traced_memory()
+        finally:
+            if not tracing:
+                tracemalloc.stop()
+        self.setup_peak_memory = peak_memory - start_memory
+
+    return wrapper
+
+
 class MonthlySimulation:
     # TODO: more flexible approach
     TIME_STEP = 2592000  # i.e., 30 * 24 * 3600 seconds per month
 
+    # model parameters and their default values
+    DEFAULT_PARAMETERS = {
+        'HEAT_COEFF': 1,
+        'TEMP_SNOW_FALL': 2,
+        'TEMP_SNOW_MELT': 0,
+        'SNOW_MELT_COEFF': 15,
+        'CROPF_COEFF': 1.5,
+        'WHC_COEFF': 1.5,
+        'TOGW': .5,
+        'C': .2
+    }
+    PARAMETER_NAMES = list(DEFAULT_PARAMETERS)
+
+    # default number of months whose outflow is routed at once (see
+    # `_simulate`)
+    ROUTING_BATCH_SIZE = 12
+
     @staticmethod
-    def _prepare_ds(filepath_or_dataset, varname, decode_times):
+    def _prepare_ds(filepath_or_dataset, varname, decode_times, window=None):
         if isinstance(filepath_or_dataset, str):
             ds = xr.open_dataset(filepath_or_dataset,
                                  decode_times=decode_times)
@@ -35,58 +95,164 @@ class MonthlySimulation:
                 raise ValueError(
                     f"Variable {varname} must be among {data_vars}")
 
+        if window is not None:
+            # select the window lazily, so that file-backed datasets only read
+            # it from disk. The spatial dimensions are assumed to be the rows
+            # and columns of the rasters, in this order
+            row_dim, col_dim = [
+                dim for dim in ds[varname].dims if dim != 'time'
+            ]
+            row_slice, col_slice = window.toslices()
+            ds = ds.isel({row_dim: row_slice, col_dim: col_slice})
+
         return ds, varname
 
+    @staticmethod
+    def _read_raster(filepath_or_arr, window, cache_dir, dtype=None):
+        # Returns the values of a raster (restricted to `window` if provided)
+        # and, if it is read from a file, the (closed) rasterio dataset with
+        # its metadata. Arrays are only sliced (i.e., no copies). Files are
+        # only read within the window and, if `cache_dir` is provided, the
+        # values are stored there as a raw '.npy' file (keyed by the file
+        # path, size, modification time and window) which is returned as a
+        # read-only memory map, so that large rasters are not held in memory
+        if not isinstance(filepath_or_arr, str):
+            arr = np.asanyarray(filepath_or_arr)
+            if window is not None:
+                arr = arr[window.toslices()]
+            return arr, None
+
+        # ACHTUNG: rasterio (like matplotlib for the plots) is only imported
+        # when needed, so that simulations of in-memory arrays (e.g., in the
+        # worker processes of `calibrate`) do not pay for its import
+        import rasterio
+        with rasterio.open(filepath_or_arr) as src:
+            if cache_dir is None:
+                arr = src.read(1, window=window)
+                if dtype is not None:
+                    arr = arr.astype(dtype, copy=False)
+                return arr, src
+
+            stat = os.stat(filepath_or_arr)
+            key = hashlib.sha256(
+                repr((os.path.abspath(filepath_or_arr), stat.st_size,
+                      stat.st_mtime_ns,
+                      None if window is None else window.flatten(),
+                      None if dtype is None else np.dtype(dtype).str)
+                     ).encode())
+            cache_filepath = os.path.join(cache_dir, f'{key.hexdigest()}.npy')
+            if not os.path.exists(cache_filepath):
+                arr = src.read(1, window=window)
+                if dtype is not None:
+                    arr = arr.astype(dtype, copy=False)
+                os.makedirs(cache_dir, exist_ok=True)
+                # write to a temporary file first so that concurrent
+                # simulations never see a partially written cache file
+                fd, tmp_filepath = tempfile.mkstemp(suffix='.npy',
+                                                    dir=cache_dir)
+                with os.fdopen(fd, 'wb') as f:
+                    np.save(f, arr)
+                os.replace(tmp_filepath, cache_filepath)
+
+        return np.load(cache_filepath, mmap_mode='r'), src
+
+    @_trace_setup_memory
     def __init__(self, dem, cropf, whc, prec, temp,
                  monthly_daylight_hours=None, prec_varname=None,
                  temp_varname=None, res=None, nodata=-9999, whc_epsilon=.01,
-                 decode_times=False, init_parameters={}):
+                 decode_times=False, init_parameters={}, gauges=None,
+                 climate_loading=None, engine='numpy', window=None,
+                 mask=None, raster_cache_dir=None, climate_prefetch=0,
+                 flow_routing=None, transform=None, climate_regridding=None,
+                 regridding_cache_dir=None, profiler=None):
+        setup_start = time.perf_counter()
 
         #
         # LOAD TERRAIN DATA
         #
 
+        # WINDOW
+        # the rasters (and the climatological datasets) can be restricted to
+        # a window, i.e., a `rasterio.windows.Window` or a tuple of
+        # ((row_start, row_stop), (col_start, col_stop)), so that only the
+        # window is read from the raster files. Alternatively, a boolean
+        # `mask` of the shape of the rasters (e.g., a catchment) sets the
+        # pixels outside of it to nodata and, unless a window is provided,
+        # the window is its bounding box
+        if mask is not None:
+            mask = np.asarray(mask, dtype=bool)
+            if window is None:
+                rows = np.flatnonzero(mask.any(axis=1))
+                cols = np.flatnonzero(mask.any(axis=0))
+                if rows.size == 0:
+                    raise ValueError("The mask must have at least one pixel")
+                window = ((rows[0], rows[-1] + 1), (cols[0], cols[-1] + 1))
+        if window is not None:
+            from rasterio import windows
+            if not isinstance(window, windows.Window):
+                window = windows.Window.from_slices(*window)
+        self.window = window
+
         # DEM
-        if isinstance(dem, str):
-            with rasterio.open(dem) as dem_src:
-                self.dem = richdem.rdarray(
-                    dem_src.read(1).astype(np.double), no_data=dem_src.nodata)
-                # We assert that all rasters are aligned, so this should be
-                # the resolution of all rasters. We will be setting it as
-                # class attribute every time we read a raster file to ensure
-                # that we get the resolution when some terrain data is
-                # provided as ndarray
-                self.res = dem_src.res
-        elif isinstance(dem, np.ndarray):
-            # ensure that the self.dem is a `richdem.rdarray` (which is a
-            # subclass of `np.ndarray`)
-            if isinstance(dem, richdem.rdarray):
-                self.dem = dem
-            else:
-                # ACHTUNG with the nodata argument, since elevation could
-                # perfectly take negative values
-                self.dem = richdem.rdarray(
-                    dem.astype(np.double), no_data=nodata)
+        if isinstance(dem, richdem.rdarray):
+            nodata = dem.no_data
+            dem_meta = dem
+        else:
+            dem_meta = None
+        dem, dem_src = MonthlySimulation._read_raster(dem, window,
+                                                      raster_cache_dir,
+                                                      dtype=np.double)
+        if dem_src is not None:
+            # We assert that all rasters are aligned, so this should be the
+            # resolution of all rasters. We will be setting it as class
+            # attribute every time we read a raster file to ensure that we
+            # get the resolution when some terrain data is provided as
+            # ndarray
+            self.res = dem_src.res
+            nodata = dem_src.nodata
+            transform = dem_src.transform
+        elif transform is None and \
+                getattr(dem_meta, 'geotransform', None) is not None:
+            from rasterio import Affine
+            transform = Affine.from_gdal(*dem_meta.geotransform)
+        # the affine transform of the (windowed) rasters, if known, which is
+        # only needed to regrid the climatological data (see below)
+        if transform is not None and window is not None:
+            transform = windows.transform(window, transform)
+        self.transform = transform
+        # ACHTUNG with the nodata argument, since elevation could perfectly
+        # take negative values
+        if mask is not None:
+            # the masked DEM is a new array, so the caller's one is untouched
+            dem = np.where(mask[window.toslices()], dem, nodata)
+        # ensure that the self.dem is a `richdem.rdarray` (which is a subclass
+        # of `np.ndarray`). ACHTUNG: this does not copy the DEM if it is
+        # already an array of doubles
+        self.dem = richdem.rdarray(dem, meta_obj=dem_meta, no_data=nodata,
+                                   dtype=np.double)
 
         # CROP FACTOR
-        if isinstance(cropf, str):
-            with rasterio.open(cropf) as cropf_src:
-                self.cropf = cropf_src.read(1)
-                self.res = cropf_src.res  # See comment above `dem_src.res`
-        elif isinstance(cropf, np.ndarray):
-            self.cropf = cropf
+        self.cropf, cropf_src = MonthlySimulation._read_raster(
+            cropf, window, raster_cache_dir)
+        if cropf_src is not None:
+            self.res = cropf_src.res  # See comment above `dem_src.res`
 
         # WATER HOLDING CAPACITY
-        if isinstance(whc, str):
-            with rasterio.open(whc) as whc_src:
-                self.whc = whc_src.read(1)
-                self.res = whc_src.res  # See comment above `dem_src.res`
-        elif isinstance(whc, np.ndarray):
-            self.whc = whc
+        whc, whc_src = MonthlySimulation._read_raster(whc, window,
+                                                      raster_cache_dir)
+        if whc_src is not None:
+            self.res = whc_src.res  # See comment above `dem_src.res`
 
         # whc must be strictly positive, so we must replace all zero/negative
-        # pixels for an arbitrarily very small value
-        self.whc[self.whc <= 0] = whc_epsilon
+        # pixels for an arbitrarily very small value. ACHTUNG: this is done
+        # in a new array (only if needed), so that neither the caller's array
+        # nor the cached rasters are modified. The value is cast to the data
+        # type of the raster (as an in-place assignment would do), e.g., for
+        # integer rasters, a `whc_epsilon` smaller than one becomes zero
+        if np.any(whc <= 0):
+            whc = np.where(whc <= 0,
+                           np.asarray(whc_epsilon).astype(whc.dtype), whc)
+        self.whc = whc
 
         if res is not None:
             # If the resolution is explicitly provided, it takes preference
@@ -104,19 +270,95 @@ class MonthlySimulation:
         if not (self.dem.shape == self.cropf.shape == self.whc.shape):
             raise ValueError("Raster shapes do not match!")
 
+        # ROUTING
+        # the DEM is static, so the D8 flow directions and the order in which
+        # pixels pass their flow downstream only need to be computed once
+        # (unless a precomputed `routing.D8Routing` of the DEM is provided,
+        # e.g., from compiled inputs, see `from_compiled_inputs`)
+        if flow_routing is None:
+            self.routing = routing.D8Routing(self.dem)
+        else:
+            if flow_routing.shape != self.dem.shape:
+                raise ValueError(
+                    "The shape of the flow routing must match the rasters")
+            self.routing = flow_routing
+
+        # GAUGES
+        # by default, the whole streamflow raster is computed and the gauge
+        # flow is assumed to be its maximum. Alternatively, if the gauge
+        # locations are known, i.e., a list of (row, col) pixel coordinates or
+        # 'outlet' for the pixel with the largest drainage area, only the
+        # pixels that drain into the gauges need to be simulated, and the flow
+        # of each gauge is the sum of the outflow of its upstream pixels
+        if gauges is None:
+            self.gauges = None
+            # the water balance is computed over the valid (i.e., not nodata)
+            # pixels of the DEM, which for rasters clipped to a catchment
+            # might be less than half of the raster. If all the pixels are
+            # valid, the rasters are used as they are
+            valid_mask = ~self.routing.nodata_mask.ravel()
+            if np.all(valid_mask):
+                self._pixels = None
+            else:
+                self._pixels = np.flatnonzero(valid_mask)
+        else:
+            if isinstance(gauges, str):
+                if gauges != 'outlet':
+                    raise ValueError(
+                        "Gauges must be a list of (row, col) pixel "
+                        "coordinates or 'outlet'")
+                self.gauges = np.array([self.routing.outlet()])
+            else:
+                rows, cols = np.asarray(gauges).reshape(-1, 2).T
+                if np.any((rows < 0) | (rows >= self.dem.shape[0]) |
+                          (cols < 0) | (cols >= self.dem.shape[1])):
+                    raise ValueError("Gauges must lie within the rasters!")
+                self.gauges = np.ravel_multi_index((rows, cols),
+                                                   self.dem.shape)
+                if np.any(self.routing.nodata_mask.ravel()[self.gauges]):
+                    raise ValueError("Gauges cannot lie on nodata pixels!")
+
+            catchments = [
+                self.routing.upstream_pixels(gauge) for gauge in self.gauges
+            ]
+            # the water balance is only computed over the union of the
+            # catchments (flat indices of the pixels, in ascending order)
+            self._pixels = np.unique(np.concatenate(catchments))
+            # sparse matrix such that multiplying it by the outflow of the
+            # simulated pixels gives the flow at each gauge
+            self._gauge_matrix = sparse.csr_matrix(
+                (np.ones(sum(catchment.size for catchment in catchments)),
+                 (np.repeat(np.arange(len(catchments)),
+                            [catchment.size for catchment in catchments]),
+                  np.searchsorted(self._pixels, np.concatenate(catchments)))),
+                shape=(len(catchments), self._pixels.size))
+
+        # terrain data of the simulated pixels (ACHTUNG: when all the pixels
+        # are simulated, windows of caller-provided arrays are the only case
+        # that requires a copy, i.e., to make them contiguous)
+        self._cropf = np.ascontiguousarray(self._to_domain(self.cropf))
+        self._whc = np.ascontiguousarray(self._to_domain(self.whc))
+
         #
         # CLIMATOLOGICAL DATA
         #
 
         # TODO: support ndarrays as climatological data?
 
+        # the window of the rasters does not apply to climatological data
+        # that must be regridded (see below)
+        if climate_regridding is None:
+            climate_window = window
+        else:
+            climate_window = None
+
         # PRECIPITATION
         self.prec_ds, self.prec_varname = MonthlySimulation._prepare_ds(
-            prec, prec_varname, decode_times)
+            prec, prec_varname, decode_times, climate_window)
 
         # TEMPERATURE
         self.temp_ds, self.temp_varname = MonthlySimulation._prepare_ds(
-            temp, temp_varname, decode_times)
+            temp, temp_varname, decode_times, climate_window)
 
         # we assert that not only the `time` dimensions match, but so do the
         # (x, y)/(lon, lat) coordinates. TODO: enforce it by raising
@@ -128,6 +370,91 @@ class MonthlySimulation:
             raise ValueError(
                 "Time dimensions of climatological datasets do not match")
 
+        # REGRIDDING
+        # by default, the climatological data must be on the grid of the
+        # rasters. Alternatively, it can stay on its own (e.g., coarser)
+        # rectilinear grid, given by the coordinates of its spatial
+        # dimensions, and be regridded on the fly with a sparse matrix of
+        # weights (see `regridding.REGRIDDING_METHODS`), which is computed
+        # once (and cached on disk if `regridding_cache_dir` is provided).
+        # This requires the affine transform of the rasters, which is taken
+        # from the DEM (file or `richdem.rdarray`) or from `transform`
+        self.climate_regridding = climate_regridding
+        if climate_regridding is None:
+            self._regridding_matrix = None
+            self._climate_shape = self.dem.shape
+        else:
+            if self.transform is None:
+                raise ValueError(
+                    "Regridding the climatological data requires the "
+                    "transform of the rasters")
+            src_coords = []
+            for ds, varname in [(self.prec_ds, self.prec_varname),
+                                (self.temp_ds, self.temp_varname)]:
+                da = ds[varname]
+                spatial_dims = [dim for dim in da.dims if dim != 'time']
+                if not all(dim in da.coords for dim in spatial_dims):
+                    raise ValueError(
+                        f"Variable {varname} must have coordinates along its "
+                        "spatial dimensions to be regridded")
+                src_coords.append([da[dim].values for dim in spatial_dims])
+            if not all(
+                    np.array_equal(prec_coords, temp_coords) for prec_coords,
+                    temp_coords in zip(*src_coords)):
+                raise ValueError(
+                    "The grids of the climatological datasets do not match")
+            src_y, src_x = src_coords[0]
+            weights = regridding.get_regridding_weights(
+                src_y, src_x, *self._get_raster_coords(),
+                method=climate_regridding, cache_dir=regridding_cache_dir)
+            # only the rows of the simulated pixels are needed
+            if self._pixels is not None:
+                weights = weights[self._pixels]
+            self._regridding_matrix = weights
+            self._climate_shape = (src_y.size, src_x.size)
+
+        # By default, the climatological data of each month is extracted from
+        # the datasets at each simulation step, which for file-backed datasets
+        # means reading from disk. Alternatively, the values of the simulated
+        # pixels for the whole record can be loaded once into C-contiguous
+        # (months, ) + domain arrays (see `_to_domain`), either in memory
+        # ('memory') or in a memory map of a temporary file ('mmap'), so that
+        # each simulation step only gets array views
+        if climate_loading is None:
+            self._prec_arr = None
+            self._temp_arr = None
+        elif climate_loading in ['memory', 'mmap']:
+            self._prec_arr = self._load_climate(self.prec_ds,
+                                                self.prec_varname,
+                                                climate_loading)
+            self._temp_arr = self._load_climate(self.temp_ds,
+                                                self.temp_varname,
+                                                climate_loading)
+        else:
+            raise ValueError("Climate loading must be None, 'memory' or "
+                             "'mmap'")
+
+        # when the climatological data is extracted from the datasets at each
+        # simulation step, the months that follow the simulated one can be
+        # read in background threads (up to `climate_prefetch` months ahead),
+        # so that reading from disk overlaps with the simulation (see
+        # `_iter_climate`)
+        if climate_prefetch < 0:
+            raise ValueError(
+                "The number of prefetched months cannot be negative")
+        self.climate_prefetch = climate_prefetch
+
+        # months appended after the record of the datasets (see
+        # `append_months`), as tuples of the precipitation and temperature at
+        # the simulated pixels
+        self._num_record_months = self.num_months
+        self._appended_climate = []
+
+        # the yearly heat index and alpha are computed (and cached) the first
+        # time that they are needed
+        self._yearly_heat_index = None
+        self._heat_index_alpha_cache = None
+
         # OTHER
 
         # this will be used later in the `simulate` method
@@ -141,195 +468,1217 @@ class MonthlySimulation:
         # `zeros_like` (because it would also return an rdarray). On the other
         # hand, we can enforce a `np.double` data type in order to be
         # consistent with the DEM's data type (remember that richdem enforces
-        # using doubles)
-        self.snow_accum = np.zeros(self.dem.shape, dtype=np.double)
-        self.available_water = np.zeros(self.dem.shape, dtype=np.double)
-        self.ground_water = np.zeros(self.dem.shape, dtype=np.double)
+        # using doubles). The state variables are only stored for the
+        # simulated pixels (see the `snow_accum`, `available_water` and
+        # `ground_water` properties for the full rasters)
+        domain_shape = self._cropf.shape
+        self._snow_accum = np.zeros(domain_shape, dtype=np.double)
+        self._available_water = np.zeros(domain_shape, dtype=np.double)
+        self._ground_water = np.zeros(domain_shape, dtype=np.double)
+        # index of the month that follows the last simulated one, i.e., the
+        # month from which a simulation can be resumed
+        self.step = 0
 
         # PARAMETERS
-        self.HEAT_COEFF = init_parameters.get('HEAT_COEFF', 1)
-        self.TEMP_SNOW_FALL = init_parameters.get('TEMP_SNOW_FALL', 2)
-        self.TEMP_SNOW_MELT = init_parameters.get('TEMP_SNOW_MELT', 0)
-        self.SNOW_MELT_COEFF = init_parameters.get('SNOW_MELT_COEFF', 15)
-        self.CROPF_COEFF = init_parameters.get('CROPF_COEFF', 1.5)
-        self.WHC_COEFF = init_parameters.get('WHC_COEFF', 1.5)
-        self.TOGW = init_parameters.get('TOGW', .5)
-        self.C = init_parameters.get('C', .2)
+        for parameter, default in MonthlySimulation.DEFAULT_PARAMETERS.items():
+            setattr(self, parameter, init_parameters.get(parameter, default))
+
+        # ENGINE
+        # the water balance can be computed with numpy operations ('numpy')
+        # or with a kernel compiled with numba ('numba') that fuses all of
+        # them into a single parallel loop over the pixels, which falls back
+        # to 'numpy' if numba is not installed. ACHTUNG: unless it has been
+        # configured, numba's threading layer is set to prefer OpenMP over TBB
+        # (see `kernels.set_threading_layer_priority`)
+        if engine not in ['numpy', 'numba']:
+            raise ValueError("Engine must be 'numpy' or 'numba'")
+        if engine == 'numba':
+            from . import kernels
+            if kernels.water_balance_kernel is None:
+                warnings.warn("Numba is not installed, falling back to the "
+                              "'numpy' engine")
+                engine = 'numpy'
+            else:
+                kernels.set_threading_layer_priority()
+        self.engine = engine
+
+        # work buffers of the simulation steps (see `_buffer`)
+        self._buffers = {}
+
+        # PROFILING
+        # optional callable (e.g., a `profiling.Profiler`) that receives a
+        # `profiling.PhaseEvent` for the setup and for each phase of the
+        # simulations (see `profiling.PHASES`)
+        self.profiler = profiler
+        if profiler is not None:
+            profiler(
+                profiling.PhaseEvent('setup', None, 0, setup_start,
+                                     time.perf_counter() - setup_start, 0,
+                                     None))
 
         # TODO: self.flux_i
         # TODO: self.time_step
 
+    def _load_climate(self, ds, varname, climate_loading):
+        da = ds[varname]
+        # ensure that the layout is (time, y, x) and that it matches the
+        # terrain data
+        if 'time' not in da.dims or da.ndim != 3:
+            raise ValueError(
+                f"Variable {varname} must have the time dimension and two "
+                "spatial dimensions")
+        da = da.transpose('time', *[dim for dim in da.dims if dim != 'time'])
+        shape = (self.num_months, ) + self._climate_shape
+        if da.shape != shape:
+            raise ValueError(
+                f"The shape of variable {varname} must be {shape}, i.e., "
+                "(months, ) + the shape of the rasters (or of the "
+                "climatological grid if it is regridded)")
+        # keep floating point data types (so that the results do not depend on
+        # the loading mode), but cast anything else to doubles
+        if np.issubdtype(da.dtype, np.floating):
+            dtype = da.dtype
+        else:
+            dtype = np.double
+
+        # only the values of the simulated pixels are stored
+        domain_shape = (self.num_months, ) + self._cropf.shape
+        if climate_loading == 'memory':
+            arr = np.ascontiguousarray(self._climate_to_domain(da.values),
+                                       dtype=dtype)
+        else:
+            # the temporary file is deleted as soon as the memory map is
+            # garbage-collected. Read month by month to bound memory usage
+            arr = np.memmap(tempfile.TemporaryFile(), dtype=dtype,
+                            mode='w+', shape=domain_shape)
+            for i in range(self.num_months):
+                arr[i] = self._climate_to_domain(da.isel(time=i).values)
+            arr.flush()
+        arr.flags.writeable = False
+
+        return arr
+
+    def _get_climate(self, i, buffer_names=('prec', 'temp')):
+        # precipitation and temperature of the month `i` at the simulated
+        # pixels. ACHTUNG: these might be work buffers (see `_to_domain`),
+        # unless `buffer_names` is (None, None)
+        if i >= self._num_record_months:
+            return self._appended_climate[i - self._num_record_months]
+        if self._prec_arr is None:
+            prec_buffer_name, temp_buffer_name = buffer_names
+            return (self._climate_to_domain(
+                self.prec_ds.isel(time=i)[self.prec_varname].values,
+                prec_buffer_name),
+                    self._climate_to_domain(
+                        self.temp_ds.isel(time=i)[self.temp_varname].values,
+                        temp_buffer_name))
+        return self._prec_arr[i], self._temp_arr[i]
+
+    def _iter_climate(self, start, end):
+        # iterator that yields the precipitation and temperature of the months
+        # from `start` to `end` (see `_get_climate`), prefetched in background
+        # threads if `climate_prefetch` is set and the climatological data is
+        # extracted from the datasets at each step
+        if self.climate_prefetch == 0 or self._prec_arr is not None:
+            return (self._get_climate(i) for i in range(start, end))
+        # ACHTUNG: the prefetched months cannot be written to the work buffers
+        # since they are read concurrently
+        return prefetch.prefetch(
+            functools.partial(self._get_climate, buffer_names=(None, None)),
+            range(start, end), self.climate_prefetch,
+            num_threads=min(self.climate_prefetch, os.cpu_count() or 1))
+
+    def _get_temp(self, start, end):
+        # (months, ) + domain array with the temperature of the months from
+        # `start` to `end` at the simulated pixels
+        record_end = min(end, self._num_record_months)
+        temp = []
+        if start < record_end:
+            if self._temp_arr is None:
+                # ACHTUNG: select the months before extracting the values, so
+                # that file-backed datasets only read them from disk
+                temp_da = self.temp_ds[self.temp_varname].isel(
+                    time=slice(start, record_end))
+                temp.append(
+                    self._climate_to_domain(
+                        temp_da.transpose(
+                            'time', *[dim for dim in temp_da.dims
+                                      if dim != 'time']).values))
+            else:
+                temp.append(self._temp_arr[start:record_end])
+        if end > record_end:
+            temp.append(
+                np.stack([
+                    temp_i for _, temp_i in self._appended_climate[
+                        max(start, record_end) -
+                        self._num_record_months:end -
+                        self._num_record_months]
+                ]))
+        if len(temp) == 1:
+            return temp[0]
+        return np.concatenate(temp)
+
+    def _to_domain(self, arr, buffer_name=None):
+        # values of a raster (the last two axes of `arr`, so that a stack of
+        # them can be converted at once) at the simulated pixels, written to
+        # the work buffer `buffer_name` if provided (see `_buffer`)
+        if self._pixels is None:
+            return arr
+        arr = np.asarray(arr)
+        arr = arr.reshape(arr.shape[:-2] + (-1, ))
+        # ACHTUNG: unlike fancy indexing, `np.take` always returns C-contiguous
+        # arrays, so that the results (e.g., sums along the time axis) do not
+        # depend on whether the values come from the datasets or from the
+        # preloaded arrays
+        if buffer_name is None:
+            out = None
+        else:
+            out = self._buffer(buffer_name,
+                               arr.shape[:-1] + self._pixels.shape, arr.dtype)
+        return np.take(arr, self._pixels, axis=-1, out=out)
+
+    def _get_raster_coords(self):
+        # coordinates of the cell centers of the rows and columns of the
+        # rasters (ACHTUNG: assuming that the transform has no rotation)
+        height, width = self.dem.shape
+        return (self.transform.f + self.transform.e *
+                (np.arange(height) + .5), self.transform.c +
+                self.transform.a * (np.arange(width) + .5))
+
+    def _climate_to_domain(self, arr, buffer_name=None):
+        # same as `_to_domain` for climatological fields, which are regridded
+        # if needed (in which case, they are not written to work buffers)
+        if self._regridding_matrix is None:
+            return self._to_domain(arr, buffer_name)
+        arr = np.asarray(arr)
+        values = self._regridding_matrix.dot(
+            arr.reshape(-1, arr.shape[-2] * arr.shape[-1]).T).T
+        return values.reshape(arr.shape[:-2] + self._cropf.shape)
+
+    def _to_raster(self, values, fill_value=np.nan):
+        # raster from the values at the simulated pixels (the last axis of
+        # `values`, so that a stack of them can be converted at once)
+        if self._pixels is None:
+            return values
+        raster = np.full(values.shape[:-1] + self.dem.shape, fill_value,
+                         dtype=values.dtype)
+        raster.reshape(values.shape[:-1] + (-1, ))[..., self._pixels] = values
+        return raster
+
+    @property
+    def parameters(self):
+        return {
+            parameter: getattr(self, parameter)
+            for parameter in MonthlySimulation.PARAMETER_NAMES
+        }
+
+    def _state_to_domain(self, raster):
+        # values of a state variable raster at the simulated pixels, copied
+        # (as doubles) since the state variables are updated in place
+        raster = np.asarray(raster, dtype=np.double)
+        if raster.shape != self.dem.shape:
+            raise ValueError(
+                f"The state variables must have shape {self.dem.shape}, "
+                "i.e., the shape of the rasters")
+        return np.array(self._to_domain(raster))
+
+    @property
+    def snow_accum(self):
+        return self._to_raster(self._snow_accum)
+
+    @snow_accum.setter
+    def snow_accum(self, raster):
+        self._snow_accum = self._state_to_domain(raster)
+
+    @property
+    def available_water(self):
+        return self._to_raster(self._available_water)
+
+    @available_water.setter
+    def available_water(self, raster):
+        self._available_water = self._state_to_domain(raster)
+
+    @property
+    def ground_water(self):
+        return self._to_raster(self._ground_water)
+
+    @ground_water.setter
+    def ground_water(self, raster):
+        self._ground_water = self._state_to_domain(raster)
+
     @staticmethod
     def _compute_alpha(heat_index):
         # Thornthwaite (1948)
         return .49239 + .01792 * heat_index - .0000771771 * heat_index**2 \
             + .000000675 * heat_index**3
 
-    # this is the STREAM model's core
-    def _simulation_step(self, prec_i, temp_i, year_heat_index, year_alpha,
-                         daylight_hours=12):
+    def _buffer(self, name, shape, dtype):
+        # preallocated work buffer, which is only reallocated if its shape or
+        # data type change (e.g., ensembles of a different size)
+        buf = self._buffers.get(name)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = self._buffers[name] = np.empty(shape, dtype=dtype)
+        return buf
+
+    def _ufunc(self, name, ufunc, *operands, dtype=None):
+        # applies `ufunc` to `operands` writing to the work buffer `name`. By
+        # default, the buffer gets the data type that `ufunc` would return,
+        # so that the results are exactly the same as without `out`
+        if dtype is None:
+            dtype = np.result_type(*operands)
+        return ufunc(
+            *operands,
+            out=self._buffer(name,
+                             np.broadcast(*operands).shape, dtype))
+
+    def _mask(self, name, ufunc, *operands):
+        return self._ufunc(name, ufunc, *operands, dtype=bool)
+
+    def _phase(self, phase, step=None, num_steps=1):
+        # context manager that reports the phase to the profiler, if any
+        # (see `profiling.PHASES`)
+        if self.profiler is None:
+            return profiling.NULL_PHASE
+        return profiling._Phase(self.profiler, phase, step, num_steps)
+
+    # this is the STREAM model's core. ACHTUNG: all the arrays must only have
+    # the values of the simulated pixels (see `_to_domain`). The parameters
+    # and state variables can have extra leading dimensions (e.g., one for
+    # each member of an ensemble), in which case everything is broadcast. The
+    # state variables are updated in place and all the intermediate results
+    # are written to preallocated work buffers (see `_buffer`), so that no
+    # arrays are allocated at each step. The outflow is written to `out` if
+    # provided, otherwise to a work buffer that is overwritten at the next
+    # step. Using `np.copyto(..., where=...)` to select values instead of
+    # boolean-mask scatters keeps the results identical to the expressions
+    # in the comments
+    def _water_balance(self, state, parameters, prec_i, temp_i,
+                       year_heat_index, year_alpha, daylight_hours=12,
+                       out=None):
+        if self.engine == 'numba':
+            return self._water_balance_numba(state, parameters, prec_i,
+                                             temp_i, year_heat_index,
+                                             year_alpha, daylight_hours, out)
+
+        snow_accum, available_water, ground_water = state
 
         # SNOW
-        # snow accumulation from the previous iteration
-        snow_accum_prev = self.snow_accum
-        # Snow
-        snowfall_i = np.copy(prec_i)  # [kg]
-        # at high temp no snow
-        snowfall_i[temp_i > self.TEMP_SNOW_FALL] = 0
+        # Snow: at high temp no snow
+        # snowfall_i = np.where(temp_i > TEMP_SNOW_FALL, 0, prec_i)  # [kg]
+        high_temp = self._mask('high_temp', np.greater, temp_i,
+                               parameters['TEMP_SNOW_FALL'])
+        snowfall_i = self._buffer('snowfall', high_temp.shape,
+                                  np.result_type(0, prec_i))
+        np.copyto(snowfall_i, prec_i)
+        np.copyto(snowfall_i, 0, where=high_temp)
         # add snow accumulated from previous iterations (months)
-        snow_accum_i = snow_accum_prev + snowfall_i  # [kg]
-        # how much snow would melt at each pixel given its temperature
-        # ACHTUNG: use maximum temperature here
-        snow_melt_i = self.SNOW_MELT_COEFF * (temp_i - self.TEMP_SNOW_MELT
-                                              )  # [kg]
-        # at low temp no snow melts ACHTUNG: use maximum temperature here
-        snow_melt_i[temp_i < self.TEMP_SNOW_MELT] = 0
+        np.add(snow_accum, snowfall_i, out=snow_accum)  # [kg]
+        # how much snow would melt at each pixel given its temperature, at
+        # low temp no snow melts ACHTUNG: use maximum temperature here
+        # snow_melt_i = np.where(temp_i < TEMP_SNOW_MELT, 0,
+        #                        SNOW_MELT_COEFF * (temp_i - TEMP_SNOW_MELT))
+        snow_melt_i = self._ufunc(
+            'snow_melt', np.multiply, parameters['SNOW_MELT_COEFF'],
+            self._ufunc('melt_temp', np.subtract, temp_i,
+                        parameters['TEMP_SNOW_MELT']))  # [kg]
+        np.copyto(
+            snow_melt_i, 0,
+            where=self._mask('low_temp', np.less, temp_i,
+                             parameters['TEMP_SNOW_MELT']))
         # no more snow can melt than the snow that there actually is
-        snow_melt_i = np.minimum(snow_accum_i, snow_melt_i)
-        # substract the melted snow from the snow accumulation
-        snow_accum_i = snow_accum_i - snow_melt_i
+        snow_melt_i = self._ufunc('actual_snow_melt', np.minimum, snow_accum,
+                                  snow_melt_i)
+        # substract the melted snow from the snow accumulation (i.e., the
+        # snow accumulation for next iteration)
+        np.subtract(snow_accum, snow_melt_i, out=snow_accum)
         # this is the actual input of liquid water per pixel
-        liquid_prec_i = prec_i - snowfall_i + snow_melt_i
-        # update snow accumulation for next iteration
-        self.snow_accum = snow_accum_i
+        # liquid_prec_i = prec_i - snowfall_i + snow_melt_i
+        liquid_prec_i = self._ufunc(
+            'liquid_prec', np.add,
+            self._ufunc('rain', np.subtract, prec_i, snowfall_i), snow_melt_i)
 
         # POTENTIAL EVAPOTRANSPIRATION (Thornthwaite)
-        pe_i = np.full_like(temp_i, np.nan)
-        high_temp_cond = temp_i >= 26.5
-        pe_i[high_temp_cond] = -415.85 + 32.24 * temp_i[high_temp_cond] - \
-            .43 * temp_i[high_temp_cond]**2
-        mid_temp_cond = (temp_i > 0) & (temp_i < 26.5)
-        pe_i[mid_temp_cond] = 16 * (
-            (10 * (temp_i[mid_temp_cond] / year_heat_index[mid_temp_cond]))
-            ** year_alpha[mid_temp_cond])  # yapf: disable
-        pe_i[temp_i <= 0] = 0
-        pe_i *= (daylight_hours / 12) * self.cropf * self.CROPF_COEFF
+        # pe_i = np.select(
+        #     [temp_i >= 26.5, temp_i > 0, temp_i <= 0],
+        #     [-415.85 + 32.24 * temp_i - .43 * temp_i**2,
+        #      16 * ((10 * (temp_i / year_heat_index))**year_alpha), 0],
+        #     np.nan)
+        pe_high = self._ufunc('pe_high', np.multiply, 32.24, temp_i)
+        np.add(-415.85, pe_high, out=pe_high)
+        pe_high_sq = self._ufunc('pe_high_sq', np.square, temp_i)
+        np.multiply(.43, pe_high_sq, out=pe_high_sq)
+        np.subtract(pe_high, pe_high_sq, out=pe_high)
+        # ACHTUNG: the expression of each temperature range is evaluated at
+        # every pixel, e.g., the mid-temperature one where the heat index is
+        # zero, so we need to ignore the floating point errors
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pe_mid = self._ufunc('pe_mid_ratio', np.divide, temp_i,
+                                 year_heat_index)
+            np.multiply(10, pe_mid, out=pe_mid)
+            pe_mid = self._ufunc('pe_mid', np.power, pe_mid, year_alpha)
+            np.multiply(16, pe_mid, out=pe_mid)
+        # like `np.select`, the choices (and default) are converted to arrays
+        # to determine the data type
+        pe_i = self._buffer(
+            'pe',
+            np.broadcast(pe_high, pe_mid).shape,
+            np.result_type(pe_high, pe_mid, np.asarray(0),
+                           np.asarray(np.nan)))
+        pe_i.fill(np.nan)
+        np.copyto(pe_i, 0,
+                  where=self._mask('pe_cond', np.less_equal, temp_i, 0))
+        np.copyto(pe_i, pe_mid,
+                  where=self._mask('pe_cond', np.greater, temp_i, 0))
+        np.copyto(pe_i, pe_high,
+                  where=self._mask('pe_cond', np.greater_equal, temp_i, 26.5))
+        # pe_i = pe_i * ((daylight_hours / 12) * cropf * CROPF_COEFF)
+        pe_i = self._ufunc(
+            'actual_pe', np.multiply, pe_i,
+            self._ufunc(
+                'pe_factor', np.multiply,
+                self._ufunc('daylight_cropf', np.multiply,
+                            daylight_hours / 12, self._cropf),
+                parameters['CROPF_COEFF']))
 
         # SOIL STORAGE (Thornthwaite-Mather)
-        # here we use two copies of the water available at the end of the last
-        # iteration, and update it for the next iteration. We could also
-        # update it in a piecewise manner according to whether the soil is
-        # wetting above/below capacity or drying, avoiding to create the
-        # `avaiable_water_i` variable as in:
-        # self.available_water[below_cap] = available_water_prev[below_cap] + \
-        #    prec_eff_i[below_cap]
-        # self.available_water[above_cap] = whc[above_cap]
-        # available_water_i[drying] = available_water_prev[drying] * np.exp(
-        #    prec_eff_i[drying] / whc[drying])
-        # but I think it is better to update the state variables in one and
-        # only one line
-        available_water_prev = np.copy(self.available_water)
-        available_water_i = np.copy(self.available_water)
+        # the water available at the end of the last iteration is updated in
+        # a piecewise manner according to whether the soil is wetting
+        # below/above capacity or drying
         # this is the effective precipitation at each pixel
-        prec_eff_i = liquid_prec_i - pe_i
+        prec_eff_i = self._ufunc('prec_eff', np.subtract, liquid_prec_i,
+                                 pe_i)
         # water holding capacity at each pixel
-        whc = self.whc * self.WHC_COEFF
-        # start array of zeros with excess at each pixel
-        excess_i = np.zeros_like(prec_eff_i)
-        # soil is wetting below capacity
-        below_cap = available_water_prev + prec_eff_i <= whc
-        excess_i[below_cap] = 0
-        available_water_i[below_cap] = available_water_prev[below_cap] + \
-            prec_eff_i[below_cap]
-        # soil is wetting above capacity
-        above_cap = available_water_prev + prec_eff_i > whc
-        excess_i[above_cap] = available_water_prev[above_cap] + \
-            prec_eff_i[above_cap] - whc[above_cap]
-        available_water_i[above_cap] = whc[above_cap]
+        whc = self._ufunc('whc', np.multiply, self._whc,
+                          parameters['WHC_COEFF'])
+        wetting_i = self._ufunc('wetting', np.add, available_water,
+                                prec_eff_i)
+        # soil is wetting below capacity (no excess), soil is wetting above
+        # capacity (excess over whc)
+        below_cap = self._mask('below_cap', np.less_equal, wetting_i, whc)
+        above_cap = self._mask('above_cap', np.greater, wetting_i, whc)
+        # excess_i = np.where(above_cap, wetting_i - whc, 0)
+        excess_i = self._ufunc('excess', np.subtract, wetting_i, whc)
+        np.copyto(excess_i, 0,
+                  where=self._mask('not_above_cap', np.logical_not,
+                                   above_cap))
         # soil is drying
-        drying = prec_eff_i <= 0
-        excess_i[drying] = 0
-        available_water_i[drying] = available_water_prev[drying] * np.exp(
-            prec_eff_i[drying] / whc[drying])
-        # update available water for next iteration
-        self.available_water = available_water_i
+        drying = self._mask('drying', np.less_equal, prec_eff_i, 0)
+        # excess_i = np.where(drying, 0, excess_i)
+        np.copyto(excess_i, 0, where=drying)
+        # available_water_i = np.where(
+        #     drying, available_water_prev * np.exp(prec_eff_i / whc),
+        #     np.where(below_cap, wetting_i,
+        #              np.where(above_cap, whc, available_water_prev)))
+        with np.errstate(over='ignore', invalid='ignore'):
+            drying_water = self._ufunc('drying_water', np.divide, prec_eff_i,
+                                       whc)
+            np.exp(drying_water, out=drying_water)
+            drying_water = self._ufunc('drying_available_water',
+                                       np.multiply, available_water,
+                                       drying_water)
+        np.copyto(available_water, whc, where=above_cap)
+        np.copyto(available_water, wetting_i, where=below_cap)
+        np.copyto(available_water, drying_water, where=drying)
 
         # FLOW SEPARATION
         # separate soil excess that goes to ground water (recharge) and runoff
-        runoff_i = (1 - self.TOGW) * excess_i
-        to_ground_water_i = excess_i - runoff_i
-        ground_water_i = self.ground_water + to_ground_water_i
+        runoff_i = self._ufunc('runoff', np.multiply, 1 - parameters['TOGW'],
+                               excess_i)
+        to_ground_water_i = self._ufunc('to_ground_water', np.subtract,
+                                        excess_i, runoff_i)
+        np.add(ground_water, to_ground_water_i, out=ground_water)
         # separate ground water that goes to the base flow (discharge)
-        base_flow_i = ground_water_i * self.C
-        # update ground water for the next iteration
-        self.ground_water = ground_water_i - base_flow_i
+        base_flow_i = self._ufunc('base_flow', np.multiply, ground_water,
+                                  parameters['C'])
+        # ground water for the next iteration
+        np.subtract(ground_water, base_flow_i, out=ground_water)
         # total outflow (snow melt + runoff + base flow) at each pixel (divide
         # by 1000 to convert from liters to m^3)
-        outflow_i = runoff_i + base_flow_i
-        outflow_i = (outflow_i / 1000) * self.res[0] * self.res[1]
+        if out is None:
+            out = self._buffer('outflow', runoff_i.shape,
+                               np.result_type(runoff_i, base_flow_i))
+        np.add(runoff_i, base_flow_i, out=out)
+        np.divide(out, 1000, out=out)
+        np.multiply(out, self.res[0], out=out)
+        np.multiply(out, self.res[1], out=out)
+
+        return state, out
+
+    def _water_balance_numba(self, state, parameters, prec_i, temp_i,
+                             year_heat_index, year_alpha, daylight_hours,
+                             out):
+        # same as `_water_balance` but with the compiled kernel, which works
+        # with (num_members, num_pixels) views of the arrays. ACHTUNG: the
+        # results might differ from the 'numpy' engine by rounding errors
+        from . import kernels
+
+        domain_shape = self._cropf.shape
+        full_shape = state[0].shape
+        flat_shape = (int(np.prod(full_shape[:len(full_shape) -
+                                             len(domain_shape)])), -1)
+        if out is None:
+            out = self._buffer('outflow', full_shape, np.double)
+
+        def members_view(arr):
+            # the heat index and alpha might be scalars, rasters or
+            # (num_members, ) + rasters
+            return np.broadcast_to(arr, full_shape).reshape(flat_shape)
+
+        kernel_parameters = self._buffer('kernel_parameters',
+                                         (flat_shape[0], len(
+                                             kernels.PARAMETERS)), np.double)
+        for j, parameter in enumerate(kernels.PARAMETERS):
+            kernel_parameters[:, j] = np.ravel(parameters[parameter])
+
+        kernels.water_balance_kernel(
+            *[state_arr.reshape(flat_shape) for state_arr in state],
+            out.reshape(flat_shape), np.ravel(prec_i), np.ravel(temp_i),
+            np.ravel(self._cropf), np.ravel(self._whc),
+            members_view(year_heat_index), members_view(year_alpha),
+            kernel_parameters, daylight_hours / 12,
+            float(self.res[0] * self.res[1]))
+
+        return state, out
+
+    def _water_balance_step(self, prec_i, temp_i, year_heat_index, year_alpha,
+                            daylight_hours=12):
+        # ACHTUNG: the returned outflow is a work buffer
+        _, outflow_i = self._water_balance(
+            (self._snow_accum, self._available_water, self._ground_water),
+            self.parameters, prec_i, temp_i, year_heat_index, year_alpha,
+            daylight_hours)
+
+        return outflow_i
+
+    def _simulation_step(self, prec_i, temp_i, year_heat_index, year_alpha,
+                         daylight_hours=12):
+        outflow_i = self._water_balance_step(prec_i, temp_i, year_heat_index,
+                                             year_alpha, daylight_hours)
+
+        if self.gauges is not None:
+            # flow at each gauge
+            return self._gauge_matrix.dot(outflow_i)
 
         # FLOW ACCUMULATION
         # weighted flow accumulation to simulate the spatially-explicit stream
-        # flow
-        streamflow_i = richdem.FlowAccumulation(
-            self.dem, method='D8', weights=outflow_i.astype(np.double))
+        # flow (equivalent to `richdem.FlowAccumulation` with the D8 method)
+        # (the pixels that are not simulated do not generate any outflow)
+        streamflow_i = self.routing.accumulate(
+            self._to_raster(outflow_i, fill_value=0))
 
         # Assume that maximum flow corresponds to the gauge station
         gauge_flow_i = streamflow_i.max().item()
 
         return gauge_flow_i
 
-    def simulate(self, heat_index=None, alpha=None):
+    def _iter_heat_index_alpha(self, heat_index=None, alpha=None,
+                               heat_coeff=None):
+        # iterator that yields the heat index and alpha of each month
+        if heat_index is not None:
+            if alpha is None:
+                alpha = MonthlySimulation._compute_alpha(heat_index)
+
+            # the heat index and alpha can be scalars or rasters, so they are
+            # broadcast to the rasters before taking the simulated pixels
+            yield from itertools.repeat(
+                (self._to_domain(np.broadcast_to(heat_index, self.dem.shape)),
+                 self._to_domain(np.broadcast_to(alpha, self.dem.shape))),
+                self.num_months)
+        else:
+            if heat_coeff is None:
+                heat_coeff = self.HEAT_COEFF
+
+            if np.ndim(heat_coeff) == 0:
+                yearly_heat_index, yearly_alpha = \
+                    self._get_yearly_heat_index_alpha(heat_coeff)
+                for year_heat_index, year_alpha in zip(yearly_heat_index,
+                                                       yearly_alpha):
+                    yield from itertools.repeat(
+                        (year_heat_index, year_alpha), 12)
+            else:
+                # the coefficient has extra leading dimensions (e.g., one for
+                # each member of an ensemble), so we scale the heat index
+                # year by year to avoid storing it for every member and year
+                for year_heat_index in self._get_yearly_heat_index():
+                    year_heat_index = year_heat_index * heat_coeff
+                    year_alpha = MonthlySimulation._compute_alpha(
+                        year_heat_index)
+                    yield from itertools.repeat(
+                        (year_heat_index, year_alpha), 12)
+            # ACHTUNG: the heat index of a year can only be computed once all
+            # its months are available, so the months of an incomplete year
+            # at the end of the record (see `append_months`) get the heat
+            # index and alpha of the last complete year
+            if self.num_months % 12 != 0:
+                yield from itertools.repeat((year_heat_index, year_alpha),
+                                            self.num_months % 12)
+
+    def _get_yearly_heat_index(self):
+        # Calculate yearly heat index (without the coefficient) using
+        # Thornthwaite's equation for all the years at once, i.e., a (years,
+        # ...) array with the values of the simulated pixels. It only depends
+        # on the temperature, so it is computed once and cached (and when
+        # months are appended, it is only computed for the new years). The
+        # temperature is read year by year, so that memory usage does not
+        # grow with the length of the record beyond the (years, ...) result
+        num_years = self.num_months // 12
+        if self._yearly_heat_index is None:
+            first_year = 0
+        else:
+            first_year = len(self._yearly_heat_index)
+        if first_year < num_years:
+            yearly_heat_index = None
+            for year in range(first_year, num_years):
+                temp = self._get_temp(year * 12, (year + 1) * 12)
+
+                # negative temperatures result in NaN, which must be ignored
+                with np.errstate(invalid='ignore'):
+                    monthly_heat_index = (temp / 5)**1.514
+                monthly_heat_index[np.isnan(monthly_heat_index)] = 0
+                if yearly_heat_index is None:
+                    # the data type follows the one of the temperature
+                    yearly_heat_index = np.empty(
+                        (num_years - first_year, ) +
+                        monthly_heat_index.shape[1:],
+                        dtype=monthly_heat_index.dtype)
+                monthly_heat_index.sum(
+                    axis=0, out=yearly_heat_index[year - first_year])
+            if self._yearly_heat_index is not None:
+                yearly_heat_index = np.concatenate(
+                    [self._yearly_heat_index, yearly_heat_index])
+            self._yearly_heat_index = yearly_heat_index
 
-        # iterator that yields the monthly daylight hours
+        return self._yearly_heat_index
+
+    def _get_yearly_heat_index_alpha(self, heat_coeff):
+        # yearly heat index (with the coefficient) and alpha, which are cached
+        # for the last coefficient used so that repeated simulations (e.g.,
+        # calibrating other parameters) can reuse them
+        yearly_heat_index = self._get_yearly_heat_index()
+        if self._heat_index_alpha_cache is None or \
+           self._heat_index_alpha_cache[0] != heat_coeff:
+            yearly_heat_index = yearly_heat_index * heat_coeff
+            self._heat_index_alpha_cache = (
+                heat_coeff, yearly_heat_index,
+                MonthlySimulation._compute_alpha(yearly_heat_index))
+        elif len(self._heat_index_alpha_cache[1]) < len(yearly_heat_index):
+            # only compute the years that have been appended
+            _, cached_heat_index, cached_alpha = self._heat_index_alpha_cache
+            new_heat_index = yearly_heat_index[len(cached_heat_index):] * \
+                heat_coeff
+            self._heat_index_alpha_cache = (
+                heat_coeff,
+                np.concatenate([cached_heat_index, new_heat_index]),
+                np.concatenate([
+                    cached_alpha,
+                    MonthlySimulation._compute_alpha(new_heat_index)
+                ]))
+
+        return self._heat_index_alpha_cache[1:]
+
+    def _get_monthly_daylight_hours(self):
         try:
-            daylight_hours_pool = itertools.cycle(self.monthly_daylight_hours)
+            return self.monthly_daylight_hours
         except AttributeError:
             # if the monthly daylight hours were not provided, we assert that
             # in every month, every day has 12 hours of light
-            daylight_hours_pool = itertools.cycle([12])
+            return [12]
 
-        gauge_flow = np.zeros(self.num_months)
+    def _simulate(self, state, parameters, heat_index_alpha_pool,
+                  routing_batch_size, members_shape=(), start=0, end=None,
+                  recorders=()):
+        # runs the simulation of the months from `start` to `end` (by default,
+        # the whole record) from `state`, which might have extra leading
+        # dimensions `members_shape` (e.g., one for each member of an
+        # ensemble), and returns the final state and the gauge flow, with
+        # shape `(num_steps, ) + members_shape` or `(num_steps, ) +
+        # members_shape + (num_gauges, )` in gauge mode. The
+        # `heat_index_alpha_pool` must start at the first month of the record.
+        # The fields of each step are passed to the `recorders` (see
+        # `outputs.StepWriter` and `accumulators._AccumulatorRecorder`)
+        if end is None:
+            end = self.num_months
+        num_steps = end - start
+        heat_index_alpha_pool = itertools.islice(heat_index_alpha_pool,
+                                                 start, None)
 
-        if heat_index is not None:
-            if alpha is None:
-                alpha = MonthlySimulation._compute_alpha(heat_index)
+        # iterator that yields the monthly daylight hours (the position in the
+        # daylight cycle is the one of the first simulated month)
+        daylight_hours_pool = itertools.islice(
+            itertools.cycle(self._get_monthly_daylight_hours()), start, None)
+        climate_pool = self._iter_climate(start, end)
 
-            for i in range(self.num_months):
-                gauge_flow[i] = self._simulation_step(
-                    self.prec_ds.isel(time=i)[self.prec_varname].values,
-                    self.temp_ds.isel(time=i)[self.temp_varname].values,
-                    heat_index, alpha, next(daylight_hours_pool))
+        # The water balance of each month only depends on the previous one,
+        # but the flow accumulation is linear in the outflow of each pixel, so
+        # the monthly outflows are first computed for a batch of months and
+        # then routed together with a single multiple right-hand side solve.
+        # ACHTUNG: the outflow (and streamflow) of a batch is stored as a
+        # (months, height, width) array, so the batches are bounded (by
+        # default, to `ROUTING_BATCH_SIZE` months) so that memory usage does
+        # not grow with the length of the record
+        if routing_batch_size is None:
+            routing_batch_size = self.ROUTING_BATCH_SIZE
+        if routing_batch_size < 1:
+            raise ValueError("The routing batch size must be at least 1")
+        outflow = np.empty((min(routing_batch_size, num_steps), ) +
+                           members_shape + self._cropf.shape)
+
+        if self.gauges is None:
+            gauge_flow = np.zeros((num_steps, ) + members_shape)
         else:
-            # Calculate yearly heat index and alpha using Thornthwaite's
-            # equation
-            num_years = self.num_months // 12
-            if self.num_months % 12 != 0:
-                raise ValueError(
-                    "The heat index can only be computed for an entire year! "
-                    "Ensure that your climatological datasets start have a "
-                    "number of months that is multiple of 12")
-
-            for year in range(num_years):
-                year_first_month = year * 12
-                year_last_month = year_first_month + 12
-                year_temp_ds = self.temp_ds.isel(
-                    time=slice(year_first_month, year_last_month))
-
-                year_heat_index = year_temp_ds[self.temp_varname] \
-                    .groupby('time').apply(lambda temp: (temp / 5) ** 1.514) \
-                    .fillna(0).sum('time').values
-                # in this case, use the coefficient
-                year_heat_index *= self.HEAT_COEFF
-
-                year_alpha = MonthlySimulation._compute_alpha(year_heat_index)
-
-                for i in range(year_first_month, year_last_month):
-                    gauge_flow[i] = self._simulation_step(
-                        self.prec_ds.isel(time=i)[self.prec_varname].values,
-                        self.temp_ds.isel(time=i)[self.temp_varname].values,
-                        year_heat_index, year_alpha, next(daylight_hours_pool))
+            gauge_flow = np.zeros((num_steps, ) + members_shape +
+                                  (len(self.gauges), ))
+
+        for batch_start in range(start, end, routing_batch_size):
+            batch_end = min(batch_start + routing_batch_size, end)
+            batch_outflow = outflow[:batch_end - batch_start]
+            batch_gauge_flow = gauge_flow[batch_start - start:batch_end -
+                                          start]
+
+            # WATER BALANCE
+            for i in range(batch_start, batch_end):
+                with self._phase('heat_index', i):
+                    year_heat_index, year_alpha = next(heat_index_alpha_pool)
+                with self._phase('climate', i) as phase:
+                    prec_i, temp_i = next(climate_pool)
+                    phase.nbytes = prec_i.nbytes + temp_i.nbytes
+                with self._phase('water_balance', i) as phase:
+                    self._water_balance(state, parameters, prec_i, temp_i,
+                                        year_heat_index, year_alpha,
+                                        next(daylight_hours_pool),
+                                        out=outflow[i - batch_start])
+                    phase.nbytes = outflow[i - batch_start].nbytes
+                if recorders:
+                    with self._phase('outputs', i):
+                        for recorder in recorders:
+                            self._write_water_balance_fields(
+                                recorder, i - start, state)
+
+            streamflow_recorders = [
+                recorder for recorder in recorders
+                if 'streamflow' in recorder.fields
+            ]
+            with self._phase('routing', batch_start,
+                             batch_end - batch_start) as phase:
+                phase.nbytes = batch_outflow.nbytes
+                if self.gauges is None or streamflow_recorders:
+                    # FLOW ACCUMULATION
+                    # (the pixels that are not simulated do not generate any
+                    # outflow)
+                    streamflow = self.routing.accumulate_many(
+                        self._to_raster(batch_outflow, fill_value=0).reshape(
+                            (-1, ) + self.dem.shape))
+
+                if self.gauges is None:
+                    # Assume that maximum flow corresponds to the gauge
+                    # station
+                    batch_gauge_flow[:] = streamflow.reshape(
+                        batch_gauge_flow.shape + (-1, )).max(axis=-1)
+                else:
+                    # the flow at each gauge is the sum of the outflow of its
+                    # upstream pixels
+                    batch_gauge_flow[:] = self._gauge_matrix.dot(
+                        batch_outflow.reshape(
+                            -1, self._pixels.size).T).T.reshape(
+                                batch_gauge_flow.shape)
+
+            if streamflow_recorders:
+                with self._phase('outputs', batch_start,
+                                 batch_end - batch_start):
+                    for i, streamflow_i in enumerate(streamflow, batch_start):
+                        for recorder in streamflow_recorders:
+                            recorder.write('streamflow', i - start,
+                                           self._to_domain(streamflow_i))
 
         # from m^3 to m^3/s
         gauge_flow /= self.TIME_STEP
 
+        return state, gauge_flow
+
+    # work buffers (see `_water_balance`) of the fields that can be recorded at
+    # each step, besides the state variables
+    _WATER_BALANCE_FIELD_BUFFERS = {
+        'pe': 'actual_pe',
+        'excess': 'excess',
+        'runoff': 'runoff',
+        'base_flow': 'base_flow'
+    }
+
+    def _write_water_balance_fields(self, recorder, i, state):
+        for field in recorder.fields:
+            if field in ['snow_accum', 'available_water', 'ground_water']:
+                recorder.write(field, i, state[[
+                    'snow_accum', 'available_water', 'ground_water'
+                ].index(field)])
+            elif field in MonthlySimulation._WATER_BALANCE_FIELD_BUFFERS:
+                recorder.write(
+                    field, i, self._buffers[
+                        MonthlySimulation._WATER_BALANCE_FIELD_BUFFERS[field]])
+
+    def _check_heat_index(self, heat_index):
+        # ACHTUNG: only the record of the datasets must have entire years,
+        # since the months of an incomplete year appended to it (see
+        # `append_months`) get the heat index of the last complete year
+        if heat_index is None and self._num_record_months % 12 != 0:
+            raise ValueError(
+                "The heat index can only be computed for an entire year! "
+                "Ensure that your climatological datasets start have a "
+                "number of months that is multiple of 12")
+
+    def simulate(self, heat_index=None, alpha=None, routing_batch_size=None,
+                 start=0, end=None, output_filepath=None,
+                 output_fields=('streamflow', ), output_queue_size=2,
+                 accumulators=None):
+        # Simulates the months from `start` to `end` (by default, the whole
+        # record) from the current state variables. To resume a simulation
+        # from a snapshot (see `save_state` and `load_state`), use
+        # `start=self.step`.
+        #
+        # If `output_filepath` is provided, the `output_fields` (see
+        # `OUTPUT_FIELDS`) of each month are written, as (time, y, x) rasters
+        # with NaN at the pixels that are not simulated, to a NetCDF file
+        # ('.nc') or a Zarr store ('.zarr') by a background thread, with at
+        # most `output_queue_size` fields waiting to be written. ACHTUNG: the
+        # streamflow rasters of a whole routing batch are computed at once, so
+        # when the streamflow is recorded (in the outputs or the
+        # accumulators), the routing batches default to a single month so
+        # that memory usage is bounded to a couple of months.
+        #
+        # If `accumulators` are provided (see the `accumulators` module), they
+        # are updated with the fields of each month and their per-pixel
+        # statistics are returned (after the gauge flow) as an
+        # `xarray.Dataset` aligned with the rasters
+        self._check_heat_index(heat_index)
+        if end is None:
+            end = self.num_months
+        if not 0 <= start <= end <= self.num_months:
+            raise ValueError(
+                "The simulated months must satisfy 0 <= start <= end <= "
+                f"{self.num_months}")
+
+        recorded_fields = []
+        if accumulators is not None:
+            recorded_fields += [
+                getattr(accumulator, 'field', None)
+                for accumulator in accumulators
+            ]
+        if output_filepath is not None:
+            recorded_fields += list(output_fields)
+        if self.engine == 'numba' and any(
+                field in MonthlySimulation._WATER_BALANCE_FIELD_BUFFERS
+                for field in recorded_fields):
+            raise ValueError(
+                "With the 'numba' engine, only the state variables and the "
+                "streamflow can be recorded")
+        if routing_batch_size is None and 'streamflow' in recorded_fields:
+            routing_batch_size = 1
+
+        recorders = []
+        if accumulators is not None:
+            recorders.append(
+                _accumulators._AccumulatorRecorder(accumulators,
+                                                   self._cropf.shape))
+        if output_filepath is not None:
+            recorders.append(
+                outputs.StepWriter(output_filepath, output_fields,
+                                   np.arange(start, end), self.dem.shape,
+                                   self._to_raster,
+                                   queue_size=output_queue_size))
+
+        try:
+            (self._snow_accum, self._available_water,
+             self._ground_water), gauge_flow = self._simulate(
+                 (self._snow_accum, self._available_water,
+                  self._ground_water), self.parameters,
+                 self._iter_heat_index_alpha(heat_index, alpha),
+                 routing_batch_size, start=start, end=end,
+                 recorders=recorders)
+        finally:
+            for recorder in recorders:
+                recorder.close()
+        self.step = end
+
         # set it as class attribute in case they want to plot it later
         self.gauge_flow = gauge_flow
 
+        if accumulators is not None:
+            return gauge_flow, self._get_summary_ds(accumulators)
+        return gauge_flow
+
+    def _get_summary_ds(self, accumulators):
+        # dataset with the statistics of the accumulators as rasters, with the
+        # spatial dimensions and coordinates of the climatological data
+        da = self.prec_ds[self.prec_varname]
+        spatial_dims = [dim for dim in da.dims if dim != 'time']
+        if self._regridding_matrix is None:
+            coords = {
+                name: coord
+                for name, coord in da.coords.items()
+                if set(coord.dims) <= set(spatial_dims)
+            }
+        else:
+            # the coordinates of the rasters' grid
+            coords = dict(zip(spatial_dims, self._get_raster_coords()))
+        summary_ds = xr.Dataset(coords=coords)
+        for accumulator in accumulators:
+            summary_ds = summary_ds.assign_coords(accumulator.coords())
+            for name, values in accumulator.result().items():
+                raster = self._to_raster(values.astype(np.double))
+                summary_ds[name] = (list(accumulator.dims) + spatial_dims,
+                                    raster)
+        return summary_ds
+
+    def append_months(self, prec, temp, heat_index=None, alpha=None,
+                      routing_batch_size=None):
+        # Operational mode: appends new months of climatological data to the
+        # record, simulates only these months from the current state
+        # variables and appends their flow to `gauge_flow`, so that the cost
+        # of an update only depends on the number of new months. `prec` and
+        # `temp` can be (months, height, width) arrays (or (height, width)
+        # arrays for a single month) or datasets/data arrays like the ones
+        # passed to the constructor. ACHTUNG: the new months are not added
+        # to `prec_ds` and `temp_ds`
+        if self.step != self.num_months:
+            raise ValueError(
+                "The whole record must be simulated (see `simulate`) before "
+                "appending new months")
+        if heat_index is None and self.num_months < 12:
+            raise ValueError(
+                "The heat index of the new months can only be computed if "
+                "the record has at least an entire year! Otherwise, provide "
+                "the heat index")
+
+        new_climate = []
+        for new_data, varname in [(prec, self.prec_varname),
+                                  (temp, self.temp_varname)]:
+            if isinstance(new_data, xr.Dataset):
+                new_data = new_data[varname]
+            if isinstance(new_data, xr.DataArray) and 'time' in new_data.dims:
+                new_data = new_data.transpose(
+                    'time', *[dim for dim in new_data.dims if dim != 'time'])
+            new_data = np.asarray(new_data)
+            if new_data.shape == self._climate_shape:
+                new_data = new_data[np.newaxis]
+            if new_data.shape[1:] != self._climate_shape:
+                raise ValueError(
+                    f"The new months of {varname} must have shape (months, ) "
+                    "+ the shape of the rasters (or of the climatological "
+                    "grid if it is regridded)")
+            # copy the values so that they are not modified from outside
+            new_climate.append(np.array(self._climate_to_domain(new_data)))
+        new_prec, new_temp = new_climate
+        if len(new_prec) != len(new_temp):
+            raise ValueError(
+                "The new months of precipitation and temperature must match")
+
+        start = self.num_months
+        self._appended_climate.extend(zip(new_prec, new_temp))
+        self.num_months += len(new_prec)
+
+        (self._snow_accum, self._available_water,
+         self._ground_water), gauge_flow = self._simulate(
+             (self._snow_accum, self._available_water, self._ground_water),
+             self.parameters, self._iter_heat_index_alpha(heat_index, alpha),
+             routing_batch_size, start=start, end=self.num_months)
+        self.step = self.num_months
+
+        if hasattr(self, 'gauge_flow'):
+            self.gauge_flow = np.concatenate([self.gauge_flow, gauge_flow])
+        else:
+            self.gauge_flow = gauge_flow
+
         return gauge_flow
 
+    # COMPILED INPUTS
+    # Parsing the raster files and the climatological datasets, validating
+    # them and computing the routing can take much longer than simulating a
+    # catchment. Instead, the inputs can be compiled once into a directory of
+    # raw '.npy' files (keyed by a hash of the contents of the sources and of
+    # the loading arguments), from which new simulations are built with
+    # read-only memory maps, i.e., with almost no parsing and sharing the
+    # pages of the files across processes through the page cache
+    @staticmethod
+    def _update_input_hash(key, source):
+        if isinstance(source, str):
+            if os.path.isdir(source):
+                # e.g., zarr stores
+                filepaths = sorted(
+                    os.path.join(dirpath, filename)
+                    for dirpath, _, filenames in os.walk(source)
+                    for filename in filenames)
+            else:
+                filepaths = [source]
+            for filepath in filepaths:
+                key.update(os.path.relpath(filepath, source).encode())
+                with open(filepath, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1 << 20), b''):
+                        key.update(chunk)
+        elif isinstance(source, xr.Dataset):
+            for varname, da in sorted(source.variables.items()):
+                key.update(repr((varname, da.dims, da.dtype.str)).encode())
+                key.update(np.ascontiguousarray(da.values).tobytes())
+        elif isinstance(source, np.ndarray):
+            key.update(repr((source.shape, source.dtype.str)).encode())
+            key.update(np.ascontiguousarray(source).tobytes())
+        else:
+            key.update(repr(source).encode())
+
+    @staticmethod
+    def compile_inputs(cache_dir, dem, cropf, whc, prec, temp,
+                       prec_varname=None, temp_varname=None, res=None,
+                       nodata=-9999, whc_epsilon=.01, decode_times=False,
+                       window=None, mask=None):
+        # Compiles the inputs (with the same meaning as in the constructor)
+        # into a subdirectory of `cache_dir` and returns its path, which can
+        # be passed to `from_compiled_inputs`. If the inputs have already been
+        # compiled, the existing subdirectory is returned right away
+        key = hashlib.sha256()
+        for source in [dem, cropf, whc, prec, temp, mask]:
+            MonthlySimulation._update_input_hash(key, source)
+        if hasattr(window, 'toranges'):
+            # i.e., a `rasterio.windows.Window`
+            window = window.toranges()
+        key.update(
+            repr((prec_varname, temp_varname, res, nodata, whc_epsilon,
+                  decode_times, window)).encode())
+        inputs_dir = os.path.join(cache_dir, key.hexdigest())
+        if os.path.exists(inputs_dir):
+            return inputs_dir
+
+        ms = MonthlySimulation(dem, cropf, whc, prec, temp,
+                               prec_varname=prec_varname,
+                               temp_varname=temp_varname, res=res,
+                               nodata=nodata, whc_epsilon=whc_epsilon,
+                               decode_times=decode_times, window=window,
+                               mask=mask)
+
+        # write to a temporary directory first so that concurrent
+        # compilations never see partially written inputs
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=cache_dir)
+        for name, arr in [('dem', np.asarray(ms.dem)), ('cropf', ms.cropf),
+                          ('whc', ms.whc)] + [
+                              (f'routing_{name}', getattr(ms.routing, name))
+                              for name in routing.D8Routing.ARRAYS
+                          ]:
+            np.save(os.path.join(tmp_dir, f'{name}.npy'), arr)
+
+        # the climatological data is written month by month to bound memory
+        # usage, as (time, rows, cols) arrays
+        metadata = dict(res=[float(r) for r in ms.res],
+                        nodata=float(ms.dem.no_data))
+        if ms.transform is not None:
+            metadata['transform'] = list(ms.transform)[:6]
+        coords = {}
+        for name, ds, varname in [('prec', ms.prec_ds, ms.prec_varname),
+                                  ('temp', ms.temp_ds, ms.temp_varname)]:
+            da = ds[varname]
+            dims = ['time'] + [dim for dim in da.dims if dim != 'time']
+            da = da.transpose(*dims)
+            metadata.update({f'{name}_varname': varname, f'{name}_dims': dims})
+            arr = np.lib.format.open_memmap(
+                os.path.join(tmp_dir, f'{name}.npy'), mode='w+',
+                dtype=da.dtype if np.issubdtype(da.dtype, np.floating) else
+                np.double, shape=da.shape)
+            for i in range(ms.num_months):
+                arr[i] = da.isel(time=i).values
+            arr.flush()
+            del arr
+            for dim in dims:
+                if dim in da.coords:
+                    coords[dim] = da[dim].values
+        for dim, values in coords.items():
+            np.save(os.path.join(tmp_dir, f'coord_{dim}.npy'), values)
+
+        metadata['coords'] = list(coords)
+        with open(os.path.join(tmp_dir, 'metadata.json'), 'w') as f:
+            json.dump(metadata, f)
+
+        try:
+            os.rename(tmp_dir, inputs_dir)
+        except OSError:
+            # another process has compiled the same inputs in the meantime
+            shutil.rmtree(tmp_dir)
+
+        return inputs_dir
+
+    @classmethod
+    def from_compiled_inputs(cls, inputs_dir, **kwargs):
+        # Builds a simulation from the inputs compiled by `compile_inputs`,
+        # where `kwargs` are passed to the constructor (except the ones of
+        # `compile_inputs`, which have already been applied)
+        with open(os.path.join(inputs_dir, 'metadata.json')) as f:
+            metadata = json.load(f)
+
+        def load(name):
+            return np.load(os.path.join(inputs_dir, f'{name}.npy'),
+                           mmap_mode='r')
+
+        coords = {dim: load(f'coord_{dim}') for dim in metadata['coords']}
+        prec_ds, temp_ds = [
+            xr.Dataset(
+                {
+                    metadata[f'{name}_varname']:
+                    (metadata[f'{name}_dims'], load(name))
+                }, coords={
+                    dim: coords[dim]
+                    for dim in metadata[f'{name}_dims'] if dim in coords
+                }) for name in ['prec', 'temp']
+        ]
+        flow_routing = routing.D8Routing.from_arrays(
+            **{name: load(f'routing_{name}')
+               for name in routing.D8Routing.ARRAYS})
+
+        if 'transform' in metadata:
+            from rasterio import Affine
+            kwargs['transform'] = Affine(*metadata['transform'])
+
+        return cls(richdem.rdarray(load('dem'), no_data=metadata['nodata']),
+                   load('cropf'), load('whc'), prec_ds, temp_ds,
+                   res=tuple(metadata['res']), flow_routing=flow_routing,
+                   **kwargs)
+
+    # STATE SNAPSHOTS
+    # The state variables start at zero, which is why the model needs warm-up
+    # months. To avoid simulating them again and again, the state variables
+    # (of the simulated pixels) can be stored to a (compressed) npz file
+    # together with the month from which the simulation must be resumed and
+    # the position in the daylight cycle of such month
+    def save_state(self, filepath):
+        # ACHTUNG: numpy appends the '.npz' extension to `filepath` if it does
+        # not have it
+        np.savez_compressed(
+            filepath, snow_accum=self._snow_accum,
+            available_water=self._available_water,
+            ground_water=self._ground_water, step=self.step,
+            daylight_position=self.step %
+            len(self._get_monthly_daylight_hours()))
+
+    def load_state(self, filepath):
+        with np.load(filepath) as snapshot:
+            state = tuple(snapshot[state_var] for state_var in
+                          ['snow_accum', 'available_water', 'ground_water'])
+            step = snapshot['step'].item()
+            daylight_position = snapshot['daylight_position'].item()
+        for state_arr in state:
+            if state_arr.shape != self._cropf.shape:
+                raise ValueError(
+                    "The state variables of the snapshot must have shape "
+                    f"{self._cropf.shape}, i.e., the simulated pixels")
+        if step > self.num_months or daylight_position != step % len(
+                self._get_monthly_daylight_hours()):
+            raise ValueError(
+                "The step of the snapshot does not match the months and the "
+                "daylight cycle of this simulation")
+        self._snow_accum, self._available_water, self._ground_water = (
+            np.array(state_arr, dtype=np.double) for state_arr in state)
+        self.step = step
+
+    def _get_warm_state_key(self, num_months, heat_index, alpha):
+        # hash of everything that determines the state variables after
+        # simulating the first `num_months` from zero, i.e., the terrain, the
+        # climatological data of these months (and of the whole years that
+        # determine their heat index), the parameters and the simulation
+        # settings
+        key = hashlib.sha256()
+        for arr in [self.dem, self._cropf, self._whc, self._pixels]:
+            if arr is not None:
+                key.update(np.ascontiguousarray(arr).tobytes())
+        num_temp_months = min(-(-num_months // 12) * 12, self.num_months)
+        for i in range(num_temp_months):
+            prec_i, temp_i = self._get_climate(i)
+            if i < num_months:
+                key.update(np.ascontiguousarray(prec_i).tobytes())
+            key.update(np.ascontiguousarray(temp_i).tobytes())
+        for arr in [heat_index, alpha]:
+            if arr is not None:
+                key.update(np.ascontiguousarray(arr).tobytes())
+        key.update(
+            repr((num_months, sorted(self.parameters.items()),
+                  list(self._get_monthly_daylight_hours()), tuple(self.res),
+                  self.engine)).encode())
+        return key.hexdigest()
+
+    def spin_up(self, num_months, heat_index=None, alpha=None,
+                cache_dir=None):
+        # Simulates the first `num_months` from zero state variables, so that
+        # the rest of the record can then be simulated with
+        # `simulate(start=self.step)`. If `cache_dir` is provided, the
+        # resulting state is stored there, keyed by a hash of the inputs and
+        # parameters, so that the spin-up of later simulations with the same
+        # inputs and parameters (e.g., scenario runs) is read from disk
+        # instead of being simulated again
+        if cache_dir is not None:
+            filepath = os.path.join(
+                cache_dir,
+                self._get_warm_state_key(num_months, heat_index, alpha) +
+                '.npz')
+            if os.path.exists(filepath):
+                self.load_state(filepath)
+                return
+
+        domain_shape = self._cropf.shape
+        self._snow_accum = np.zeros(domain_shape, dtype=np.double)
+        self._available_water = np.zeros(domain_shape, dtype=np.double)
+        self._ground_water = np.zeros(domain_shape, dtype=np.double)
+        self.simulate(heat_index=heat_index, alpha=alpha, end=num_months)
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.save_state(filepath)
+
+    def simulate_ensemble(self, parameters, parameter_names=None,
+                          heat_index=None, alpha=None,
+                          routing_batch_size=None):
+        # Simulates an ensemble of N members at once, where `parameters` is an
+        # (N, num_parameters) table (e.g., an array or a pandas data frame)
+        # whose columns are the parameters named in `parameter_names` (by
+        # default, the columns of the data frame or `PARAMETER_NAMES`). The
+        # parameters that are not in the table take the values of this
+        # instance. The state variables of all the members start at zero and
+        # are carried as (N, height, width) arrays, which are not stored in
+        # this instance. Returns the (N, num_months) gauge flow of each member
+        # (or (N, num_months, num_gauges) in gauge mode)
+        self._check_heat_index(heat_index)
+
+        if parameter_names is None:
+            if hasattr(parameters, 'columns'):
+                parameter_names = list(parameters.columns)
+            else:
+                parameter_names = MonthlySimulation.PARAMETER_NAMES
+        parameters = np.asarray(parameters, dtype=np.double)
+        if parameters.ndim != 2 or \
+           parameters.shape[1] != len(parameter_names):
+            raise ValueError(
+                "The parameters must be a table with one column for each of "
+                f"{parameter_names}")
+
+        member_parameters = self.parameters
+        for parameter, values in zip(parameter_names, parameters.T):
+            if parameter not in member_parameters:
+                raise ValueError(f"Parameter {parameter} must be among "
+                                 f"{MonthlySimulation.PARAMETER_NAMES}")
+            # add axes so that the parameters are broadcast to the pixels
+            member_parameters[parameter] = values.reshape(
+                (-1, ) + (1, ) * self._cropf.ndim)
+
+        members_shape = (len(parameters), )
+        state = tuple(
+            np.zeros(members_shape + self._cropf.shape, dtype=np.double)
+            for _ in range(3))
+        heat_index_alpha_pool = self._iter_heat_index_alpha(
+            heat_index, alpha, heat_coeff=member_parameters['HEAT_COEFF'])
+        _, gauge_flow = self._simulate(state, member_parameters,
+                                       heat_index_alpha_pool,
+                                       routing_batch_size,
+                                       members_shape=members_shape)
+
+        # put the members axis first
+        return np.moveaxis(gauge_flow, 0, 1)
+
     def plot_gauge_flow(self, obs_gauge_flow=None, num_warmup_months=6,
                         **kwargs):
+        from . import plotting
         return plotting.plot_gauge_flow(
             self.gauge_flow, obs_gauge_flow=obs_gauge_flow,
             num_warmup_months=num_warmup_months, **kwargs)
@@ -0,0 +1,137 @@
+import queue
+import threading
+
+import numpy as np
+
+__all__ = ['OUTPUT_FIELDS']
+
+# fields that can be recorded at each step of a simulation: the state
+# variables, the potential evapotranspiration, the soil excess, the runoff and
+# the base flow (all of them at the end of the month) and the streamflow
+# raster of the flow accumulation
+OUTPUT_FIELDS = [
+    'snow_accum', 'available_water', 'ground_water', 'pe', 'excess',
+    'runoff', 'base_flow', 'streamflow'
+]
+
+
+class _NetCDFStore:
+    def __init__(self, filepath, fields, num_steps, shape, dtype):
+        import netCDF4
+
+        self._ds = netCDF4.Dataset(filepath, mode='w')
+        self._ds.createDimension('time', num_steps)
+        self._ds.createDimension('y', shape[0])
+        self._ds.createDimension('x', shape[1])
+        self._vars = {
+            field: self._ds.createVariable(field, dtype, ('time', 'y', 'x'),
+                                           chunksizes=(1, ) + shape,
+                                           fill_value=np.nan)
+            for field in fields
+        }
+        self.time = self._ds.createVariable('time', np.int64, ('time', ))
+
+    def write(self, field, i, raster):
+        self._vars[field][i] = raster
+
+    def close(self):
+        self._ds.close()
+
+
+class _ZarrStore:
+    def __init__(self, filepath, fields, num_steps, shape, dtype):
+        import zarr
+
+        # ACHTUNG: use the version 2 format (whose dimension names xarray can
+        # read with any version of zarr), which must be requested explicitly
+        # with zarr >= 3
+        if int(zarr.__version__.split('.')[0]) >= 3:
+            format_kws = dict(zarr_format=2)
+        else:
+            format_kws = {}
+        zarr.open_group(filepath, mode='w', **format_kws)
+
+        def create_array(name, shape, chunks, dtype, fill_value, dims):
+            arr = zarr.open_array(filepath, path=name, mode='w', shape=shape,
+                                  chunks=chunks, dtype=dtype,
+                                  fill_value=fill_value, **format_kws)
+            # so that xarray can open the store
+            arr.attrs['_ARRAY_DIMENSIONS'] = dims
+            return arr
+
+        self._arrs = {
+            field: create_array(field, (num_steps, ) + shape,
+                                (1, ) + shape, dtype, np.nan,
+                                ['time', 'y', 'x'])
+            for field in fields
+        }
+        self.time = create_array('time', (num_steps, ), (max(num_steps, 1), ),
+                                 np.int64, None, ['time'])
+
+    def write(self, field, i, raster):
+        self._arrs[field][i] = raster
+
+    def close(self):
+        pass
+
+
+class StepWriter:
+    # Writes the fields of each simulation step to a NetCDF file ('.nc') or a
+    # Zarr store ('.zarr'), chunked by month, in a background thread so that
+    # the I/O overlaps with the simulation. The steps are passed to the
+    # thread through a queue of at most `queue_size` fields, which bounds the
+    # memory usage regardless of the length of the record. ACHTUNG: `write`
+    # blocks when the queue is full
+    def __init__(self, filepath, fields, times, shape, to_raster,
+                 queue_size=2):
+        if filepath.endswith('.nc'):
+            store_cls = _NetCDFStore
+        elif filepath.endswith('.zarr'):
+            store_cls = _ZarrStore
+        else:
+            raise ValueError(
+                "The output file path must end with '.nc' or '.zarr'")
+        for field in fields:
+            if field not in OUTPUT_FIELDS:
+                raise ValueError(
+                    f"Output field {field} must be among {OUTPUT_FIELDS}")
+        self.fields = list(fields)
+        # function that converts the values of the simulated pixels to a
+        # raster (see `MonthlySimulation._to_raster`)
+        self._to_raster = to_raster
+
+        # ACHTUNG: the store is created in the main thread so that errors
+        # (e.g., missing dependencies) are raised right away
+        self._store = store_cls(filepath, self.fields, len(times), shape,
+                                np.double)
+        self._store.time[:] = times
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self._error is not None:
+                # keep consuming so that the main thread never blocks
+                continue
+            field, i, values = item
+            try:
+                self._store.write(field, i, self._to_raster(values))
+            except Exception as e:
+                self._error = e
+
+    def write(self, field, i, values):
+        # ACHTUNG: the values are copied since the simulation reuses its
+        # arrays at each step
+        self._queue.put((field, i, np.array(values, dtype=np.double)))
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._store.close()
+        if self._error is not None:
+            raise self._error
@@ -1,15 +1,19 @@
-import matplotlib.pyplot as plt
 import numpy as np
-from matplotlib.ticker import FuncFormatter
 
 from . import utils
 
 __all__ = ['plot_gauge_flow']
 
+# ACHTUNG: matplotlib is only imported when plotting, since it is by far the
+# slowest dependency to import and most simulations (e.g., headless ones or
+# in worker processes) never plot
+
 
 def plot_gauge_flow(sim_gauge_flow, obs_gauge_flow=None, num_warmup_months=12,
                     warmup_vline=True, nash_sutcliffe=True,
                     monthly_aligned=True, legend=True, **plt_kws):
+    import matplotlib.pyplot as plt
+    from matplotlib.ticker import FuncFormatter
 
     fig, ax = plt.subplots(**plt_kws)
 
@@ -0,0 +1,37 @@
+import collections
+import itertools
+from concurrent import futures
+
+__all__ = []
+
+# ACHTUNG: this module is used internally by `MonthlySimulation` and it is not
+# part of the public API
+
+
+def prefetch(read, indices, num_prefetch, num_threads=1):
+    # Yields `read(i)` for each `i` of `indices` (in order) while the
+    # following `num_prefetch` items are read in a pool of `num_threads`
+    # background threads, so that (e.g.,) decoding the climatological data of
+    # the next months from disk overlaps with the simulation of the current
+    # one. At most `num_prefetch` items are pending besides the yielded one,
+    # which bounds the memory usage. ACHTUNG: `read` must be thread-safe and
+    # must return new arrays (not work buffers) since the items are read
+    # concurrently. Errors of `read` are raised when the item is yielded
+    if num_prefetch < 1:
+        raise ValueError("The number of prefetched items must be positive")
+    indices = iter(indices)
+    with futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+        pending = collections.deque(
+            executor.submit(read, i)
+            for i in itertools.islice(indices, num_prefetch))
+        try:
+            while pending:
+                future = pending.popleft()
+                for i in itertools.islice(indices, 1):
+                    pending.append(executor.submit(read, i))
+                yield future.result()
+        finally:
+            # if the consumer stops early (or fails), do not read the pending
+            # items that have not started yet
+            for future in pending:
+                future.cancel()
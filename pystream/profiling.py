@@ -0,0 +1,170 @@
+import collections
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+__all__ = ['PHASES', 'PhaseEvent', 'Profiler']
+
+# Phases of a simulation that are reported to the `profiler` of a
+# `MonthlySimulation` (any callable that takes a `PhaseEvent`):
+# - 'setup': the construction of the simulation (a single event)
+# - 'climate': extracting (and regridding) the climatological data of a
+#   month, where `nbytes` are the bytes of the precipitation and temperature
+#   arrays. With `climate_prefetch`, this is the time spent waiting for the
+#   background threads
+# - 'heat_index': getting the heat index and alpha of a month, i.e., the
+#   precomputation of the yearly heat index in the first month and next to
+#   nothing in the others
+# - 'water_balance': the water balance of a month, where `nbytes` are the
+#   bytes of its outflow
+# - 'routing': the flow accumulation of a batch of months (see
+#   `routing_batch_size`) or the flow at the gauges, where `nbytes` are the
+#   bytes of the routed outflow
+# - 'outputs': writing the fields of a batch of months to the outputs and
+#   accumulators
+PHASES = ['setup', 'climate', 'heat_index', 'water_balance', 'routing',
+          'outputs']
+
+# `step` is the index of the (first) month of the phase (None for 'setup'),
+# `num_steps` the number of months, `start` the value of
+# `time.perf_counter()` when it started, `duration` in seconds, and
+# `allocated` the peak memory (in bytes) allocated during the phase (None
+# unless the profiler has a true `trace_memory` attribute)
+PhaseEvent = collections.namedtuple('PhaseEvent', [
+    'phase', 'step', 'num_steps', 'start', 'duration', 'nbytes', 'allocated'
+])
+
+
+class _Phase:
+    # context manager that times a phase and reports it to the profiler. The
+    # code within the phase can set the `nbytes` attribute
+    __slots__ = ['profiler', 'phase', 'step', 'num_steps', 'nbytes', 'start',
+                 'start_memory', 'tracing']
+
+    def __init__(self, profiler, phase, step=None, num_steps=1):
+        self.profiler = profiler
+        self.phase = phase
+        self.step = step
+        self.num_steps = num_steps
+        self.nbytes = 0
+
+    def __enter__(self):
+        self.tracing = None
+        if getattr(self.profiler, 'trace_memory', False):
+            self.tracing = tracemalloc.is_tracing()
+            if self.tracing:
+                # ACHTUNG: `reset_peak` requires Python 3.9 (see `setup.py`)
+                tracemalloc.reset_peak()
+            else:
+                tracemalloc.start()
+            self.start_memory, _ = tracemalloc.get_traced_memory()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        duration = time.perf_counter() - self.start
+        allocated = None
+        if self.tracing is not None:
+            _, peak_memory = tracemalloc.get_traced_memory()
+            allocated = peak_memory - self.start_memory
+            if not self.tracing:
+                tracemalloc.stop()
+        self.profiler(
+            PhaseEvent(self.phase, self.step, self.num_steps, self.start,
+                       duration, self.nbytes, allocated))
+
+
+class _NullPhase:
+    # what `MonthlySimulation._phase` returns without profiler, so that
+    # profiling costs (close to) nothing when disabled
+    __slots__ = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def __setattr__(self, name, value):
+        pass
+
+
+NULL_PHASE = _NullPhase()
+
+
+class Profiler:
+    # Built-in profiler that collects the `PhaseEvent` instances of one or
+    # more simulations (e.g., `MonthlySimulation(..., profiler=profiler)`),
+    # which can be summarized with `report` or exported with
+    # `to_chrome_trace`. If `trace_memory` is True, the memory allocated in
+    # each phase is traced with `tracemalloc`, which slows down the
+    # simulation considerably
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.events = []
+        # the profiler might be shared by simulations that run in different
+        # threads
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        with self._lock:
+            self.events.append(event)
+
+    def clear(self):
+        with self._lock:
+            self.events = []
+
+    def to_dataframe(self):
+        return pd.DataFrame(self.events, columns=PhaseEvent._fields)
+
+    def report(self):
+        # data frame with the number of events, total, mean and maximum
+        # duration (in seconds), share of the total duration, total bytes
+        # and peak allocated memory (in bytes) of each phase
+        df = self.to_dataframe()
+        report_df = df.groupby('phase', sort=False).agg(
+            count=('duration', 'size'), total_time=('duration', 'sum'),
+            mean_time=('duration', 'mean'), max_time=('duration', 'max'),
+            nbytes=('nbytes', 'sum'),
+            peak_allocated=('allocated', 'max'))
+        report_df.insert(
+            2, 'time_share',
+            report_df['total_time'] / report_df['total_time'].sum())
+        return report_df.reindex(
+            [phase for phase in PHASES if phase in report_df.index] +
+            [phase for phase in report_df.index if phase not in PHASES])
+
+    def to_chrome_trace(self, filepath):
+        # writes the events as complete ('X') events of the Chrome trace
+        # event format, which can be opened in chrome://tracing or
+        # https://ui.perfetto.dev, with the time in microseconds since the
+        # first event
+        if len(self.events) > 0:
+            origin = min(event.start for event in self.events)
+        trace_events = []
+        for event in self.events:
+            args = {
+                field: getattr(event, field)
+                for field in ['step', 'num_steps', 'nbytes', 'allocated']
+                if getattr(event, field) is not None
+            }
+            trace_events.append({
+                'name': event.phase,
+                'cat': 'pystream',
+                'ph': 'X',
+                'ts': (event.start - origin) * 1e6,
+                'dur': event.duration * 1e6,
+                'pid': os.getpid(),
+                'tid': 0,
+                'args': {
+                    key: int(value) if isinstance(value, np.integer) else value
+                    for key, value in args.items()
+                }
+            })
+        with open(filepath, 'w') as f:
+            json.dump({'traceEvents': trace_events}, f)
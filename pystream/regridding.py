@@ -0,0 +1,153 @@
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+from scipy import sparse
+
+__all__ = [
+    'REGRIDDING_METHODS', 'get_regridding_weights', 'regridding_weights'
+]
+
+# Regridding of the climatological data from its (rectilinear) grid to the
+# grid of the rasters, as a sparse matrix of weights such that multiplying it
+# by a (raveled) climatological field gives the (raveled) field on the
+# rasters' grid. Since both grids are rectilinear, the weights are the
+# Kronecker product of the weights along the rows (y) and along the columns
+# (x). The methods are 'nearest' (nearest neighbour), 'bilinear' (the values
+# outside of the climatological grid are the ones of its edges) and 'area'
+# (each raster cell is the average of the climatological cells that it
+# overlaps, weighted by the overlapping length along each axis)
+REGRIDDING_METHODS = ['nearest', 'bilinear', 'area']
+
+# weights computed in this process (see `get_regridding_weights`), so that
+# many simulations on the same grids only compute them once
+_cached_weights = {}
+_MAX_CACHED_WEIGHTS = 8
+
+
+def _cell_edges(centers):
+    # edges of the cells of (ascending) cell centers, assuming that the first
+    # and last cells are symmetric around their centers
+    if centers.size == 1:
+        return np.array([centers[0] - .5, centers[0] + .5])
+    midpoints = (centers[:-1] + centers[1:]) / 2
+    return np.concatenate([[2 * centers[0] - midpoints[0]], midpoints,
+                           [2 * centers[-1] - midpoints[-1]]])
+
+
+def _axis_weights(src, dst, method):
+    # (rows, cols, data) of the weights along one axis, where `src` and `dst`
+    # are the cell centers (in any monotonic order) of the climatological
+    # and the raster grid respectively
+    src_order = np.argsort(src, kind='stable')
+    src = np.asarray(src, dtype=np.double)[src_order]
+    dst = np.asarray(dst, dtype=np.double)
+    num_src, num_dst = src.size, dst.size
+
+    if num_src == 1:
+        rows = np.arange(num_dst)
+        cols = np.zeros(num_dst, dtype=np.intp)
+        data = np.ones(num_dst)
+    elif method == 'nearest':
+        right = np.clip(np.searchsorted(src, dst), 1, num_src - 1)
+        left = right - 1
+        rows = np.arange(num_dst)
+        cols = np.where(dst - src[left] <= src[right] - dst, left, right)
+        data = np.ones(num_dst)
+    elif method == 'bilinear':
+        left = np.clip(np.searchsorted(src, dst) - 1, 0, num_src - 2)
+        t = np.clip((dst - src[left]) / (src[left + 1] - src[left]), 0, 1)
+        rows = np.tile(np.arange(num_dst), 2)
+        cols = np.concatenate([left, left + 1])
+        data = np.concatenate([1 - t, t])
+    else:
+        src_edges = _cell_edges(src)
+        dst_order = np.argsort(dst, kind='stable')
+        dst_edges = _cell_edges(dst[dst_order])
+        dst_lo = np.empty(num_dst)
+        dst_hi = np.empty(num_dst)
+        dst_lo[dst_order] = dst_edges[:-1]
+        dst_hi[dst_order] = dst_edges[1:]
+        # range of climatological cells that each raster cell might overlap
+        first = np.clip(
+            np.searchsorted(src_edges, dst_lo, side='right') - 1, 0,
+            num_src - 1)
+        last = np.clip(
+            np.searchsorted(src_edges, dst_hi, side='left') - 1, first,
+            num_src - 1)
+        counts = last - first + 1
+        rows = np.repeat(np.arange(num_dst), counts)
+        cols = first[rows] + np.arange(rows.size) - np.repeat(
+            np.cumsum(counts) - counts, counts)
+        data = np.clip(
+            np.minimum(dst_hi[rows], src_edges[cols + 1]) -
+            np.maximum(dst_lo[rows], src_edges[cols]), 0, None)
+        # raster cells outside of the climatological grid take the values of
+        # the nearest edge
+        outside = np.bincount(rows, data, minlength=num_dst) == 0
+        data[outside[rows]] = 1
+        data /= np.bincount(rows, data, minlength=num_dst)[rows]
+
+    return rows, src_order[cols], data
+
+
+def regridding_weights(src_y, src_x, dst_y, dst_x, method='bilinear'):
+    # sparse matrix of shape (len(dst_y) * len(dst_x), len(src_y) *
+    # len(src_x)) of the weights from the climatological grid with cell
+    # centers `src_y` and `src_x` to the raster grid with cell centers `dst_y`
+    # and `dst_x` (see `REGRIDDING_METHODS`)
+    if method not in REGRIDDING_METHODS:
+        raise ValueError(
+            f"Regridding method must be among {REGRIDDING_METHODS}")
+    weights = []
+    for src, dst in [(src_y, dst_y), (src_x, dst_x)]:
+        rows, cols, data = _axis_weights(np.ravel(src), np.ravel(dst), method)
+        weights.append(
+            sparse.csr_matrix((data, (rows, cols)),
+                              shape=(np.size(dst), np.size(src))))
+    weights = sparse.kron(*weights, format='csr')
+    # ACHTUNG: explicit zeros would propagate the NaNs of the climatological
+    # cells that do not contribute to a raster cell
+    weights.eliminate_zeros()
+
+    return weights
+
+
+def get_regridding_weights(src_y, src_x, dst_y, dst_x, method='bilinear',
+                           cache_dir=None):
+    # same as `regridding_weights`, but the weights are cached in this process
+    # and, if `cache_dir` is provided, in an '.npz' file keyed by a hash of
+    # the coordinates and the method
+    key = hashlib.sha256(method.encode())
+    for coords in [src_y, src_x, dst_y, dst_x]:
+        coords = np.ascontiguousarray(coords, dtype=np.double)
+        key.update(repr(coords.shape).encode())
+        key.update(coords.tobytes())
+    key = key.hexdigest()
+
+    weights = _cached_weights.get(key)
+    if cache_dir is not None:
+        cache_filepath = os.path.join(cache_dir, f'{key}.npz')
+        if weights is None and os.path.exists(cache_filepath):
+            weights = sparse.load_npz(cache_filepath).tocsr()
+    if weights is None:
+        weights = regridding_weights(src_y, src_x, dst_y, dst_x,
+                                     method=method)
+
+    if cache_dir is not None and not os.path.exists(cache_filepath):
+        os.makedirs(cache_dir, exist_ok=True)
+        # write to a temporary file first so that concurrent simulations never
+        # see a partially written cache file
+        fd, tmp_filepath = tempfile.mkstemp(suffix='.npz', dir=cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            sparse.save_npz(f, weights)
+        os.replace(tmp_filepath, cache_filepath)
+
+    if key not in _cached_weights:
+        if len(_cached_weights) >= _MAX_CACHED_WEIGHTS:
+            # forget the oldest weights
+            del _cached_weights[next(iter(_cached_weights))]
+        _cached_weights[key] = weights
+
+    return weights
@@ -0,0 +1,225 @@
+import numpy as np
+from scipy import sparse
+from scipy.sparse import linalg as sparse_linalg
+
+__all__ = ['D8Routing']
+
+# richdem's D8 neighbourhood (see `dx` and `dy` in richdem's `constants.hpp`),
+# which starts at the left neighbour and goes clockwise. ACHTUNG: the order
+# matters, since ties between equally low neighbours are resolved in favour of
+# the first one
+D8_DY = np.array([0, -1, -1, -1, 0, 1, 1, 1])
+D8_DX = np.array([-1, -1, 0, 1, 1, 1, 0, -1])
+
+# value that richdem assigns to the nodata cells of a flow accumulation
+ACCUM_NODATA = -1
+
+
+class D8Routing:
+    # Static D8 routing of a DEM, i.e., the receiver of each pixel plus the
+    # order in which pixels must pass their flow downstream. Flow directions
+    # follow richdem's O'Callaghan and Mark (1984) implementation: edge cells
+    # and pits do not drain, and nodata cells neither drain nor receive flow.
+    # The traversal order reproduces the one of richdem's generic flow
+    # accumulation (a FIFO topological sort), so that the accumulated flows
+    # are bit-identical to `richdem.FlowAccumulation(dem, method='D8')`
+    def __init__(self, dem, nodata=None):
+        if nodata is None:
+            # `richdem.rdarray` instances carry their own nodata value
+            nodata = getattr(dem, 'no_data', None)
+        dem = np.asarray(dem, dtype=np.double)
+        self.shape = dem.shape
+        height, width = self.shape
+
+        # ACHTUNG: like richdem, detect nodata by equality, so that NaN nodata
+        # values are never considered nodata
+        if nodata is None:
+            self.nodata_mask = np.zeros(self.shape, dtype=bool)
+        else:
+            self.nodata_mask = dem == nodata
+
+        #
+        # FLOW DIRECTIONS
+        #
+
+        # only the interior cells can drain, so we work with views of the DEM
+        # that are shifted towards each neighbour
+        center = dem[1:-1, 1:-1]
+        lowest_elev = np.full(center.shape, np.finfo(np.double).max)
+        lowest_n = np.full(center.shape, -1)
+        for n, (dy, dx) in enumerate(zip(D8_DY, D8_DX)):
+            rows = slice(1 + dy, height - 1 + dy)
+            cols = slice(1 + dx, width - 1 + dx)
+            neighbour_elev = dem[rows, cols]
+            cond = ~self.nodata_mask[rows, cols] & (
+                neighbour_elev < center) & (neighbour_elev < lowest_elev)
+            lowest_elev = np.where(cond, neighbour_elev, lowest_elev)
+            lowest_n = np.where(cond, n, lowest_n)
+        lowest_n[self.nodata_mask[1:-1, 1:-1]] = -1
+
+        # flat index of the receiver of each pixel (-1 if it does not drain)
+        receivers = np.full(self.shape, -1, dtype=np.intp)
+        ys, xs = np.nonzero(lowest_n >= 0)
+        ns = lowest_n[ys, xs]
+        receivers[ys + 1, xs + 1] = (ys + 1 + D8_DY[ns]) * width + \
+            xs + 1 + D8_DX[ns]
+        self.receivers = receivers.ravel()
+
+        #
+        # TRAVERSAL ORDER
+        #
+
+        self._set_traversal_order()
+
+    def _set_traversal_order(self):
+        # order in which the pixels pass their flow downstream, given the
+        # receivers and the nodata mask. Kahn's algorithm processed level by
+        # level: all the pixels of a level only depend on pixels of previous
+        # levels. Within each level, pixels are sorted by the position of
+        # their last donor in the previous level, which is the order in which
+        # richdem's FIFO queue visits them
+        num_donors = np.bincount(self.receivers[self.receivers >= 0],
+                                 minlength=self.receivers.size)
+        level = np.flatnonzero((num_donors == 0) &
+                               ~self.nodata_mask.ravel())
+        # level of each pixel, which will be used to sort the pixels
+        # topologically when building the sparse routing operator
+        self.pixel_levels = np.zeros(self.receivers.size, dtype=np.intp)
+        donor_levels = []
+        while level.size > 0:
+            self.pixel_levels[level] = len(donor_levels)
+            level = level[self.receivers[level] >= 0]
+            level_receivers = self.receivers[level]
+            donor_levels.append(level)
+            # position of the last occurrence of each receiver
+            rev_receivers, rev_first, counts = np.unique(
+                level_receivers[::-1], return_index=True, return_counts=True)
+            num_donors[rev_receivers] -= counts
+            ready = num_donors[rev_receivers] == 0
+            last_donor = level_receivers.size - 1 - rev_first[ready]
+            level = rev_receivers[ready][np.argsort(last_donor)]
+
+        # the pixels that do not drain anywhere are left out, since they do not
+        # pass any flow downstream
+        self.donors = np.concatenate(donor_levels) if donor_levels \
+            else np.array([], dtype=np.intp)
+        self.donor_receivers = self.receivers[self.donors]
+        self.level_bounds = np.cumsum([0] +
+                                      [level.size for level in donor_levels])
+
+        # the sparse routing operator and the donor matrix are only built if
+        # needed
+        self._operator_lu = None
+        self._donor_matrix = None
+
+    @classmethod
+    def from_receivers(cls, receivers, nodata_mask):
+        # routing given the flat index of the receiver of each pixel (-1 if
+        # it does not drain), e.g., flow directions that are not derived from
+        # a DEM. ACHTUNG: the receivers must not have cycles, otherwise the
+        # pixels of the cycles and downstream of them never pass their flow
+        routing = cls.__new__(cls)
+        routing.nodata_mask = np.asarray(nodata_mask, dtype=bool)
+        routing.shape = routing.nodata_mask.shape
+        routing.receivers = np.asarray(receivers, dtype=np.intp).ravel()
+        routing._set_traversal_order()
+
+        return routing
+
+    # arrays that fully determine the routing, e.g., to store it and restore
+    # it with `from_arrays` without recomputing it from the DEM
+    ARRAYS = [
+        'nodata_mask', 'receivers', 'pixel_levels', 'donors',
+        'donor_receivers', 'level_bounds'
+    ]
+
+    @classmethod
+    def from_arrays(cls, **arrays):
+        # `arrays` maps each name of `ARRAYS` to its array (which can be
+        # read-only, e.g., a memory map)
+        routing = cls.__new__(cls)
+        for name in cls.ARRAYS:
+            setattr(routing, name, arrays[name])
+        routing.shape = routing.nodata_mask.shape
+        routing._operator_lu = None
+        routing._donor_matrix = None
+
+        return routing
+
+    def accumulate(self, weights):
+        # weighted flow accumulation, i.e., a single pass over the pixels in
+        # topological order. `np.add.at` is unbuffered and processes repeated
+        # indices in order, so the additions happen in the same sequence as in
+        # richdem
+        accum = np.array(weights, dtype=np.double).reshape(-1)
+        for start, end in zip(self.level_bounds[:-1], self.level_bounds[1:]):
+            np.add.at(accum, self.donor_receivers[start:end],
+                      accum[self.donors[start:end]])
+        accum[self.nodata_mask.ravel()] = ACCUM_NODATA
+
+        return accum.reshape(self.shape)
+
+    def outlet(self):
+        # flat index of the pixel with the largest (unweighted) flow
+        # accumulation, i.e., the outlet of the largest drainage basin
+        return np.argmax(self.accumulate(np.ones(self.receivers.size)))
+
+    def upstream_pixels(self, pixel):
+        # flat indices of the pixels that drain into `pixel` (including the
+        # pixel itself), sorted in ascending order
+        if self._donor_matrix is None:
+            # row `r` of this matrix has the donors of the pixel `r`
+            num_pixels = self.receivers.size
+            self._donor_matrix = sparse.csr_matrix(
+                (np.ones(self.donors.size, dtype=bool),
+                 (self.donor_receivers, self.donors)),
+                shape=(num_pixels, num_pixels))
+
+        # ACHTUNG: D8 routing is a forest, so no pixel can be visited twice
+        upstream = [np.array([pixel], dtype=np.intp)]
+        while upstream[-1].size > 0:
+            upstream.append(self._donor_matrix[upstream[-1]].indices)
+
+        return np.sort(np.concatenate(upstream))
+
+    def _get_operator_lu(self):
+        # Weighted D8 accumulation is linear in the weights: if `A` is the
+        # adjacency matrix such that `A[r, d] = 1` when the pixel `d` drains
+        # into `r`, the accumulation `x` of the weights `w` is the solution of
+        # `(I - A) x = w`. Sorting the pixels topologically makes `I - A`
+        # lower triangular, so its LU factorization (without pivoting) has no
+        # fill-in and solving it is a single triangular solve
+        if self._operator_lu is None:
+            num_pixels = self.receivers.size
+            self._perm = np.argsort(self.pixel_levels, kind='stable')
+            inv_perm = np.empty_like(self._perm)
+            inv_perm[self._perm] = np.arange(num_pixels)
+            operator = sparse.identity(num_pixels, format='csc') - \
+                sparse.csc_matrix(
+                    (np.ones(self.donors.size),
+                     (inv_perm[self.donor_receivers], inv_perm[self.donors])),
+                    shape=(num_pixels, num_pixels))
+            self._operator_lu = sparse_linalg.splu(
+                operator, permc_spec='NATURAL', diag_pivot_thresh=0,
+                options={'SymmetricMode': True})
+
+        return self._operator_lu
+
+    def accumulate_many(self, weights):
+        # weighted flow accumulation of a stack of weights of shape
+        # `(n, height, width)` or `(n, num_pixels)`, e.g., the outflow of each
+        # month of the simulation, with a single multiple right-hand side
+        # solve of the sparse routing operator. ACHTUNG: since the additions
+        # are done in a different order, the results might differ from
+        # `accumulate` (and richdem) by rounding errors
+        weights = np.asarray(weights, dtype=np.double)
+        num_layers = weights.shape[0]
+        weights = weights.reshape(num_layers, -1)
+
+        operator_lu = self._get_operator_lu()
+        accum = np.empty_like(weights)
+        accum[:, self._perm] = operator_lu.solve(
+            np.ascontiguousarray(weights[:, self._perm].T)).T
+        accum[:, self.nodata_mask.ravel()] = ACCUM_NODATA
+
+        return accum.reshape((num_layers, ) + self.shape)
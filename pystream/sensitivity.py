@@ -0,0 +1,319 @@
+import hashlib
+import json
+import multiprocessing as mp
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from .calibration import _evaluate_members, _worker_pool
+from .metrics import METRICS
+from .monthly_simulation import MonthlySimulation
+
+__all__ = [
+    'SENSITIVITY_METHODS', 'morris_design', 'saltelli_design',
+    'sensitivity_analysis'
+]
+
+# Global sensitivity analysis of the parameters of a simulation:
+# - 'morris': elementary effects (Morris, 1991) of `num_trajectories`
+#   one-at-a-time trajectories over a grid of `num_levels` levels of each
+#   parameter, i.e., `num_trajectories * (num_parameters + 1)` runs. The
+#   indices are the mean (`mu`), mean absolute value (`mu_star`, which ranks
+#   the parameters by importance) and standard deviation (`sigma`, which
+#   reveals interactions and non-linearities) of the elementary effects
+# - 'sobol': first-order (`S1`) and total (`ST`) Sobol indices with the
+#   estimators of Saltelli et al. (2010) and Jansen (1999) over a scrambled
+#   Sobol sequence of `num_samples` (rounded up to a power of two) base
+#   samples, i.e., `num_samples * (num_parameters + 2)` runs
+SENSITIVITY_METHODS = ['morris', 'sobol']
+
+
+def morris_design(num_trajectories, num_parameters, num_levels=4,
+                  random_state=None):
+    # (num_trajectories * (num_parameters + 1), num_parameters) array of
+    # points of the unit hypercube, where each trajectory starts at a random
+    # point of the grid and then moves each parameter (in random order and
+    # direction) by `num_levels / (2 * (num_levels - 1))`
+    if num_levels < 2:
+        raise ValueError("There must be at least two levels")
+    if random_state is None:
+        random_state = np.random.RandomState()
+    delta = num_levels / (2 * (num_levels - 1))
+    # only the levels from which moving up by `delta` stays in the grid
+    levels = np.arange(num_levels) / (num_levels - 1)
+    levels = levels[levels <= 1 - delta + 1e-12]
+    base = random_state.choice(levels, (num_trajectories, num_parameters))
+    directions = random_state.choice([-1, 1],
+                                     (num_trajectories, num_parameters))
+    start = base + delta * (directions < 0)
+    order = np.argsort(random_state.rand(num_trajectories, num_parameters),
+                       axis=1)
+    steps = np.zeros((num_trajectories, num_parameters, num_parameters))
+    rows = np.arange(num_trajectories)[:, np.newaxis]
+    steps[rows, np.arange(num_parameters),
+          order] = delta * directions[rows, order]
+    trajectories = np.concatenate([
+        start[:, np.newaxis], start[:, np.newaxis] + np.cumsum(steps, axis=1)
+    ], axis=1)
+    return trajectories.reshape(-1, num_parameters)
+
+
+def saltelli_design(num_samples, num_parameters, seed=None):
+    # (num_samples * (num_parameters + 2), num_parameters) array of points of
+    # the unit hypercube, i.e., for each base sample, the point `a` of the
+    # matrix A, the points of A with the i-th column of the matrix B (for
+    # each parameter i) and the point `b` of B. ACHTUNG: `scipy.stats` is
+    # slow to import, so it is only imported when needed
+    from scipy.stats import qmc
+    sampler = qmc.Sobol(2 * num_parameters, scramble=True, seed=seed)
+    base = sampler.random_base2(int(np.ceil(np.log2(max(num_samples, 1)))))
+    a, b = base[:, :num_parameters], base[:, num_parameters:]
+    ab = np.repeat(a[:, np.newaxis], num_parameters, axis=1)
+    ab[:, np.arange(num_parameters), np.arange(num_parameters)] = b
+    return np.concatenate([a[:, np.newaxis], ab, b[:, np.newaxis]],
+                          axis=1).reshape(-1, num_parameters)
+
+
+def _confidence(estimates, confidence_level):
+    # half-width of the normal confidence interval of the bootstrap estimates
+    # (first axis)
+    from scipy import stats
+    return stats.norm.ppf(.5 + confidence_level / 2) * np.std(
+        estimates, axis=0, ddof=1)
+
+
+def _morris_indices(design, outputs, num_resamples, confidence_level,
+                    random_state):
+    num_parameters = design.shape[1]
+    trajectories = design.reshape(-1, num_parameters + 1, num_parameters)
+    outputs = outputs.reshape(-1, num_parameters + 1)
+    # each step of a trajectory moves a single parameter
+    steps = np.diff(trajectories, axis=1)
+    moved = np.argmax(np.abs(steps), axis=2)
+    rows = np.arange(len(trajectories))[:, np.newaxis]
+    effects = np.empty((len(trajectories), num_parameters))
+    effects[rows, moved] = np.diff(outputs, axis=1) / np.take_along_axis(
+        steps, moved[..., np.newaxis], axis=2)[..., 0]
+
+    resamples = random_state.randint(len(effects),
+                                     size=(num_resamples, len(effects)))
+    return pd.DataFrame({
+        'mu': effects.mean(axis=0),
+        'mu_star': np.abs(effects).mean(axis=0),
+        'sigma': effects.std(axis=0, ddof=1),
+        'mu_star_conf': _confidence(
+            np.abs(effects)[resamples].mean(axis=1), confidence_level)
+    })
+
+
+def _sobol_indices(design, outputs, num_resamples, confidence_level,
+                   random_state):
+    num_parameters = design.shape[1]
+    outputs = outputs.reshape(-1, num_parameters + 2)
+    f_a, f_ab, f_b = outputs[:, 0], outputs[:, 1:-1], outputs[:, -1]
+
+    def indices(f_a, f_ab, f_b):
+        variance = np.var(np.concatenate([f_a, f_b], axis=-1), axis=-1)
+        variance = variance[..., np.newaxis]
+        first_order = np.mean(f_b[..., np.newaxis] *
+                              (f_ab - f_a[..., np.newaxis]),
+                              axis=-2) / variance
+        total = .5 * np.mean(
+            (f_a[..., np.newaxis] - f_ab)**2, axis=-2) / variance
+        return first_order, total
+
+    first_order, total = indices(f_a, f_ab, f_b)
+    resamples = random_state.randint(len(outputs),
+                                     size=(num_resamples, len(outputs)))
+    resampled_first_order, resampled_total = indices(
+        f_a[resamples], f_ab[resamples], f_b[resamples])
+    return pd.DataFrame({
+        'S1': first_order,
+        'S1_conf': _confidence(resampled_first_order, confidence_level),
+        'ST': total,
+        'ST_conf': _confidence(resampled_total, confidence_level)
+    })
+
+
+def _get_inputs_hash(simulation, obs_gauge_flow):
+    # hash of everything besides the settings that determines the outputs of
+    # the runs, i.e., the terrain, climatological data and parameters of
+    # `simulation` (see `MonthlySimulation._get_warm_state_key`), its gauges
+    # and the observations
+    key = hashlib.sha256(
+        simulation._get_warm_state_key(simulation.num_months, None,
+                                       None).encode())
+    for arr in [simulation.gauges, obs_gauge_flow]:
+        if arr is None:
+            key.update(b'None')
+        else:
+            key.update(repr((arr.shape, arr.dtype.str)).encode())
+            key.update(np.ascontiguousarray(arr).tobytes())
+    return key.hexdigest()
+
+
+def _save_json(f, **obj):
+    f.write(json.dumps(obj).encode())
+
+
+def _load_results(results_dir, settings):
+    # design and (partial) outputs stored in `results_dir`, or None if it is
+    # a new analysis
+    settings_filepath = os.path.join(results_dir, 'settings.json')
+    if not os.path.exists(settings_filepath):
+        return None
+    with open(settings_filepath) as f:
+        stored_settings = json.load(f)
+    if stored_settings != settings:
+        raise ValueError(
+            f"The results in {results_dir} are of a different analysis "
+            f"({stored_settings})")
+    design = np.load(os.path.join(results_dir, 'design.npy'))
+    outputs = np.full(len(design), np.nan)
+    done = np.zeros(len(design), dtype=bool)
+    for filename in os.listdir(results_dir):
+        if filename.startswith('runs-') and filename.endswith('.npz'):
+            with np.load(os.path.join(results_dir, filename)) as runs:
+                outputs[runs['indices']] = runs['outputs']
+                done[runs['indices']] = True
+    return design, outputs, done
+
+
+def _save(results_dir, filename, save, arr):
+    # write to a temporary file first so that an interrupted analysis never
+    # leaves partially written results
+    fd, tmp_filepath = tempfile.mkstemp(suffix=os.path.splitext(filename)[1],
+                                        dir=results_dir)
+    with os.fdopen(fd, 'wb') as f:
+        save(f, **arr) if isinstance(arr, dict) else save(f, arr)
+    os.replace(tmp_filepath, os.path.join(results_dir, filename))
+
+
+def sensitivity_analysis(simulation, parameter_bounds, method='morris',
+                         obs_gauge_flow=None, metric='nash_sutcliffe',
+                         num_trajectories=20, num_levels=4, num_samples=256,
+                         num_warmup_months=6, num_resamples=1000,
+                         confidence_level=.95, processes=None, batch_size=None,
+                         results_dir=None, seed=None):
+    # Global sensitivity analysis (see `SENSITIVITY_METHODS`) of the
+    # parameters of `simulation` (a `MonthlySimulation` instance) within
+    # `parameter_bounds`, which maps the name of each parameter to its (min,
+    # max) bounds (the rest of parameters take the values of `simulation`).
+    # The analyzed output of each run is the `metric` (see `metrics.METRICS`)
+    # of its gauge flow with respect to `obs_gauge_flow` or, if it is None,
+    # its mean gauge flow, in both cases after the `num_warmup_months` and
+    # averaged over the gauges.
+    #
+    # Like in `calibrate`, the runs are simulated as ensembles of (at most)
+    # `batch_size` members (by default, 64) by a pool of `processes` worker
+    # processes, which share the terrain, climatological data, routing and
+    # heat index of `simulation`. If `results_dir` is provided, the design and
+    # the outputs of each batch are stored there as soon as they are
+    # evaluated, so that an interrupted analysis can be resumed by calling
+    # this function again with the same arguments (and the same inputs,
+    # parameters and observations, which is checked with a hash of them).
+    #
+    # Returns a pandas data frame with the sensitivity indices of each
+    # parameter and the half-width of their bootstrap (with `num_resamples`)
+    # confidence interval at `confidence_level`, and a data frame with the
+    # parameters and output of each run
+    if method not in SENSITIVITY_METHODS:
+        raise ValueError(f"Method must be among {SENSITIVITY_METHODS}")
+    if obs_gauge_flow is not None and metric not in METRICS:
+        raise ValueError(f"Metric must be among {METRICS}")
+    parameter_names = list(parameter_bounds)
+    for parameter in parameter_names:
+        if parameter not in MonthlySimulation.PARAMETER_NAMES:
+            raise ValueError(f"Parameter {parameter} must be among "
+                             f"{MonthlySimulation.PARAMETER_NAMES}")
+    if len(parameter_names) == 0:
+        raise ValueError("There must be at least one parameter")
+    bounds = np.array([parameter_bounds[parameter]
+                       for parameter in parameter_names],
+                      dtype=np.double)  # yapf: disable
+    if obs_gauge_flow is not None:
+        obs_gauge_flow = np.asarray(obs_gauge_flow, dtype=np.double)
+        output_name = metric
+    else:
+        output_name = 'mean_gauge_flow'
+    if processes is None:
+        processes = mp.cpu_count()
+    if batch_size is None:
+        batch_size = 64
+
+    # DESIGN
+    # everything that determines the design and the outputs of the runs
+    settings = dict(method=method, parameter_bounds=bounds.tolist(),
+                    parameter_names=parameter_names, output=output_name,
+                    num_warmup_months=num_warmup_months, seed=seed)
+    if method == 'morris':
+        settings.update(num_trajectories=num_trajectories,
+                        num_levels=num_levels)
+    else:
+        settings.update(num_samples=num_samples)
+    results = None
+    if results_dir is not None:
+        # the stored results can only be resumed with the same inputs and
+        # observations
+        settings.update(
+            inputs_hash=_get_inputs_hash(simulation, obs_gauge_flow))
+        os.makedirs(results_dir, exist_ok=True)
+        results = _load_results(results_dir, settings)
+    if results is None:
+        random_state = np.random.RandomState(seed)
+        if method == 'morris':
+            samples = morris_design(num_trajectories, len(parameter_names),
+                                    num_levels=num_levels,
+                                    random_state=random_state)
+        else:
+            samples = saltelli_design(num_samples, len(parameter_names),
+                                      seed=random_state)
+        design = bounds[:, 0] + samples * (bounds[:, 1] - bounds[:, 0])
+        outputs = np.full(len(design), np.nan)
+        done = np.zeros(len(design), dtype=bool)
+        if results_dir is not None:
+            # ACHTUNG: the settings are written last, since they mark that
+            # the design is stored (see `_load_results`)
+            _save(results_dir, 'design.npy', np.save, design)
+            _save(results_dir, 'settings.json', _save_json, settings)
+    else:
+        design, outputs, done = results
+
+    # EVALUATION
+    pending = np.flatnonzero(~done)
+    if pending.size > 0:
+        batches = np.split(pending,
+                           np.arange(batch_size, pending.size, batch_size))
+        with _worker_pool(simulation, parameter_names, obs_gauge_flow,
+                          num_warmup_months, min(processes, len(batches)),
+                          metric=metric) as pool:
+            for indices, batch_outputs in zip(
+                    batches,
+                    pool.imap(_evaluate_members,
+                              [design[indices] for indices in batches])):
+                outputs[indices] = batch_outputs
+                if results_dir is not None:
+                    _save(results_dir, f'runs-{indices[0]:07d}.npz',
+                          np.savez, {
+                              'indices': indices,
+                              'outputs': batch_outputs
+                          })
+
+    # INDICES
+    # ACHTUNG: the normalized design is recovered from the parameters so that
+    # the stored designs do not need to be normalized
+    samples = (design - bounds[:, 0]) / (bounds[:, 1] - bounds[:, 0])
+    if method == 'morris':
+        indices_func = _morris_indices
+    else:
+        indices_func = _sobol_indices
+    indices_df = indices_func(samples, outputs, num_resamples,
+                              confidence_level,
+                              np.random.RandomState(seed))
+    indices_df.index = pd.Index(parameter_names, name='parameter')
+    runs_df = pd.DataFrame(design, columns=parameter_names)
+    runs_df[output_name] = outputs
+
+    return indices_df, runs_df
@@ -7,5 +7,7 @@ def nash_sutcliffe(sim_gauge_flow, obs_gauge_flow):
     if len(sim_gauge_flow) != len(obs_gauge_flow):
         raise ValueError("Lengths must match!")
 
-    return 1 - sum((sim_gauge_flow - obs_gauge_flow)**2) / sum(
-        (obs_gauge_flow - np.mean(obs_gauge_flow))**2)
+    # ACHTUNG: summing along the first axis like the built-in `sum`, so that
+    # the efficiency of each gauge is returned in gauge mode
+    return 1 - np.sum((sim_gauge_flow - obs_gauge_flow)**2, axis=0) / np.sum(
+        (obs_gauge_flow - np.mean(obs_gauge_flow, axis=0))**2, axis=0)
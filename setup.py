@@ -11,7 +11,7 @@ classifiers = [
     'License :: OSI Approved :: GNU Lesser General Public License v3 (LGPLv3)',
     'Programming Language :: Python',
     'Programming Language :: Python :: 3',
-    'Programming Language :: Python :: 3.6',
+    'Programming Language :: Python :: 3.9',
 ]
 
 here = path.abspath(path.dirname(__file__))
@@ -42,6 +42,7 @@ setup(
     license='GPL-3.0',
     packages=find_packages(exclude=['docs', 'tests*']),
     include_package_data=True,
+    python_requires='>=3.9',
     install_requires=install_requires,
     dependency_links=dependency_links,
 )
@@ -1,6 +1,12 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
 import unittest
 
 import numpy as np
+import pandas as pd
 import rasterio
 import richdem
 import xarray as xr
@@ -8,6 +14,33 @@ import xarray as xr
 import pystream as pst
 
 
+def synthetic_inputs(shape=(20, 25), num_months=24, seed=0):
+    # tilted terrain with some noise, so that it has both a main drainage
+    # direction and local pits, plus seasonal climatological data
+    rng = np.random.RandomState(seed)
+    ys, xs = np.mgrid[0:shape[0], 0:shape[1]]
+    dem = 100 + 2 * ys + np.abs(xs - shape[1] // 2) + rng.rand(*shape)
+    dem[0, :3] = -9999
+    cropf = rng.uniform(.5, 1, shape)
+    whc = rng.uniform(0, 100, shape)
+
+    months = np.arange(num_months)
+    seasonal = np.cos(2 * np.pi * months / 12)[:, np.newaxis, np.newaxis]
+    dims = ('time', 'y', 'x')
+    coords = {'time': months}
+    prec_ds = xr.Dataset(
+        {'prec': (dims, rng.uniform(0, 150, (num_months, ) + shape))},
+        coords=coords)
+    temp_ds = xr.Dataset(
+        {
+            'temp':
+            (dims, 10 - 12 * seasonal + rng.normal(0, 3,
+                                                   (num_months, ) + shape))
+        }, coords=coords)
+
+    return dem, cropf, whc, prec_ds, temp_ds
+
+
 class TestMonthlySimulation(unittest.TestCase):
     def setUp(self):
         self.dem_fp = 'tests/input_data/dem.tif'
@@ -185,3 +218,1013 @@ class TestMonthlySimulation(unittest.TestCase):
         self.assertTrue(np.all(gauge_flow >= 0))
         # TODO: test plotting
         # TODO: test Nash-Sutcliffe
+
+
+class TestRouting(unittest.TestCase):
+    def setUp(self):
+        self.dem, _, _, _, _ = synthetic_inputs()
+        self.rd_dem = richdem.rdarray(self.dem, no_data=-9999)
+        self.weights = np.random.RandomState(1).rand(*self.dem.shape)
+
+    def test_d8_accumulation(self):
+        routing = pst.D8Routing(self.rd_dem)
+        # the receivers of edge and nodata cells must be -1
+        receivers = routing.receivers.reshape(self.dem.shape)
+        self.assertTrue(np.all(receivers[0] == -1))
+        self.assertTrue(np.all(receivers[:, -1] == -1))
+        # the accumulation must be exactly the same as richdem's
+        self.assertTrue(
+            np.array_equal(
+                routing.accumulate(self.weights),
+                richdem.FlowAccumulation(self.rd_dem, method='D8',
+                                         weights=self.weights.copy())))
+        # repeated accumulations must not be affected by previous ones
+        self.assertTrue(
+            np.array_equal(
+                routing.accumulate(np.ones_like(self.weights)),
+                richdem.FlowAccumulation(self.rd_dem, method='D8')))
+
+    def test_accumulate_many(self):
+        routing = pst.D8Routing(self.rd_dem)
+        weights = np.random.RandomState(2).rand(5, *self.dem.shape)
+        accum = routing.accumulate_many(weights)
+        self.assertEqual(accum.shape, weights.shape)
+        for weights_i, accum_i in zip(weights, accum):
+            self.assertTrue(
+                np.allclose(accum_i, routing.accumulate(weights_i)))
+
+
+class TestSyntheticSimulation(unittest.TestCase):
+    def setUp(self):
+        self.inputs = synthetic_inputs()
+        self.res = (100, 100)
+
+    def simulation(self, **kwargs):
+        dem, cropf, whc, prec_ds, temp_ds = self.inputs
+        return pst.MonthlySimulation(dem, cropf, np.copy(whc), prec_ds,
+                                     temp_ds, res=self.res, **kwargs)
+
+    def test_routing_batches(self):
+        # routing the monthly outflows in batches must not change the
+        # simulated flow (beyond rounding errors)
+        gauge_flow = self.simulation().simulate()
+        for routing_batch_size in [1, 5, 24]:
+            self.assertTrue(
+                np.allclose(
+                    self.simulation().simulate(
+                        routing_batch_size=routing_batch_size), gauge_flow))
+        # the batched routing must also match the step-by-step one
+        ms = self.simulation()
+        step_gauge_flow = np.array([
+            ms._simulation_step(*ms._get_climate(i), heat_index, alpha)
+            for i, (heat_index, alpha) in enumerate(
+                ms._iter_heat_index_alpha())
+        ]) / ms.TIME_STEP
+        self.assertTrue(np.allclose(step_gauge_flow, gauge_flow))
+        self.assertRaises(ValueError,
+                          self.simulation().simulate,
+                          routing_batch_size=0)
+
+    def test_gauges(self):
+        ms = self.simulation()
+        gauge_flow = ms.simulate()
+        # on this terrain, the outlet always has the maximum flow
+        outlet_ms = self.simulation(gauges='outlet')
+        outlet_gauge_flow = outlet_ms.simulate()
+        self.assertEqual(outlet_gauge_flow.shape, (ms.num_months, 1))
+        self.assertTrue(np.allclose(outlet_gauge_flow[:, 0], gauge_flow))
+
+        # the flow at each gauge must match the streamflow raster
+        gauges = [(10, 12), (15, 5), (18, 20)]
+        gauges_ms = self.simulation(gauges=gauges)
+        gauge_rows, gauge_cols = np.transpose(gauges)
+        streamflow = np.empty((ms.num_months, len(gauges)))
+        ms = self.simulation()
+        for i, (heat_index, alpha) in enumerate(ms._iter_heat_index_alpha()):
+            outflow_i = ms._water_balance_step(*ms._get_climate(i),
+                                               heat_index, alpha)
+            streamflow[i] = ms.routing.accumulate(
+                ms._to_raster(outflow_i, fill_value=0))[gauge_rows,
+                                                        gauge_cols]
+        self.assertTrue(
+            np.allclose(gauges_ms.simulate(), streamflow / ms.TIME_STEP))
+        # pixels outside the catchments of the gauges are not simulated
+        self.assertLess(gauges_ms._pixels.size, ms.dem.size)
+        self.assertEqual(gauges_ms.snow_accum.shape, ms.dem.shape)
+        self.assertTrue(np.isnan(gauges_ms.snow_accum).any())
+        # the state variables can be set as full rasters
+        ground_water = np.full(ms.dem.shape, 10.)
+        gauges_ms.ground_water = ground_water
+        self.assertEqual(gauges_ms._ground_water.shape,
+                         gauges_ms._pixels.shape)
+        self.assertTrue(np.all(gauges_ms._ground_water == 10))
+        with self.assertRaises(ValueError):
+            gauges_ms.ground_water = ground_water[1:]
+        # scalar heat indices are also broadcast in gauge mode
+        self.assertTrue(
+            np.allclose(
+                self.simulation(gauges='outlet').simulate(heat_index=50.),
+                self.simulation(gauges='outlet').simulate(
+                    heat_index=np.full(ms.dem.shape, 50.))))
+
+        # gauges must lie within the rasters and not on nodata pixels
+        self.assertRaises(ValueError, self.simulation, gauges=[(0, 100)])
+        self.assertRaises(ValueError, self.simulation, gauges=[(0, 0)])
+        self.assertRaises(ValueError, self.simulation, gauges='foo')
+
+    def test_valid_pixels(self):
+        # only the valid pixels of the DEM are simulated
+        ms = self.simulation(climate_loading='memory')
+        valid_mask = ms.dem != ms.dem.no_data
+        self.assertEqual(ms._pixels.size, np.sum(valid_mask))
+        for arr in [ms._cropf, ms._whc, ms._snow_accum, ms._temp_arr[0]]:
+            self.assertEqual(arr.shape, ms._pixels.shape)
+        gauge_flow = ms.simulate()
+        # the full rasters are only rebuilt on output
+        self.assertEqual(ms.available_water.shape, ms.dem.shape)
+        self.assertTrue(np.all(np.isnan(ms.available_water[~valid_mask])))
+        self.assertFalse(np.any(np.isnan(ms.available_water[valid_mask])))
+        # scalar heat indices are broadcast to the simulated pixels
+        self.assertTrue(
+            np.allclose(
+                self.simulation().simulate(heat_index=50.),
+                self.simulation().simulate(
+                    heat_index=np.full(ms.dem.shape, 50.))))
+        # if all the pixels are valid, the rasters are used as they are
+        dem, cropf, whc, prec_ds, temp_ds = self.inputs
+        dem = dem.copy()
+        dem[dem == ms.dem.no_data] = 200
+        ms = pst.MonthlySimulation(dem, cropf, whc.copy(), prec_ds, temp_ds,
+                                   res=self.res)
+        self.assertIsNone(ms._pixels)
+        self.assertEqual(ms._snow_accum.shape, ms.dem.shape)
+        self.assertEqual(ms.simulate().shape, gauge_flow.shape)
+
+    def test_ensemble(self):
+        parameter_names = ['HEAT_COEFF', 'SNOW_MELT_COEFF', 'TOGW', 'C']
+        parameters = np.array([[1, 15, .5, .2], [1.2, 10, .3, .4],
+                               [.8, 20, .7, .1]])
+        for gauges in [None, [(10, 12), (18, 20)]]:
+            ensemble_gauge_flow = self.simulation(
+                gauges=gauges).simulate_ensemble(
+                    parameters, parameter_names=parameter_names)
+            self.assertEqual(ensemble_gauge_flow.shape[:2],
+                             (len(parameters), 24))
+            # each member must match the simulation with its parameters
+            for member_parameters, member_gauge_flow in zip(
+                    parameters, ensemble_gauge_flow):
+                ms = self.simulation(gauges=gauges, init_parameters=dict(
+                    zip(parameter_names, member_parameters)))
+                self.assertTrue(
+                    np.allclose(member_gauge_flow, ms.simulate()))
+
+        # the parameters must be a table with known parameter names
+        ms = self.simulation()
+        self.assertRaises(ValueError, ms.simulate_ensemble, parameters)
+        self.assertRaises(ValueError, ms.simulate_ensemble, parameters[:, :2],
+                          parameter_names=['HEAT_COEFF', 'FOO'])
+
+    def test_climate_loading(self):
+        gauge_flow = self.simulation().simulate()
+        for climate_loading in ['memory', 'mmap']:
+            ms = self.simulation(climate_loading=climate_loading)
+            # the climatological data is preloaded as C-contiguous arrays
+            for arr in [ms._prec_arr, ms._temp_arr]:
+                self.assertEqual(arr.shape,
+                                 (ms.num_months, ) + ms._cropf.shape)
+                self.assertTrue(arr.flags.c_contiguous)
+            self.assertTrue(np.array_equal(ms.simulate(), gauge_flow))
+
+        # the climatological data must match the shape of the rasters
+        dem, cropf, whc, prec_ds, temp_ds = self.inputs
+        self.assertRaises(ValueError, pst.MonthlySimulation, dem, cropf, whc,
+                          prec_ds.isel(x=slice(1, None)), temp_ds,
+                          res=self.res, climate_loading='memory')
+        self.assertRaises(ValueError, self.simulation, climate_loading='foo')
+
+    def test_heat_index(self):
+        ms = self.simulation(init_parameters={'HEAT_COEFF': 1.2})
+        _, temp_ds = self.inputs[3:]
+        yearly_heat_index, yearly_alpha = ms._get_yearly_heat_index_alpha(
+            ms.HEAT_COEFF)
+        self.assertEqual(yearly_heat_index.shape, (2, ) + ms._cropf.shape)
+        # compare with the heat index computed year by year with xarray
+        for year in range(2):
+            year_heat_index = (temp_ds['temp'].isel(
+                time=slice(year * 12, year * 12 + 12)) / 5)**1.514
+            year_heat_index = ms._to_domain(
+                year_heat_index.fillna(0).sum('time').values)
+            self.assertTrue(
+                np.allclose(yearly_heat_index[year],
+                            year_heat_index * ms.HEAT_COEFF))
+            self.assertTrue(
+                np.allclose(
+                    yearly_alpha[year],
+                    pst.MonthlySimulation._compute_alpha(
+                        year_heat_index * ms.HEAT_COEFF)))
+        # the results are cached for repeated simulations
+        self.assertIs(
+            ms._get_yearly_heat_index_alpha(ms.HEAT_COEFF)[0],
+            yearly_heat_index)
+        self.assertIsNot(
+            ms._get_yearly_heat_index_alpha(1)[0], yearly_heat_index)
+
+    def test_work_buffers(self):
+        for gauges in [None, 'outlet']:
+            ms = self.simulation(gauges=gauges)
+            gauge_flow = ms.simulate()
+            buffers = dict(ms._buffers)
+            # repeated simulations reuse the work buffers and the state
+            # variables are updated in place
+            snow_accum = ms._snow_accum
+            ms.simulate()
+            self.assertIs(ms._snow_accum, snow_accum)
+            for name, buffer in ms._buffers.items():
+                self.assertIs(buffer, buffers[name])
+            # the results do not depend on the reuse of the buffers
+            self.assertTrue(
+                np.allclose(
+                    self.simulation(gauges=gauges).simulate(
+                        routing_batch_size=1), gauge_flow))
+
+    def test_engine(self):
+        self.assertRaises(ValueError, self.simulation, engine='fortran')
+        try:
+            import numba
+        except ImportError:
+            self.skipTest("numba is not installed")
+        for gauges in [None, 'outlet']:
+            numpy_ms = self.simulation(gauges=gauges)
+            numba_ms = self.simulation(gauges=gauges, engine='numba')
+            self.assertTrue(
+                np.allclose(numba_ms.simulate(), numpy_ms.simulate()))
+            for state in ['snow_accum', 'available_water', 'ground_water']:
+                self.assertTrue(
+                    np.allclose(getattr(numba_ms, state),
+                                getattr(numpy_ms, state), equal_nan=True))
+            parameters = {'TOGW': [.2, .5, .8], 'HEAT_COEFF': [.8, 1, 1.2]}
+            self.assertTrue(
+                np.allclose(
+                    numba_ms.simulate_ensemble(pd.DataFrame(parameters)),
+                    numpy_ms.simulate_ensemble(pd.DataFrame(parameters))))
+        # the threading layer chosen by the user is respected
+        priority = numba.config.THREADING_LAYER_PRIORITY
+        numba.config.THREADING_LAYER_PRIORITY = ['workqueue', 'omp', 'tbb']
+        try:
+            self.simulation(engine='numba')
+            self.assertEqual(numba.config.THREADING_LAYER_PRIORITY,
+                             ['workqueue', 'omp', 'tbb'])
+        finally:
+            numba.config.THREADING_LAYER_PRIORITY = priority
+
+    def test_state_snapshots(self):
+        gauge_flow = self.simulation(gauges='outlet').simulate()
+        ms = self.simulation(gauges='outlet')
+        ms.spin_up(12)
+        self.assertEqual(ms.step, 12)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            snapshot_filepath = os.path.join(tmp_dir, 'state.npz')
+            ms.save_state(snapshot_filepath)
+            # resuming from the snapshot is the same as not stopping
+            self.assertTrue(
+                np.array_equal(ms.simulate(start=ms.step), gauge_flow[12:]))
+            resumed_ms = self.simulation(gauges='outlet')
+            resumed_ms.load_state(snapshot_filepath)
+            self.assertEqual(resumed_ms.step, 12)
+            self.assertTrue(
+                np.array_equal(resumed_ms.simulate(start=resumed_ms.step),
+                               gauge_flow[12:]))
+            # the snapshot must match the simulated pixels
+            self.assertRaises(ValueError,
+                              self.simulation().load_state,
+                              snapshot_filepath)
+            self.assertRaises(ValueError, ms.simulate, start=12, end=30)
+
+            # warm state cache
+            cache_dir = os.path.join(tmp_dir, 'cache')
+            for _ in range(2):
+                ms = self.simulation(gauges='outlet')
+                ms.spin_up(12, cache_dir=cache_dir)
+                self.assertEqual(len(os.listdir(cache_dir)), 1)
+                self.assertTrue(
+                    np.array_equal(ms.simulate(start=ms.step),
+                                   gauge_flow[12:]))
+            # other parameters result in another warm state
+            ms = self.simulation(gauges='outlet',
+                                 init_parameters={'TOGW': .2})
+            ms.spin_up(12, cache_dir=cache_dir)
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+    def test_append_months(self):
+        dem, cropf, whc, prec_ds, temp_ds = self.inputs
+        for gauges in [None, 'outlet']:
+            gauge_flow = self.simulation(gauges=gauges).simulate()
+            ms = pst.MonthlySimulation(dem, cropf, whc.copy(),
+                                       prec_ds.isel(time=slice(0, 12)),
+                                       temp_ds.isel(time=slice(0, 12)),
+                                       res=self.res, gauges=gauges)
+            # the whole record must be simulated first
+            self.assertRaises(ValueError, ms.append_months,
+                              prec_ds.isel(time=slice(12, 24)),
+                              temp_ds.isel(time=slice(12, 24)))
+            ms.simulate()
+            yearly_heat_index = ms._get_yearly_heat_index()
+            # appending a whole year extends the cached heat index
+            self.assertTrue(
+                np.array_equal(
+                    ms.append_months(prec_ds.isel(time=slice(12, 24)),
+                                     temp_ds.isel(time=slice(12, 24))),
+                    gauge_flow[12:]))
+            self.assertEqual(ms.num_months, 24)
+            self.assertTrue(np.array_equal(ms.gauge_flow, gauge_flow))
+            self.assertTrue(
+                np.array_equal(ms._get_yearly_heat_index()[0],
+                               yearly_heat_index[0]))
+
+        # months can be appended one by one (as arrays)
+        heat_index = np.full(dem.shape, 40.)
+        gauge_flow = self.simulation().simulate(heat_index=heat_index)
+        ms = pst.MonthlySimulation(dem, cropf, whc.copy(),
+                                   prec_ds.isel(time=slice(0, 12)),
+                                   temp_ds.isel(time=slice(0, 12)),
+                                   res=self.res)
+        ms.simulate(heat_index=heat_index)
+        for i in range(12, 24):
+            ms.append_months(prec_ds['prec'].values[i],
+                             temp_ds['temp'].values[i], heat_index=heat_index)
+        self.assertTrue(np.array_equal(ms.gauge_flow, gauge_flow))
+        self.assertRaises(ValueError, ms.append_months,
+                          prec_ds['prec'].values[:2],
+                          temp_ds['temp'].values[:1])
+
+        # after appending an incomplete year, the whole record (including
+        # the appended months) can be simulated again
+        ms = pst.MonthlySimulation(dem, cropf, whc.copy(),
+                                   prec_ds.isel(time=slice(0, 12)),
+                                   temp_ds.isel(time=slice(0, 12)),
+                                   res=self.res)
+        ms.simulate()
+        appended_gauge_flow = ms.append_months(
+            prec_ds['prec'].values[12], temp_ds['temp'].values[12])
+        self.assertEqual(ms.num_months, 13)
+        appended_gauge_flow = np.concatenate(
+            [ms.gauge_flow[:12], appended_gauge_flow])
+        ms._snow_accum[:] = 0
+        ms._available_water[:] = 0
+        ms._ground_water[:] = 0
+        self.assertTrue(np.allclose(ms.simulate(), appended_gauge_flow))
+
+    def test_outputs(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for gauges in [None, 'outlet']:
+                ms = self.simulation(gauges=gauges)
+                output_filepath = os.path.join(tmp_dir, 'outputs.nc')
+                gauge_flow = ms.simulate(
+                    routing_batch_size=5, output_filepath=output_filepath,
+                    output_fields=pst.OUTPUT_FIELDS)
+                with xr.open_dataset(output_filepath) as output_ds:
+                    self.assertEqual(
+                        output_ds['snow_accum'].shape,
+                        (ms.num_months, ) + ms.dem.shape)
+                    for state in ['snow_accum', 'available_water',
+                                  'ground_water']:
+                        self.assertTrue(
+                            np.array_equal(
+                                output_ds[state].isel(time=-1).values,
+                                getattr(ms, state), equal_nan=True))
+                    streamflow = output_ds['streamflow'].values.reshape(
+                        ms.num_months, -1)
+                    if gauges is None:
+                        self.assertTrue(
+                            np.allclose(
+                                np.nanmax(streamflow, axis=1) /
+                                ms.TIME_STEP, gauge_flow))
+                    else:
+                        self.assertTrue(
+                            np.allclose(
+                                streamflow[:, ms.gauges] / ms.TIME_STEP,
+                                gauge_flow))
+                        # the runoff and base flow of the catchment make up
+                        # the flow at its outlet
+                        outflow = (output_ds['runoff'] +
+                                   output_ds['base_flow']) / 1000 * \
+                            self.res[0] * self.res[1]
+                        self.assertTrue(
+                            np.allclose(
+                                outflow.sum(['y', 'x']).values /
+                                ms.TIME_STEP, gauge_flow[:, 0]))
+
+            # Zarr stores (if zarr is installed)
+            try:
+                import zarr
+            except ImportError:
+                zarr = None
+            if zarr is not None:
+                ms = self.simulation()
+                output_filepath = os.path.join(tmp_dir, 'outputs.zarr')
+                ms.simulate(output_filepath=output_filepath,
+                            output_fields=['ground_water'])
+                with xr.open_zarr(output_filepath,
+                                  consolidated=False) as output_ds:
+                    self.assertTrue(
+                        np.array_equal(output_ds['time'], np.arange(24)))
+                    self.assertTrue(
+                        np.array_equal(
+                            output_ds['ground_water'].isel(time=-1).values,
+                            ms.ground_water, equal_nan=True))
+
+            # when the streamflow is recorded, the months are routed one by
+            # one by default
+            profiler = pst.Profiler()
+            ms = self.simulation(profiler=profiler)
+            ms.simulate(output_filepath=os.path.join(tmp_dir, 'flow.nc'))
+            self.assertEqual(profiler.report().loc['routing', 'count'],
+                             ms.num_months)
+
+            ms = self.simulation()
+            self.assertRaises(ValueError, ms.simulate,
+                              output_filepath=os.path.join(tmp_dir, 'foo.txt'))
+            self.assertRaises(ValueError, ms.simulate,
+                              output_filepath=output_filepath,
+                              output_fields=['foo'])
+
+    def test_accumulators(self):
+        ms = self.simulation()
+        accumulators = [
+            pst.MeanVariance('streamflow'),
+            pst.MinMax('available_water'),
+            pst.Exceedance('snow_accum', 0),
+            pst.Quantiles('streamflow', [.25, .5])
+        ]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_filepath = os.path.join(tmp_dir, 'outputs.nc')
+            gauge_flow, summary_ds = ms.simulate(
+                output_filepath=output_filepath,
+                output_fields=['streamflow', 'available_water', 'snow_accum'],
+                accumulators=accumulators)
+            with xr.open_dataset(output_filepath) as output_ds:
+                output_ds = output_ds.load()
+        self.assertEqual(len(gauge_flow), ms.num_months)
+        self.assertEqual(summary_ds['streamflow_mean'].shape, ms.dem.shape)
+        self.assertEqual(summary_ds['streamflow_quantile'].shape,
+                         (2, ) + ms.dem.shape)
+        # compare with the statistics of the stored monthly fields
+        for summary_var, values in [
+            ('streamflow_mean', output_ds['streamflow'].mean('time')),
+            ('streamflow_variance', output_ds['streamflow'].var('time')),
+            ('available_water_min', output_ds['available_water'].min('time')),
+            ('available_water_max', output_ds['available_water'].max('time')),
+            ('snow_accum_exceedance',
+             (output_ds['snow_accum'] > 0).sum('time').where(
+                 output_ds['snow_accum'].notnull().all('time')))
+        ]:
+            self.assertTrue(
+                np.allclose(summary_ds[summary_var], values, equal_nan=True))
+
+        # the P-square quantiles approximate the actual ones
+        rng = np.random.RandomState(0)
+        quantiles = pst.Quantiles('streamflow', [.1, .5, .9])
+        quantiles.start((3, ))
+        values = rng.normal(size=(2000, 3))
+        for values_i in values:
+            quantiles.update(values_i)
+        self.assertTrue(
+            np.allclose(quantiles.result()['streamflow_quantile'],
+                        np.quantile(values, [.1, .5, .9], axis=0), atol=.1))
+
+        self.assertRaises(ValueError, pst.MeanVariance, 'foo')
+        self.assertRaises(ValueError, pst.Quantiles, 'streamflow', [1.5])
+
+    def test_raster_loading(self):
+        dem, cropf, whc, prec_ds, temp_ds = self.inputs
+        # caller-provided arrays are neither copied nor modified
+        whc = np.copy(whc)
+        whc[5, 5] = 0
+        ms = pst.MonthlySimulation(dem, cropf, whc, prec_ds, temp_ds,
+                                   res=self.res, trace_memory=True)
+        self.assertEqual(whc[5, 5], 0)
+        self.assertGreater(ms.whc[5, 5], 0)
+        self.assertTrue(np.shares_memory(ms.dem, dem))
+        self.assertTrue(np.shares_memory(ms.cropf, cropf))
+        self.assertGreater(ms.setup_peak_memory, 0)
+        # the replaced pixels keep the data type of the raster, so that in
+        # integer rasters they stay at zero
+        int_whc = whc.astype(np.int32)
+        ms = pst.MonthlySimulation(dem, cropf, int_whc, prec_ds, temp_ds,
+                                   res=self.res)
+        self.assertEqual(ms.whc.dtype, np.int32)
+        self.assertEqual(ms.whc[5, 5], 0)
+        self.assertEqual(int_whc[5, 5], 0)
+
+        # windowed loading from raster files, with and without a cache of
+        # memory-mapped rasters, matches windowed arrays
+        window = ((2, 18), (3, 22))
+        rows, cols = slice(*window[0]), slice(*window[1])
+        gauge_flow = pst.MonthlySimulation(dem[rows, cols], cropf[rows, cols],
+                                           whc[rows, cols],
+                                           prec_ds.isel(y=rows, x=cols),
+                                           temp_ds.isel(y=rows, x=cols),
+                                           res=self.res).simulate()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filepaths = []
+            for name, arr in [('dem', dem), ('cropf', cropf), ('whc', whc)]:
+                filepath = os.path.join(tmp_dir, f'{name}.tif')
+                with rasterio.open(filepath, 'w', driver='GTiff',
+                                   height=arr.shape[0], width=arr.shape[1],
+                                   count=1, dtype=np.double, nodata=-9999,
+                                   transform=rasterio.transform.from_origin(
+                                       0, 0, *self.res)) as dst:
+                    dst.write(arr, 1)
+                filepaths.append(filepath)
+            cache_dir = os.path.join(tmp_dir, 'cache')
+            for raster_cache_dir in [None, cache_dir, cache_dir]:
+                ms = pst.MonthlySimulation(*filepaths, prec_ds, temp_ds,
+                                           window=window,
+                                           raster_cache_dir=raster_cache_dir)
+                self.assertEqual(ms.dem.shape, (16, 19))
+                self.assertTrue(np.array_equal(ms.simulate(), gauge_flow))
+            self.assertEqual(len(os.listdir(cache_dir)), 3)
+            self.assertIsInstance(ms.cropf, np.memmap)
+            self.assertFalse(ms.cropf.flags.writeable)
+
+        # the window of a mask is its bounding box, outside of which the
+        # pixels are nodata
+        mask = np.zeros(dem.shape, dtype=bool)
+        mask[4:10, 6:15] = True
+        mask[4, 6] = False
+        ms = pst.MonthlySimulation(dem, cropf, whc, prec_ds, temp_ds,
+                                   res=self.res, mask=mask)
+        self.assertEqual(ms.dem.shape, (6, 9))
+        self.assertEqual(ms.dem[0, 0], ms.dem.no_data)
+        self.assertEqual(ms.prec_ds['prec'].shape, (ms.num_months, 6, 9))
+        self.assertNotEqual(dem[4, 6], -9999)
+
+    def test_climate_prefetch(self):
+        dem, cropf, whc, prec_ds, temp_ds = self.inputs
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            prec_filepath = os.path.join(tmp_dir, 'prec.nc')
+            temp_filepath = os.path.join(tmp_dir, 'temp.nc')
+            prec_ds.to_netcdf(prec_filepath)
+            temp_ds.to_netcdf(temp_filepath)
+
+            def simulation(**kwargs):
+                return pst.MonthlySimulation(dem, cropf, whc, prec_filepath,
+                                             temp_filepath, res=self.res,
+                                             gauges='outlet', **kwargs)
+
+            # prefetching the months in background threads does not change
+            # the simulated flow, regardless of the routing batches, the
+            # simulated months and the appended ones
+            gauge_flow = simulation().simulate()
+            for climate_prefetch in [1, 3]:
+                ms = simulation(climate_prefetch=climate_prefetch)
+                self.assertTrue(np.array_equal(ms.simulate(), gauge_flow))
+                ms = simulation(climate_prefetch=climate_prefetch)
+                self.assertTrue(
+                    np.array_equal(
+                        np.concatenate([
+                            ms.simulate(end=7, routing_batch_size=2),
+                            ms.simulate(start=7)
+                        ]), gauge_flow))
+                ms.append_months(prec_ds['prec'].values[:3],
+                                 temp_ds['temp'].values[:3])
+                self.assertEqual(ms.step, ms.num_months)
+
+        self.assertRaises(ValueError, pst.MonthlySimulation, dem, cropf, whc,
+                          prec_ds, temp_ds, res=self.res, climate_prefetch=-1)
+        self.assertRaises(ValueError, list,
+                          pst.prefetch.prefetch(np.sqrt, range(3), 0))
+
+    def test_compiled_inputs(self):
+        dem, cropf, whc, prec_ds, temp_ds = self.inputs
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            prec_filepath = os.path.join(tmp_dir, 'prec.nc')
+            prec_ds.to_netcdf(prec_filepath)
+            cache_dir = os.path.join(tmp_dir, 'cache')
+            inputs_dir = pst.MonthlySimulation.compile_inputs(
+                cache_dir, dem, cropf, whc, prec_filepath, temp_ds,
+                res=self.res, window=((1, 20), (0, 24)))
+            # compiling the same inputs again reuses the cache, whereas other
+            # inputs get their own directory
+            self.assertEqual(
+                pst.MonthlySimulation.compile_inputs(
+                    cache_dir, dem, cropf, whc, prec_filepath, temp_ds,
+                    res=self.res, window=((1, 20), (0, 24))), inputs_dir)
+            self.assertNotEqual(
+                pst.MonthlySimulation.compile_inputs(
+                    cache_dir, dem, cropf, whc, prec_filepath, temp_ds,
+                    res=self.res), inputs_dir)
+
+            for kwargs in [{}, dict(gauges='outlet')]:
+                ms = pst.MonthlySimulation(dem, cropf, whc, prec_filepath,
+                                           temp_ds, res=self.res,
+                                           window=((1, 20), (0, 24)),
+                                           **kwargs)
+                compiled_ms = pst.MonthlySimulation.from_compiled_inputs(
+                    inputs_dir, **kwargs)
+                self.assertEqual(compiled_ms.res, ms.res)
+                self.assertIsInstance(compiled_ms.cropf, np.memmap)
+                self.assertTrue(
+                    np.array_equal(compiled_ms.simulate(), ms.simulate()))
+                self.assertTrue(
+                    np.array_equal(compiled_ms.prec_ds['time'],
+                                   prec_ds['time']))
+
+    def test_climate_regridding(self):
+        dem, cropf, whc, prec_ds, temp_ds = self.inputs
+        transform = rasterio.transform.from_origin(0, 2000, *self.res)
+        # climatological data on a grid that is 4 times coarser along the
+        # rows and 5 times along the columns (with descending rows)
+        coarse_dims = ('time', 'lat', 'lon')
+        coarse_coords = {
+            'time': prec_ds['time'],
+            'lat': np.arange(1800, 0, -400),
+            'lon': np.arange(250, 2500, 500)
+        }
+        rng = np.random.RandomState(0)
+        coarse_prec = rng.uniform(0, 150, (24, 5, 5))
+        coarse_temp = rng.normal(8, 6, (24, 5, 5))
+        coarse_prec_ds = xr.Dataset({'prec': (coarse_dims, coarse_prec)},
+                                    coords=coarse_coords)
+        coarse_temp_ds = xr.Dataset({'temp': (coarse_dims, coarse_temp)},
+                                    coords=coarse_coords)
+
+        # each raster cell lies within a single climatological cell, so the
+        # 'nearest' and 'area' methods must match the upsampled data
+        def upsample(arr):
+            return np.repeat(np.repeat(arr, 4, axis=1), 5, axis=2)
+
+        for gauges in [None, 'outlet']:
+            gauge_flow = pst.MonthlySimulation(
+                dem, cropf, whc,
+                xr.Dataset({'prec': (('time', 'y', 'x'),
+                                     upsample(coarse_prec))}),
+                xr.Dataset({'temp': (('time', 'y', 'x'),
+                                     upsample(coarse_temp))}), res=self.res,
+                gauges=gauges).simulate()
+            for climate_regridding in ['nearest', 'area']:
+                with tempfile.TemporaryDirectory() as tmp_dir:
+                    for climate_loading in [None, 'memory']:
+                        ms = pst.MonthlySimulation(
+                            dem, cropf, whc, coarse_prec_ds, coarse_temp_ds,
+                            res=self.res, gauges=gauges,
+                            transform=transform,
+                            climate_regridding=climate_regridding,
+                            climate_loading=climate_loading,
+                            regridding_cache_dir=tmp_dir)
+                        self.assertTrue(
+                            np.allclose(ms.simulate(), gauge_flow))
+                    self.assertEqual(len(os.listdir(tmp_dir)), 1)
+
+        # bilinear weights are a partition of unity
+        weights = pst.regridding_weights(coarse_coords['lat'],
+                                         coarse_coords['lon'],
+                                         *ms._get_raster_coords())
+        self.assertEqual(weights.shape, (dem.size, 25))
+        self.assertTrue(np.allclose(weights.sum(axis=1), 1))
+
+        # the transform of the rasters is required
+        self.assertRaises(ValueError, pst.MonthlySimulation, dem, cropf, whc,
+                          coarse_prec_ds, coarse_temp_ds, res=self.res,
+                          climate_regridding='area')
+        self.assertRaises(ValueError, pst.MonthlySimulation, dem, cropf, whc,
+                          coarse_prec_ds, coarse_temp_ds, res=self.res,
+                          transform=transform, climate_regridding='foo')
+
+    def test_coarsening(self):
+        dem, cropf, whc, prec_ds, temp_ds = synthetic_inputs(shape=(60, 80))
+        ms = pst.MonthlySimulation(dem, cropf, whc, prec_ds, temp_ds,
+                                   res=self.res, gauges='outlet')
+
+        # a factor of 1 must reproduce the routing and gauge flow over the
+        # catchment
+        proxy = pst.coarsen_simulation(ms, 1)
+        self.assertTrue(
+            np.array_equal(proxy.routing.receivers[ms._pixels],
+                           ms.routing.receivers[ms._pixels]))
+        match = pst.proxy_match(ms, proxy)
+        self.assertTrue(np.allclose(match['nash_sutcliffe'], 1))
+        self.assertTrue(np.allclose(match['drainage_area_ratio'], 1))
+
+        for factor in [2, 3]:
+            proxy = pst.coarsen_simulation(ms, factor)
+            self.assertEqual(proxy.dem.shape,
+                             (-(-60 // factor), -(-80 // factor)))
+            self.assertEqual(proxy.res, (self.res[0] * factor,
+                                         self.res[1] * factor))
+            match = pst.proxy_match(ms, proxy)
+            self.assertTrue(np.all(match['nash_sutcliffe'] > .5))
+            self.assertTrue(
+                np.allclose(match['drainage_area_ratio'], 1, atol=.1))
+
+        self.assertRaises(ValueError, pst.coarsen_simulation, ms, 0)
+
+    def test_profiling(self):
+        gauge_flow = self.simulation().simulate()
+        for gauges in [None, 'outlet']:
+            profiler = pst.Profiler()
+            ms = self.simulation(gauges=gauges, profiler=profiler)
+            # profiling must not change the results
+            if gauges is None:
+                self.assertTrue(np.array_equal(ms.simulate(), gauge_flow))
+            else:
+                ms.simulate()
+            report_df = profiler.report()
+            self.assertEqual(list(report_df.index), [
+                'setup', 'climate', 'heat_index', 'water_balance', 'routing'
+            ])
+            # the 24 months are routed in two batches (see
+            # `ROUTING_BATCH_SIZE`)
+            self.assertEqual(list(report_df['count']), [1, 24, 24, 24, 2])
+            self.assertTrue(np.isclose(report_df['time_share'].sum(), 1))
+            self.assertEqual(report_df.loc['climate', 'nbytes'],
+                             2 * 24 * ms._cropf.nbytes)
+
+        # any callable can be the profiler, and the memory allocated by each
+        # phase can be traced
+        events = []
+        ms = self.simulation(profiler=events.append)
+        ms.simulate()
+        self.assertEqual(len(events), 1 + 3 * 24 + 2)
+        self.assertTrue(all(event.allocated is None for event in events))
+        profiler = pst.Profiler(trace_memory=True)
+        ms = self.simulation(profiler=profiler)
+        ms.simulate(accumulators=[pst.MinMax('runoff')])
+        self.assertIn('outputs', profiler.report().index)
+        self.assertTrue(
+            all(event.allocated >= 0 for event in profiler.events
+                if event.phase != 'setup'))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            trace_filepath = os.path.join(tmp_dir, 'trace.json')
+            profiler.to_chrome_trace(trace_filepath)
+            with open(trace_filepath) as f:
+                trace_events = json.load(f)['traceEvents']
+        self.assertEqual(len(trace_events), len(profiler.events))
+        self.assertTrue(all(event['ph'] == 'X' for event in trace_events))
+
+    def test_metrics(self):
+        parameter_names = ['TOGW', 'C']
+        parameters = np.random.RandomState(0).uniform(.1, .9, (20, 2))
+        for gauges in [None, [(10, 12), (18, 20)]]:
+            ms = self.simulation(gauges=gauges)
+            obs_gauge_flow = ms.simulate()
+            obs_gauge_flow[[8, 15]] = np.nan
+            sim_gauge_flow = ms.simulate_ensemble(
+                parameters, parameter_names=parameter_names)
+            metrics = pst.compute_metrics(sim_gauge_flow, obs_gauge_flow,
+                                          num_warmup_months=6)
+            self.assertEqual(set(metrics), set(pst.METRICS))
+            for metric in pst.METRICS:
+                self.assertEqual(metrics[metric].shape,
+                                 sim_gauge_flow.shape[:1] +
+                                 obs_gauge_flow.shape[1:])
+            # the Nash-Sutcliffe efficiency of each member must match the one
+            # of `utils` without the NaN observations
+            valid = ~np.isnan(obs_gauge_flow[6:]).any(axis=-1) \
+                if gauges is not None else ~np.isnan(obs_gauge_flow[6:])
+            for member_gauge_flow, nash_sutcliffe in zip(
+                    sim_gauge_flow, metrics['nash_sutcliffe']):
+                self.assertTrue(
+                    np.allclose(
+                        pst.nash_sutcliffe(member_gauge_flow[6:][valid],
+                                           obs_gauge_flow[6:][valid]),
+                        nash_sutcliffe))
+            # the Kling-Gupta efficiency is consistent with its components
+            self.assertTrue(
+                np.allclose(
+                    metrics['kling_gupta'], 1 - np.sqrt(
+                        (metrics['correlation'] - 1)**2 +
+                        (metrics['variability_ratio'] - 1)**2 +
+                        (metrics['bias_ratio'] - 1)**2)))
+
+            # streaming the simulated flow month by month must give the same
+            # metrics
+            streaming_metrics = pst.StreamingMetrics(obs_gauge_flow,
+                                                     num_warmup_months=6)
+            for sim_gauge_flow_i in np.moveaxis(sim_gauge_flow, 1, 0):
+                streaming_metrics.update(sim_gauge_flow_i)
+            for metric, values in streaming_metrics.result().items():
+                self.assertTrue(np.allclose(values, metrics[metric]))
+            self.assertRaises(ValueError, streaming_metrics.update,
+                              sim_gauge_flow[:, 0])
+
+        # a perfect simulation
+        metrics = pst.compute_metrics(obs_gauge_flow, obs_gauge_flow,
+                                      num_warmup_months=6)
+        for metric, value in [('nash_sutcliffe', 1), ('kling_gupta', 1),
+                              ('rmse', 0), ('pbias', 0)]:
+            self.assertTrue(np.allclose(metrics[metric], value))
+
+        self.assertRaises(ValueError, pst.compute_metrics, sim_gauge_flow,
+                          obs_gauge_flow[:-1])
+        self.assertRaises(ValueError, pst.compute_metrics, sim_gauge_flow,
+                          obs_gauge_flow, metrics=['foo'])
+
+    def test_lazy_imports(self):
+        # a headless simulation of in-memory arrays (in a fresh interpreter,
+        # since this module imports rasterio) must not import matplotlib nor
+        # rasterio
+        code = (
+            "import sys\n"
+            "import numpy as np\n"
+            "import xarray as xr\n"
+            "import pystream as pst\n"
+            "dims = ('time', 'y', 'x')\n"
+            "ms = pst.MonthlySimulation(\n"
+            "    np.arange(20.).reshape(4, 5), np.ones((4, 5)),\n"
+            "    np.ones((4, 5)),\n"
+            "    xr.Dataset({'prec': (dims, np.ones((12, 4, 5)))}),\n"
+            "    xr.Dataset({'temp': (dims, np.full((12, 4, 5), 10.))}),\n"
+            "    res=(100, 100))\n"
+            "ms.simulate()\n"
+            "print(sorted(module for module in ['matplotlib', 'rasterio']\n"
+            "             if module in sys.modules))")
+        output = subprocess.run(
+            [sys.executable, '-c', code], check=True, capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.dirname(
+                os.path.abspath(__file__)))).stdout
+        self.assertEqual(output.strip(), '[]')
+
+
+class TestCalibration(unittest.TestCase):
+    def setUp(self):
+        dem, cropf, whc, prec_ds, temp_ds = synthetic_inputs()
+        self.ms = pst.MonthlySimulation(dem, cropf, whc, prec_ds, temp_ds,
+                                        res=(100, 100))
+        self.obs_gauge_flow = pst.MonthlySimulation(
+            dem, cropf, whc, prec_ds, temp_ds, res=(100, 100),
+            init_parameters={
+                'TOGW': .3,
+                'C': .4
+            }).simulate()
+        self.parameter_bounds = {'TOGW': (0, 1), 'C': (0, 1)}
+
+    def test_calibrate(self):
+        for method in ['random', 'lhs', 'differential_evolution']:
+            best_parameters, history = pst.calibrate(
+                self.ms, self.obs_gauge_flow, self.parameter_bounds,
+                method=method, num_samples=8, maxiter=2, popsize=4,
+                processes=2, seed=0)
+            self.assertEqual(list(history.columns),
+                             ['TOGW', 'C', 'nash_sutcliffe'])
+            if method != 'differential_evolution':
+                self.assertEqual(len(history), 8)
+            # the parameters that are not calibrated are kept
+            self.assertEqual(best_parameters['HEAT_COEFF'],
+                             self.ms.HEAT_COEFF)
+            for parameter, (low, high) in self.parameter_bounds.items():
+                self.assertTrue(
+                    np.all((history[parameter] >= low)
+                           & (history[parameter] <= high)))
+            # the best parameters must match the evaluations
+            best = history.loc[history['nash_sutcliffe'].idxmax()]
+            self.assertEqual(best_parameters['TOGW'], best['TOGW'])
+            ms = pst.MonthlySimulation(
+                self.ms.dem, self.ms.cropf, self.ms.whc, self.ms.prec_ds,
+                self.ms.temp_ds, res=self.ms.res,
+                init_parameters=best_parameters)
+            ms.simulate()
+            self.assertAlmostEqual(
+                ms.nash_sutcliffe(self.obs_gauge_flow),
+                best['nash_sutcliffe'])
+
+        # the ensembles are split into batches of at most `batch_size`
+        # members, which must not change the evaluations
+        _, batched_history = pst.calibrate(
+            self.ms, self.obs_gauge_flow, self.parameter_bounds,
+            method='lhs', num_samples=8, processes=2, batch_size=3, seed=0)
+        _, history = pst.calibrate(self.ms, self.obs_gauge_flow,
+                                   self.parameter_bounds, method='lhs',
+                                   num_samples=8, processes=2, seed=0)
+        pd.testing.assert_frame_equal(batched_history, history)
+
+        self.assertRaises(ValueError, pst.calibrate, self.ms,
+                          self.obs_gauge_flow, {'FOO': (0, 1)})
+        self.assertRaises(ValueError, pst.calibrate, self.ms,
+                          self.obs_gauge_flow, self.parameter_bounds,
+                          method='foo')
+
+    def test_sensitivity_analysis(self):
+        # the estimators must recover the indices of a linear function, i.e.,
+        # zero interactions and `S1 = ST = a_i**2 / sum(a**2)`
+        a = np.array([1, 2, 0])
+        random_state = np.random.RandomState(0)
+        samples = pst.saltelli_design(1024, 3, seed=0)
+        sobol_df = pst.sensitivity._sobol_indices(samples, samples.dot(a), 100,
+                                                  .95, random_state)
+        for index in ['S1', 'ST']:
+            self.assertTrue(
+                np.allclose(sobol_df[index], a**2 / np.sum(a**2), atol=.05))
+        samples = pst.morris_design(10, 3, random_state=random_state)
+        self.assertEqual(samples.shape, (40, 3))
+        morris_df = pst.sensitivity._morris_indices(samples, samples.dot(a),
+                                                    100, .95, random_state)
+        self.assertTrue(np.allclose(morris_df['mu'], a))
+        self.assertTrue(np.allclose(morris_df['sigma'], 0))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for method, num_runs in [('morris', 4 * 3), ('sobol', 4 * 4)]:
+                results_dir = os.path.join(tmp_dir, method)
+                kwargs = dict(method=method, num_trajectories=4,
+                              num_samples=4, num_resamples=10, processes=2,
+                              batch_size=5, results_dir=results_dir, seed=0)
+                indices_df, runs_df = pst.sensitivity_analysis(
+                    self.ms, self.parameter_bounds,
+                    obs_gauge_flow=self.obs_gauge_flow, **kwargs)
+                self.assertEqual(list(indices_df.index), ['TOGW', 'C'])
+                self.assertEqual(len(runs_df), num_runs)
+                self.assertFalse(runs_df['nash_sutcliffe'].isna().any())
+                # resume after losing the results of a batch
+                os.remove(os.path.join(results_dir, 'runs-0000005.npz'))
+                resumed_indices_df, resumed_runs_df = \
+                    pst.sensitivity_analysis(
+                        self.ms, self.parameter_bounds,
+                        obs_gauge_flow=self.obs_gauge_flow, **kwargs)
+                pd.testing.assert_frame_equal(runs_df, resumed_runs_df)
+                pd.testing.assert_frame_equal(indices_df, resumed_indices_df)
+                # the results of another analysis, or with other
+                # observations, cannot be resumed
+                self.assertRaises(ValueError, pst.sensitivity_analysis,
+                                  self.ms, self.parameter_bounds,
+                                  obs_gauge_flow=self.obs_gauge_flow * 2,
+                                  **kwargs)
+                kwargs['seed'] = 1
+                self.assertRaises(ValueError, pst.sensitivity_analysis,
+                                  self.ms, self.parameter_bounds, **kwargs)
+
+        # without observations, the output is the mean gauge flow
+        indices_df, runs_df = pst.sensitivity_analysis(
+            self.ms, self.parameter_bounds, num_trajectories=2, processes=1)
+        self.assertEqual(list(runs_df.columns),
+                         ['TOGW', 'C', 'mean_gauge_flow'])
+        self.assertEqual(list(indices_df.columns),
+                         ['mu', 'mu_star', 'sigma', 'mu_star_conf'])
+        self.assertRaises(ValueError, pst.sensitivity_analysis, self.ms,
+                          {'FOO': (0, 1)})
+        self.assertRaises(ValueError, pst.sensitivity_analysis, self.ms,
+                          self.parameter_bounds, method='foo')
+
+
+class TestBatch(unittest.TestCase):
+    def test_simulate_catchments(self):
+        dem, cropf, whc, prec_ds, temp_ds = synthetic_inputs(shape=(30, 40))
+        windows = {
+            'a': ((0, 15), (0, 20)),
+            'b': ((5, 30), (10, 40)),
+            'c': ((10, 20), (20, 30))
+        }
+        manifest = []
+        for catchment, window in windows.items():
+            rows, cols = slice(*window[0]), slice(*window[1])
+            manifest.append(
+                dict(catchment=catchment, dem=dem[rows, cols],
+                     cropf=cropf[rows, cols], whc=whc[rows, cols],
+                     climate_window=window))
+        manifest[2]['gauges'] = 'outlet'
+        # a catchment whose rasters do not match fails
+        manifest.append(
+            dict(catchment='d', dem=dem[:5, :5], cropf=cropf[:5, :6],
+                 whc=whc[:5, :5], climate_window=((0, 5), (0, 5))))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            prec_filepath = os.path.join(tmp_dir, 'prec.nc')
+            temp_filepath = os.path.join(tmp_dir, 'temp.nc')
+            prec_ds.to_netcdf(prec_filepath)
+            temp_ds.to_netcdf(temp_filepath)
+            results = pst.simulate_catchments(pd.DataFrame(manifest),
+                                              prec_filepath, temp_filepath,
+                                              processes=2, res=(100, 100))
+
+        self.assertEqual(list(results['catchment'].values),
+                         ['a', 'b', 'c', 'd'])
+        self.assertEqual(results['gauge_flow'].shape, (4, 24))
+        for entry in manifest[:3]:
+            rows, cols = [slice(*bounds) for bounds in windows[
+                entry['catchment']]]
+            gauge_flow = pst.MonthlySimulation(
+                entry['dem'], entry['cropf'], entry['whc'],
+                prec_ds.isel(y=rows, x=cols), temp_ds.isel(y=rows, x=cols),
+                res=(100, 100), gauges=entry.get('gauges')).simulate()
+            self.assertTrue(
+                np.allclose(
+                    results['gauge_flow'].sel(catchment=entry['catchment']),
+                    np.ravel(gauge_flow)))
+            self.assertEqual(
+                results['error'].sel(catchment=entry['catchment']), '')
+        self.assertTrue(
+            np.all(results['gauge_flow'].sel(catchment='d').isnull()))
+        self.assertIn('ValueError',
+                      results['error'].sel(catchment='d').item())
+        self.assertTrue(np.all(results['elapsed_time'] > 0))
+
+        self.assertRaises(ValueError, pst.simulate_catchments, [{
+            'catchment': 'a'
+        }], prec_ds, temp_ds)
+        # a window also applies to the climatological datasets, so it cannot
+        # be combined with a climate window
+        self.assertRaises(ValueError, pst.simulate_catchments, [
+            dict(catchment='a', dem=dem, cropf=cropf, whc=whc,
+                 window=((2, 18), (3, 22)), climate_window=((2, 18), (3, 22)))
+        ], prec_ds, temp_ds, res=(100, 100))